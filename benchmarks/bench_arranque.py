@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Benchmark del arranque: importación de módulos y apertura de la base.
+
+Mide, en procesos nuevos para no medir módulos ya cargados:
+  - el tiempo de importar los módulos sin GTK que carga la extensión,
+  - abrir el gestor recorriendo todo inicializar_db (comportamiento anterior,
+    forzado con PRAGMA user_version = 0) frente al esquema ya versionado,
+  - la primera carpeta que pide Nemo tras una actualización (abrir y migrar
+    la base y leer la carpeta), que corre en un trabajo de fondo,
+  - si gi y Nemo están instalados, importar nemo_etiquetas, crear la extensión
+    y lo que el primer update_file_info_full bloquea el hilo de GTK.
+
+Uso: python3 benchmarks/bench_arranque.py [--archivos N] [--repeticiones N]
+"""
+
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, RAIZ)
+
+from catalogo_sintetico import generar_catalogo
+from gestor_etiquetas import GestorEtiquetasSQLite
+
+# Cada medición corre en un intérprete nuevo e imprime milisegundos
+_IMPORTAR = '''
+import sys, time
+sys.path.insert(0, {raiz!r})
+inicio = time.perf_counter()
+import gestor_etiquetas, cache_carpetas
+print((time.perf_counter() - inicio) * 1000)
+'''
+
+_ABRIR = '''
+import sys, time
+sys.path.insert(0, {raiz!r})
+from gestor_etiquetas import GestorEtiquetasSQLite
+inicio = time.perf_counter()
+GestorEtiquetasSQLite({db_path!r}, usar_indice=True)
+print((time.perf_counter() - inicio) * 1000)
+'''
+
+_PRIMERA_CARPETA = '''
+import sys, time
+sys.path.insert(0, {raiz!r})
+from cache_carpetas import CacheCarpetas
+from gestor_etiquetas import GestorEtiquetasSQLite
+inicio = time.perf_counter()
+CacheCarpetas(GestorEtiquetasSQLite({db_path!r}, usar_indice=True)).cargar('/datos/0')
+print((time.perf_counter() - inicio) * 1000)
+'''
+
+# HOME apunta a una copia de la base: la extensión abre la de siempre
+_EXTENSION = '''
+import sys, time
+sys.path.insert(0, {raiz!r})
+inicio = time.perf_counter()
+import nemo_etiquetas
+from gi.repository import Gio
+importado = time.perf_counter()
+extension = nemo_etiquetas.EtiquetasExtension()
+creado = time.perf_counter()
+
+class Archivo:
+    def get_uri_scheme(self):
+        return 'file'
+    def get_location(self):
+        return Gio.File.new_for_path('/datos/0/archivo-0.pdf')
+
+extension.update_file_info_full(None, None, None, Archivo())
+pedido = time.perf_counter()
+while extension._cache_carpetas is None or extension._cache_carpetas.obtener('/datos/0') is None:
+    time.sleep(0.001)
+print((importado - inicio) * 1000, (creado - importado) * 1000,
+      (pedido - creado) * 1000, (time.perf_counter() - creado) * 1000)
+'''
+
+
+def ejecutar(codigo, entorno=None, **valores):
+    """Ejecuta el código en un intérprete nuevo y devuelve los números que imprime"""
+    salida = subprocess.run(
+        [sys.executable, '-c', codigo.format(raiz=RAIZ, **valores)],
+        capture_output=True, text=True, check=True, env=entorno
+    ).stdout
+    return [float(valor) for valor in salida.strip().splitlines()[-1].split()]
+
+
+def mejor(codigo, repeticiones, antes=None, entorno=None, **valores):
+    """Mejor tiempo de varias ejecuciones; antes() prepara cada una"""
+    tiempos = []
+    for _ in range(repeticiones):
+        if antes is not None:
+            antes()
+        tiempos.append(ejecutar(codigo, entorno, **valores))
+    return min(tiempos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--archivos', type=int, default=100000)
+    parser.add_argument('--etiquetas', type=int, default=5000)
+    parser.add_argument('--repeticiones', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Donde la abre la extensión con HOME=tmp
+        db_path = os.path.join(tmp, '.local', 'share', 'nemo-etiquetas', 'etiquetas.db')
+        gestor = GestorEtiquetasSQLite(db_path)
+        generar_catalogo(gestor, args.archivos, args.etiquetas, 4)
+        gestor.close()
+
+        def olvidar_version():
+            with sqlite3.connect(db_path) as conn:
+                conn.execute('PRAGMA user_version = 0')
+
+        importar, = mejor(_IMPORTAR, args.repeticiones)
+        completo, = mejor(_ABRIR, args.repeticiones, antes=olvidar_version, db_path=db_path)
+        versionado, = mejor(_ABRIR, args.repeticiones, db_path=db_path)
+        primera, = mejor(_PRIMERA_CARPETA, args.repeticiones, antes=olvidar_version, db_path=db_path)
+
+        print(f"Base: {args.archivos} archivos, {args.etiquetas} etiquetas")
+        print(f"  importar módulos sin GTK:        {importar:8.2f} ms")
+        print(f"  abrir gestor, esquema completo:  {completo:8.2f} ms")
+        print(f"  abrir gestor, esquema versionado:{versionado:8.2f} ms")
+        print(f"  primera carpeta (de fondo):      {primera:8.2f} ms")
+
+        try:
+            importar, crear, hilo_gtk, carpeta = mejor(
+                _EXTENSION, args.repeticiones, antes=olvidar_version, entorno=dict(os.environ, HOME=tmp)
+            )
+        except subprocess.CalledProcessError:
+            print("  extensión: gi/Nemo no disponibles, no se mide")
+            return
+        print(f"  importar nemo_etiquetas:         {importar:8.2f} ms")
+        print(f"  EtiquetasExtension():            {crear:8.2f} ms")
+        print(f"  1er update_file_info, hilo GTK:  {hilo_gtk:8.2f} ms")
+        print(f"  1er update_file_info, carpeta:   {carpeta:8.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
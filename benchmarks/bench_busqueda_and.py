@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Benchmark de buscar_por_etiquetas (AND) sobre un catálogo sintético.
+
+Compara la consulta anterior (subconsulta COUNT(*) correlacionada por cada
+archivo) con la intersección que parte de la etiqueta más rara.
+
+Uso: python3 benchmarks/bench_busqueda_and.py [--archivos N] [--etiquetas N]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from catalogo_sintetico import generar_catalogo
+from gestor_etiquetas import GestorEtiquetasSQLite
+
+
+def buscar_and_anterior(conn, etiquetas):
+    """Consulta AND anterior, conservada solo como referencia"""
+    placeholders = ','.join(['?'] * len(etiquetas))
+    query = f'''
+        SELECT a.ruta
+        FROM archivos a
+        WHERE (
+            SELECT COUNT(*)
+            FROM archivo_etiqueta ae
+            JOIN etiquetas e ON e.id = ae.etiqueta_id
+            WHERE ae.archivo_id = a.id
+            AND e.nombre IN ({placeholders})
+        ) = ?
+    '''
+    return [row[0] for row in conn.execute(query, etiquetas + [len(etiquetas)])]
+
+
+def medir(funcion, repeticiones):
+    """Devuelve (mejor tiempo en ms, resultado)"""
+    mejor = None
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion()
+        transcurrido = (time.perf_counter() - inicio) * 1000
+        mejor = transcurrido if mejor is None else min(mejor, transcurrido)
+    return mejor, resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--archivos', type=int, default=1000000)
+    parser.add_argument('--etiquetas', type=int, default=10000)
+    parser.add_argument('--por-archivo', type=int, default=4)
+    parser.add_argument('--repeticiones', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        gestor = GestorEtiquetasSQLite(os.path.join(tmp, 'etiquetas.db'))
+        inicio = time.perf_counter()
+        generar_catalogo(gestor, args.archivos, args.etiquetas, args.por_archivo)
+        print(f"Catálogo: {args.archivos} archivos, {args.etiquetas} etiquetas "
+              f"({time.perf_counter() - inicio:.1f} s de generación)")
+
+        # Consultas con etiquetas comunes: el peor caso para la consulta anterior
+        consultas = {
+            1: ['etiqueta-0'],
+            3: ['etiqueta-0', 'etiqueta-1', 'etiqueta-2'],
+            8: [f'etiqueta-{n}' for n in (0, 1, 2, 3, 5, 8, 13, 21)],
+        }
+        conn = gestor._conexion()
+        for num, etiquetas in consultas.items():
+            t_antes, r_antes = medir(lambda: buscar_and_anterior(conn, etiquetas), args.repeticiones)
+            t_ahora, r_ahora = medir(lambda: gestor.buscar_por_etiquetas(etiquetas, 'AND'), args.repeticiones)
+            assert sorted(r_antes) == sorted(r_ahora)
+            print(f"  {num} etiqueta(s): {len(r_ahora):7d} resultados | "
+                  f"anterior {t_antes:9.1f} ms | actual {t_ahora:9.1f} ms | {t_antes / t_ahora:6.1f}x")
+        gestor.close()
+
+
+if __name__ == '__main__':
+    main()
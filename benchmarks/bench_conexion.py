@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Microbenchmark: latencia por llamada con conexión nueva vs. conexión persistente.
+
+Uso: python3 benchmarks/bench_conexion.py [--llamadas N]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gestor_etiquetas import GestorEtiquetasSQLite
+
+
+def obtener_etiquetas_conexion_nueva(db_path, ruta_archivo):
+    """Comportamiento anterior: un sqlite3.connect() por llamada"""
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.execute('''
+            SELECT t.nombre, t.color
+            FROM etiquetas t
+            JOIN archivo_etiqueta ae ON t.id = ae.etiqueta_id
+            JOIN archivos a ON a.id = ae.archivo_id
+            WHERE a.ruta = ?
+        ''', (ruta_archivo,))
+        return [{'nombre': row[0], 'color': row[1]} for row in cursor]
+
+
+def medir(funcion, llamadas):
+    """Devuelve la latencia media por llamada en microsegundos"""
+    inicio = time.perf_counter()
+    for _ in range(llamadas):
+        funcion()
+    return (time.perf_counter() - inicio) / llamadas * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--llamadas', type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        archivo = os.path.join(tmp, 'factura.pdf')
+        open(archivo, 'w').close()
+
+        gestor = GestorEtiquetasSQLite(os.path.join(tmp, 'etiquetas.db'))
+        gestor.agregar_etiquetas(archivo, ['cliente-x', 'factura', '2024'])
+
+        antes = medir(lambda: obtener_etiquetas_conexion_nueva(gestor.db_path, archivo), args.llamadas)
+        despues = medir(lambda: gestor.obtener_etiquetas_archivo(archivo), args.llamadas)
+        gestor.close()
+
+    print(f"obtener_etiquetas_archivo ({args.llamadas} llamadas)")
+    print(f"  conexión por llamada: {antes:8.1f} µs/llamada")
+    print(f"  conexión persistente: {despues:8.1f} µs/llamada")
+    print(f"  mejora:               {antes / despues:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Benchmark de la importación y exportación masiva (intercambio_etiquetas).
+
+Genera un JSONL sintético (catalogo_sintetico.py) con etiquetas sesgadas
+hacia unas pocas y lo importa en una base vacía con los índices diferidos
+y sin diferir; después exporta la base a JSONL y CSV. Cada importación
+corre en un proceso nuevo para medir su memoria máxima por separado.
+
+Uso: python3 benchmarks/bench_importacion.py [--pares N] [--etiquetas N]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, RAIZ)
+
+from catalogo_sintetico import escribir_jsonl
+from gestor_etiquetas import GestorEtiquetasSQLite
+from intercambio_etiquetas import exportar
+
+# Imprime segundos y memoria máxima (MiB) de una importación
+_IMPORTAR = '''
+import resource, sys
+sys.path.insert(0, {raiz!r})
+from gestor_etiquetas import GestorEtiquetasSQLite
+from intercambio_etiquetas import importar
+with GestorEtiquetasSQLite({db_path!r}) as gestor:
+    resultado = importar(gestor, {entrada!r}, diferir_indices={diferir!r})
+print(resultado['segundos'], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+'''
+
+
+def importar_en_proceso(entrada, db_path, diferir):
+    """Importa en un intérprete nuevo; devuelve (segundos, MiB)"""
+    salida = subprocess.run(
+        [sys.executable, '-c', _IMPORTAR.format(raiz=RAIZ, db_path=db_path, entrada=entrada, diferir=diferir)],
+        capture_output=True, text=True, check=True
+    ).stdout
+    segundos, memoria = salida.strip().splitlines()[-1].split()
+    return float(segundos), float(memoria)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pares', type=int, default=2000000)
+    parser.add_argument('--etiquetas', type=int, default=5000)
+    parser.add_argument('--por-archivo', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        entrada = os.path.join(tmp, 'entrada.jsonl')
+        pares = escribir_jsonl(entrada, args.pares // args.por_archivo, args.etiquetas, args.por_archivo)
+        print(f"Entrada: {pares} pares, {os.path.getsize(entrada) / 2**20:.0f} MiB")
+
+        for diferir in (True, False):
+            db_path = os.path.join(tmp, f'etiquetas-{diferir}.db')
+            segundos, memoria = importar_en_proceso(entrada, db_path, diferir)
+            modo = "índices diferidos" if diferir else "índices y triggers"
+            print(f"  {'importar (' + modo + '):':<32}{pares / segundos:10.0f} pares/s "
+                  f"({segundos:.1f} s, {memoria:.0f} MiB máx.)")
+
+        with GestorEtiquetasSQLite(os.path.join(tmp, 'etiquetas-True.db')) as gestor:
+            for formato in ('jsonl', 'csv'):
+                inicio = time.perf_counter()
+                exportar(gestor, os.path.join(tmp, f'salida.{formato}'), formato)
+                segundos = time.perf_counter() - inicio
+                print(f"  {'exportar ' + formato + ':':<32}{pares / segundos:10.0f} pares/s "
+                      f"({segundos:.1f} s)")
+
+
+if __name__ == '__main__':
+    main()
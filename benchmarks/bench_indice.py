@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Benchmark del índice invertido en memoria frente a las búsquedas en SQLite.
+
+Uso: python3 benchmarks/bench_indice.py [--archivos N] [--etiquetas N]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bench_busqueda_and import medir
+from catalogo_sintetico import generar_catalogo
+from gestor_etiquetas import GestorEtiquetasSQLite
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--archivos', type=int, default=1000000)
+    parser.add_argument('--etiquetas', type=int, default=10000)
+    parser.add_argument('--por-archivo', type=int, default=4)
+    parser.add_argument('--repeticiones', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'etiquetas.db')
+        sqlite = GestorEtiquetasSQLite(db_path)
+        generar_catalogo(sqlite, args.archivos, args.etiquetas, args.por_archivo)
+        indice = GestorEtiquetasSQLite(db_path, usar_indice=True)
+        print(f"Catálogo: {args.archivos} archivos, {args.etiquetas} etiquetas")
+
+        consultas = [
+            (['etiqueta-0', 'etiqueta-1', 'etiqueta-2'], 'AND'),
+            ([f'etiqueta-{n}' for n in (0, 1, 2, 3, 5, 8, 13, 21)], 'AND'),
+            (['etiqueta-40', 'etiqueta-41', 'etiqueta-42'], 'OR'),
+        ]
+        for etiquetas, operador in consultas:
+            inicio = time.perf_counter()
+            indice.buscar_por_etiquetas(etiquetas, operador)
+            primera = (time.perf_counter() - inicio) * 1000
+
+            t_sqlite, r_sqlite = medir(lambda: sqlite.buscar_por_etiquetas(etiquetas, operador), args.repeticiones)
+            t_indice, r_indice = medir(lambda: indice.buscar_por_etiquetas(etiquetas, operador), args.repeticiones)
+            ids = indice._conexion().execute(
+                f"SELECT id FROM etiquetas WHERE nombre IN ({','.join('?' * len(etiquetas))})", etiquetas
+            ).fetchall()
+            t_bits, _ = medir(lambda: indice._indice.buscar([i for (i,) in ids], operador), args.repeticiones)
+            assert r_sqlite == r_indice
+            print(f"  {operador} x{len(etiquetas)}: {len(r_indice):7d} resultados | SQLite {t_sqlite:8.1f} ms | "
+                  f"índice {t_indice:8.1f} ms (carga inicial {primera:.0f} ms, "
+                  f"operación de bits {t_bits:.2f} ms)")
+        sqlite.close()
+        indice.close()
+
+
+if __name__ == '__main__':
+    main()
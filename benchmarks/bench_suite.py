@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""Suite de benchmarks del gestor de etiquetas con salida JSON comparable.
+
+Genera un catálogo sintético determinista (catalogo_sintetico.py) y mide
+los métodos públicos de GestorEtiquetasSQLite (las búsquedas AND/OR con y
+sin índice en memoria, la limpieza, la importación...) y el caché de
+búsquedas (materializar_enlaces y actualizar_enlaces). El resultado es un
+JSON con el entorno, los parámetros del catálogo y, por cada medición, los
+tiempos mínimo, mediano, medio y máximo en milisegundos.
+
+Con --comparar ANTERIOR.json muestra la variación de la mediana respecto a
+otra ejecución y termina con código 1 si alguna empeora más de --umbral.
+
+Uso: python3 benchmarks/bench_suite.py [--archivos N] [--etiquetas N] [--salida R.json]
+                                       [--comparar ANTERIOR.json] [--solo TEXTO]
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, RAIZ)
+
+from cache_busquedas import actualizar_enlaces, escribir_metadata, materializar_enlaces
+from catalogo_sintetico import carpeta_archivo, generar_catalogo, nombre_etiqueta, ruta_archivo
+from gestor_etiquetas import GestorEtiquetasSQLite
+
+# Versión del formato del JSON de resultados
+FORMATO = 1
+
+# Archivos reales (vacíos) para medir la limpieza y los movimientos
+MAX_ARCHIVOS_REALES = 20000
+
+
+def medir(funcion, repeticiones, preparar=None, operaciones=1, calentar=False):
+    """Ejecuta funcion() varias veces; preparar() corre antes de cada una sin medirse"""
+    if calentar:
+        funcion()
+    tiempos = []
+    for _ in range(repeticiones):
+        if preparar is not None:
+            preparar()
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return {
+        'repeticiones': repeticiones,
+        'operaciones': operaciones,
+        'min_ms': min(tiempos),
+        'mediana_ms': statistics.median(tiempos),
+        'media_ms': statistics.fmean(tiempos),
+        'max_ms': max(tiempos),
+    }
+
+
+def consumir(paginas):
+    """Recorre un iterador de páginas y devuelve el número de elementos"""
+    return sum(len(pagina) for pagina in paginas)
+
+
+def entorno():
+    """Versiones y commit con los que se ha medido"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'plataforma': platform.platform(),
+        'fecha': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+class Suite:
+    """Registra y ejecuta las mediciones sobre un catálogo ya generado"""
+
+    def __init__(self, args, tmp, db_path):
+        self.args = args
+        self.tmp = tmp
+        self.db_path = db_path
+        self.resultados = {}
+
+    def medir(self, nombre, funcion, pesado=False, **opciones):
+        """Mide una función si pasa el filtro --solo; las pesadas se repiten una vez"""
+        if self.args.solo and not any(texto in nombre for texto in self.args.solo):
+            return
+        repeticiones = 1 if pesado else self.args.repeticiones
+        print(f"  {nombre} …", file=sys.stderr, end=' ', flush=True)
+        resultado = medir(funcion, repeticiones, **opciones)
+        print(f"{resultado['mediana_ms']:.2f} ms", file=sys.stderr)
+        self.resultados[nombre] = resultado
+
+    def ejecutar(self):
+        args = self.args
+        gestor = GestorEtiquetasSQLite(self.db_path)
+        indice = GestorEtiquetasSQLite(self.db_path, usar_indice=True)
+
+        # Etiquetas por rango: comunes, intermedias y de la cola
+        comun, comun2, comun3 = (nombre_etiqueta(r) for r in (0, 1, 2))
+        media = nombre_etiqueta(args.etiquetas // 10)
+        rara = nombre_etiqueta(args.etiquetas - 1)
+        muestra = [ruta_archivo(n) for n in range(0, args.archivos, max(1, args.archivos // 1000))]
+        consulta = f'({comun} AND NOT {comun2}) OR {media}'
+
+        self.medir('inicializar_db', lambda: GestorEtiquetasSQLite(self.db_path).close())
+        self.medir('version_datos', lambda: [gestor.version_datos() for _ in range(1000)],
+                   operaciones=1000)
+
+        # Lecturas por archivo y por carpeta
+        self.medir('obtener_etiquetas_archivo', lambda: [gestor.obtener_etiquetas_archivo(r) for r in muestra],
+                   operaciones=len(muestra), calentar=True)
+        self.medir('obtener_todas_etiquetas_archivo',
+                   lambda: [gestor.obtener_todas_etiquetas_archivo(r) for r in muestra],
+                   operaciones=len(muestra), calentar=True)
+        self.medir('obtener_etiquetas_comunes', lambda: gestor.obtener_etiquetas_comunes(muestra[:100]),
+                   calentar=True)
+        self.medir('obtener_etiquetas_carpeta', lambda: gestor.obtener_etiquetas_carpeta(carpeta_archivo(0)),
+                   calentar=True)
+        self.medir('obtener_todas_etiquetas', gestor.obtener_todas_etiquetas, calentar=True)
+
+        # Nombres de etiquetas
+        self.medir('buscar_etiquetas[prefijo]', lambda: gestor.buscar_etiquetas('etiqueta-12'), calentar=True)
+        self.medir('buscar_etiquetas[subcadena]', lambda: gestor.buscar_etiquetas('-12'), calentar=True)
+        self.medir('buscar_etiquetas[aproximada]', lambda: gestor.buscar_etiquetas('etiqeuta-123', tolerancia=1),
+                   calentar=True)
+
+        # Búsquedas por etiquetas, en SQLite y con el índice en memoria
+        busquedas = {
+            'AND,comunes': ([comun, comun2, comun3], 'AND'),
+            'AND,comun+media': ([comun, media], 'AND'),
+            'OR,rara+media': ([rara, media], 'OR'),
+            'OR,comunes': ([comun, comun2], 'OR'),
+        }
+        for variante, g in (('sqlite', gestor), ('indice', indice)):
+            for clave, (etiquetas, operador) in busquedas.items():
+                self.medir(f'buscar_por_etiquetas[{clave},{variante}]',
+                           lambda g=g, e=etiquetas, o=operador: g.buscar_por_etiquetas(e, o), calentar=True)
+                self.medir(f'contar_por_etiquetas[{clave},{variante}]',
+                           lambda g=g, e=etiquetas, o=operador: g.contar_por_etiquetas(e, o), calentar=True)
+            self.medir(f'iterar_por_etiquetas[AND,comun,{variante}]',
+                       lambda g=g: consumir(g.iterar_por_etiquetas([comun])), calentar=True)
+
+        # Consultas booleanas y firmas del caché
+        self.medir('buscar_por_consulta', lambda: gestor.buscar_por_consulta(consulta), calentar=True)
+        self.medir('iterar_por_consulta', lambda: consumir(gestor.iterar_por_consulta(consulta)), calentar=True)
+        self.medir('contar_por_consulta', lambda: gestor.contar_por_consulta(consulta), calentar=True)
+        self.medir('firma_busqueda', lambda: gestor.firma_busqueda([comun, media], con_negacion=True),
+                   calentar=True)
+
+        # Escrituras: cada repetición alterna entre añadir y quitar, así que siempre hay cambios
+        # (las etiquetas del catálogo se conservan para no alterar las búsquedas)
+        escritos = {
+            ruta: [etiqueta['nombre'] for etiqueta in gestor.obtener_etiquetas_archivo(ruta)]
+            for ruta in muestra[:200]
+        }
+        archivos_con_extra = {'activo': False}
+
+        def alternar_archivos():
+            extra = [] if archivos_con_extra['activo'] else ['bench-archivo']
+            for ruta, etiquetas in escritos.items():
+                gestor.agregar_etiquetas(ruta, etiquetas + extra)
+            archivos_con_extra['activo'] = not archivos_con_extra['activo']
+        self.medir('agregar_etiquetas', alternar_archivos, operaciones=len(escritos))
+
+        lote_con_extra = {'activo': False}
+
+        def alternar_lote():
+            if lote_con_extra['activo']:
+                gestor.modificar_etiquetas_lote(muestra, quitar=['bench-lote'])
+            else:
+                gestor.modificar_etiquetas_lote(muestra, agregar=['bench-lote'])
+            lote_con_extra['activo'] = not lote_con_extra['activo']
+        self.medir('modificar_etiquetas_lote', alternar_lote, operaciones=len(muestra))
+
+        def en_transaccion():
+            with gestor.transaccion():
+                alternar_archivos()
+        self.medir('transaccion[agregar_etiquetas]', en_transaccion, operaciones=len(escritos))
+
+        self.medir_importacion()
+        self.medir('iterar_asignaciones', lambda: consumir([e] for e in gestor.iterar_asignaciones()),
+                   pesado=True)
+        self.medir_archivos_reales()
+        self.medir_enlaces(gestor, comun)
+
+        indice.close()
+        gestor.close()
+
+    def medir_importacion(self):
+        """importar_pares en una base nueva en cada repetición"""
+        pares = [(f'/importados/{n // 4}', nombre_etiqueta(n % 97)) for n in range(self.args.pares_importacion)]
+        bases = iter(range(self.args.repeticiones))
+        estado = {}
+
+        def preparar():
+            ruta = os.path.join(self.tmp, f'importacion-{next(bases)}.db')
+            estado['gestor'] = GestorEtiquetasSQLite(ruta)
+
+        def importar():
+            estado['gestor'].importar_pares(pares)
+            estado['gestor'].close()
+        self.medir('importar_pares', importar, preparar=preparar, operaciones=len(pares))
+
+    def medir_archivos_reales(self):
+        """limpiar_archivos_inexistentes y reconciliar_movidos sobre archivos que existen"""
+        carpeta = os.path.join(self.tmp, 'reales')
+        os.makedirs(carpeta)
+        num = min(self.args.archivos, MAX_ARCHIVOS_REALES)
+        rutas = [os.path.join(carpeta, f'archivo-{n}.txt') for n in range(num)]
+        for ruta in rutas:
+            open(ruta, 'w').close()
+        gestor = GestorEtiquetasSQLite(os.path.join(self.tmp, 'reales.db'))
+        gestor.importar_pares(((ruta, nombre_etiqueta(n % 50)) for n, ruta in enumerate(rutas)),
+                              comprobar_archivos=True)
+
+        # Un 5 % desaparece: cada repetición vuelve a darlos de alta antes de limpiar
+        desaparecidos = rutas[::20]
+        for ruta in desaparecidos:
+            os.remove(ruta)
+        self.medir(
+            'limpiar_archivos_inexistentes',
+            gestor.limpiar_archivos_inexistentes,
+            preparar=lambda: gestor.importar_pares(
+                ((ruta, 'desaparecido') for ruta in desaparecidos), diferir_indices=False
+            ),
+            operaciones=num
+        )
+
+        # 100 renombrados dentro de la carpeta, alternando entre el nombre original y el nuevo
+        movidos = rutas[1::20][:100]
+        estado = {'movidos': False}
+
+        def renombrar():
+            for ruta in movidos:
+                origen, destino = (ruta, ruta + '.movido') if not estado['movidos'] else (ruta + '.movido', ruta)
+                os.rename(origen, destino)
+            estado['movidos'] = not estado['movidos']
+
+        def reconciliar():
+            nuevas = [ruta + '.movido' for ruta in movidos] if estado['movidos'] else movidos
+            gestor.reconciliar_movidos(nuevas)
+        self.medir('reconciliar_movidos', reconciliar, preparar=renombrar, operaciones=len(movidos))
+        gestor.close()
+
+    def medir_enlaces(self, gestor, etiqueta):
+        """Carpetas de resultados: construcción completa y parche con un 1 % de cambios"""
+        rutas = gestor.buscar_por_etiquetas([etiqueta])[:self.args.enlaces]
+        destino = os.path.join(self.tmp, 'busqueda_bench')
+        self.medir('materializar_enlaces', lambda: materializar_enlaces(destino, rutas),
+                   operaciones=len(rutas))
+
+        # actualizar_enlaces necesita metadata.json: se construye una vez con ella
+        shutil.rmtree(destino, ignore_errors=True)
+        materializar_enlaces(destino, rutas, preparar=lambda c, e: escribir_metadata(c, {}, e))
+        cambios = max(1, len(rutas) // 100)
+        variantes = [rutas, rutas[cambios:] + [f'/nuevos/archivo-{n}' for n in range(cambios)]]
+        estado = {'turno': 0}
+
+        def parchear():
+            estado['turno'] ^= 1
+            actualizar_enlaces(destino, variantes[estado['turno']],
+                               preparar=lambda c, e: escribir_metadata(c, {}, e))
+        self.medir('actualizar_enlaces[1%]', parchear, operaciones=2 * cambios)
+
+
+def comparar(actual, anterior, umbral):
+    """Imprime la variación de las medianas; devuelve cuántas empeoran más del umbral"""
+    regresiones = 0
+    print(f"\nComparación con {anterior['entorno'].get('commit')} (mediana, umbral {umbral:.2f}x):", file=sys.stderr)
+    for nombre, resultado in actual['resultados'].items():
+        previo = anterior['resultados'].get(nombre)
+        if previo is None:
+            print(f"   {nombre:<48} {resultado['mediana_ms']:10.2f} ms  (nuevo)", file=sys.stderr)
+            continue
+        razon = resultado['mediana_ms'] / previo['mediana_ms'] if previo['mediana_ms'] else float('inf')
+        marca = '⚠️ ' if razon > umbral else '   '
+        regresiones += razon > umbral
+        print(f"{marca}{nombre:<48} {previo['mediana_ms']:10.2f} → {resultado['mediana_ms']:10.2f} ms"
+              f"  {razon:5.2f}x", file=sys.stderr)
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--archivos', type=int, default=100000, help="p. ej. de 10k a 5M")
+    parser.add_argument('--etiquetas', type=int, default=5000, help="p. ej. de 100 a 50k")
+    parser.add_argument('--por-archivo', type=int, default=4, help="etiquetas sorteadas por archivo")
+    parser.add_argument('--exponente', type=float, default=1.0, help="exponente de la distribución de Zipf")
+    parser.add_argument('--semilla', type=int, default=42)
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--enlaces', type=int, default=50000, help="máximo de enlaces por carpeta de resultados")
+    parser.add_argument('--pares-importacion', type=int, default=100000)
+    parser.add_argument('--solo', action='append', help="medir solo los nombres que contienen este texto")
+    parser.add_argument('--salida', help="archivo JSON de resultados (por defecto, stdout)")
+    parser.add_argument('--comparar', help="JSON de una ejecución anterior")
+    parser.add_argument('--umbral', type=float, default=1.2, help="razón de medianas que cuenta como regresión")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'etiquetas.db')
+        print(f"Generando catálogo: {args.archivos} archivos, {args.etiquetas} etiquetas…", file=sys.stderr)
+        inicio = time.perf_counter()
+        gestor = GestorEtiquetasSQLite(db_path)
+        asignaciones = generar_catalogo(
+            gestor, args.archivos, args.etiquetas, args.por_archivo, args.exponente, args.semilla
+        )
+        gestor.close()
+        generacion = time.perf_counter() - inicio
+
+        suite = Suite(args, tmp, db_path)
+        suite.ejecutar()
+
+    informe = {
+        'formato': FORMATO,
+        'entorno': entorno(),
+        'catalogo': {
+            'archivos': args.archivos,
+            'etiquetas': args.etiquetas,
+            'por_archivo': args.por_archivo,
+            'exponente': args.exponente,
+            'semilla': args.semilla,
+            'asignaciones': asignaciones,
+            'segundos_generacion': generacion,
+        },
+        'resultados': suite.resultados,
+    }
+    texto = json.dumps(informe, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            f.write(texto + '\n')
+    else:
+        print(texto)
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            anterior = json.load(f)
+        if anterior.get('catalogo', {}).get('archivos') != args.archivos:
+            print("⚠️  El catálogo de la ejecución anterior tiene otro tamaño", file=sys.stderr)
+        return 1 if comparar(informe, anterior, args.umbral) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
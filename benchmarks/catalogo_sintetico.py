@@ -0,0 +1,92 @@
+"""Generador determinista de catálogos sintéticos para los benchmarks.
+
+Con los mismos parámetros y la misma semilla la base generada es siempre
+la misma. Las etiquetas siguen una distribución de Zipf: la de rango r se
+elige con peso 1 / (r + 1) ** exponente, así que unas pocas son muy
+comunes y hay una cola larga de raras.
+"""
+
+import itertools
+import json
+import random
+
+# Archivos por carpeta en las rutas generadas (obtener_etiquetas_carpeta)
+ARCHIVOS_POR_CARPETA = 1000
+
+
+def ruta_archivo(n):
+    """Ruta del archivo n del catálogo"""
+    return f'/datos/{n // ARCHIVOS_POR_CARPETA}/archivo-{n}.pdf'
+
+
+def carpeta_archivo(n):
+    """Carpeta del archivo n del catálogo"""
+    return f'/datos/{n // ARCHIVOS_POR_CARPETA}'
+
+
+def nombre_etiqueta(rango):
+    """Nombre de la etiqueta de un rango (0 es la más común)"""
+    return f'etiqueta-{rango}'
+
+
+def pesos_zipf(num_etiquetas, exponente=1.0):
+    """Pesos acumulados de Zipf para random.choices(cum_weights=...)"""
+    return list(itertools.accumulate(1.0 / (rango + 1) ** exponente for rango in range(num_etiquetas)))
+
+
+def iterar_asignaciones(num_archivos, num_etiquetas, por_archivo, exponente=1.0, semilla=42):
+    """Genera (archivo, rango_etiqueta) con 1..por_archivo etiquetas distintas por archivo"""
+    azar = random.Random(semilla)
+    acumulados = pesos_zipf(num_etiquetas, exponente)
+    rangos = range(num_etiquetas)
+    for archivo in range(num_archivos):
+        for rango in sorted(set(azar.choices(rangos, cum_weights=acumulados, k=por_archivo))):
+            yield archivo, rango
+
+
+def generar_catalogo(gestor, num_archivos, num_etiquetas, por_archivo=4, exponente=1.0,
+                     semilla=42, tamano_lote=100000):
+    """Rellena una base vacía con el catálogo; devuelve el número de asignaciones.
+
+    Inserta con ids explícitos y, como importar_pares, deja los índices
+    secundarios y los triggers para el final.
+    """
+    asignaciones = 0
+    with gestor.transaccion() as conn:
+        diferidos = gestor._objetos_diferibles(conn)
+        for tipo, nombre, _ in diferidos:
+            conn.execute(f'DROP {tipo.upper()} {nombre}')
+
+        conn.executemany(
+            'INSERT INTO etiquetas (id, nombre) VALUES (?, ?)',
+            ((rango + 1, nombre_etiqueta(rango)) for rango in range(num_etiquetas))
+        )
+        conn.executemany(
+            'INSERT INTO archivos (id, ruta, ultima_modificacion) VALUES (?, ?, 0)',
+            ((n + 1, ruta_archivo(n)) for n in range(num_archivos))
+        )
+        pares = iterar_asignaciones(num_archivos, num_etiquetas, por_archivo, exponente, semilla)
+        while True:
+            lote = [(archivo + 1, rango + 1) for archivo, rango in itertools.islice(pares, tamano_lote)]
+            if not lote:
+                break
+            conn.executemany('INSERT INTO archivo_etiqueta (archivo_id, etiqueta_id) VALUES (?, ?)', lote)
+            asignaciones += len(lote)
+
+        for _, _, sql in diferidos:
+            conn.execute(sql)
+        gestor._recalcular_contadores(conn, num_archivos)
+    gestor._conexion().execute('ANALYZE')
+    return asignaciones
+
+
+def escribir_jsonl(ruta, num_archivos, num_etiquetas, por_archivo=4, exponente=1.0, semilla=42):
+    """Escribe el catálogo como JSONL de intercambio (una línea por archivo); devuelve las asignaciones"""
+    asignaciones = 0
+    pares = iterar_asignaciones(num_archivos, num_etiquetas, por_archivo, exponente, semilla)
+    with open(ruta, 'w', encoding='utf-8') as f:
+        for archivo, grupo in itertools.groupby(pares, key=lambda par: par[0]):
+            etiquetas = [nombre_etiqueta(rango) for _, rango in grupo]
+            f.write(json.dumps({'ruta': ruta_archivo(archivo), 'etiquetas': etiquetas}) + '\n')
+            asignaciones += len(etiquetas)
+    return asignaciones
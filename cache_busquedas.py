@@ -0,0 +1,530 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from registro_etiquetas import instrumentado, obtener_registro
+
+log = obtener_registro('cache_busquedas')
+
+# Carpetas a medio construir: nunca coinciden con el patrón busqueda_*_<hash>
+PREFIJO_TEMPORAL = '.tmp_'
+
+# Nombres que no pueden usar los enlaces dentro de una carpeta de resultados
+NOMBRES_RESERVADOS = frozenset({'metadata.json', 'metadata.json.tmp'})
+
+# Carpetas de resultados publicadas: busqueda_<fecha>_<hash>
+PREFIJO_BUSQUEDA = 'busqueda_'
+
+# ext4 guarda en el propio inodo los destinos de enlace de menos de 60 bytes
+MAX_ENLACE_EN_INODO = 59
+
+
+class EnlacesEnDisco(Mapping):
+    """{ruta: nombre} de los enlaces de una carpeta de resultados, guardado en disco.
+
+    Una búsqueda puede devolver millones de archivos: los pares van a una
+    base SQLite privada (un archivo temporal que se borra al cerrarla) en
+    lugar de a un dict, y el diff de actualizar_enlaces se hace en SQL. Las
+    rutas se guardan como bytes (os.fsencode) para conservar las que no son
+    UTF-8.
+    """
+
+    def __init__(self):
+        # '' abre una base temporal en disco, no en memoria
+        self._conn = sqlite3.connect('')
+        self._conn.execute('PRAGMA journal_mode=OFF')
+        self._conn.execute('PRAGMA synchronous=OFF')
+        self._conn.execute('CREATE TABLE enlaces (ruta BLOB PRIMARY KEY, nombre BLOB NOT NULL) WITHOUT ROWID')
+        self._conn.execute('CREATE TABLE nuevas (ruta BLOB PRIMARY KEY) WITHOUT ROWID')
+
+    def agregar(self, pares):
+        """Añade (o sustituye) pares (ruta, nombre)"""
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO enlaces (ruta, nombre) VALUES (?, ?)',
+            ((os.fsencode(ruta), os.fsencode(nombre)) for ruta, nombre in pares)
+        )
+
+    def comparar(self, rutas, tamano_lote=1000):
+        """Carga las rutas de los resultados nuevos y deja en `nuevas` las que no tienen enlace"""
+        rutas = iter(rutas)
+        for lote in iter(lambda: list(islice(rutas, tamano_lote)), []):
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO nuevas (ruta) VALUES (?)', ((os.fsencode(ruta),) for ruta in lote)
+            )
+
+    def sobrantes(self):
+        """Pares (ruta, nombre) de los enlaces cuya ruta no está entre las nuevas"""
+        cursor = self._conn.execute(
+            'SELECT ruta, nombre FROM enlaces e WHERE NOT EXISTS (SELECT 1 FROM nuevas n WHERE n.ruta = e.ruta)'
+        )
+        for ruta, nombre in cursor:
+            yield os.fsdecode(ruta), os.fsdecode(nombre)
+
+    def quitar_sobrantes(self):
+        """Olvida los enlaces sobrantes y deja en `nuevas` solo las rutas sin enlace; devuelve cuántos quitó"""
+        quitados = self._conn.execute(
+            'DELETE FROM enlaces WHERE ruta NOT IN (SELECT ruta FROM nuevas)'
+        ).rowcount
+        self._conn.execute('DELETE FROM nuevas WHERE ruta IN (SELECT ruta FROM enlaces)')
+        return quitados
+
+    def faltantes(self):
+        """Rutas nuevas sin enlace (tras quitar_sobrantes)"""
+        for (ruta,) in self._conn.execute('SELECT ruta FROM nuevas'):
+            yield os.fsdecode(ruta)
+
+    def __getitem__(self, ruta):
+        fila = self._conn.execute('SELECT nombre FROM enlaces WHERE ruta = ?', (os.fsencode(ruta),)).fetchone()
+        if fila is None:
+            raise KeyError(ruta)
+        return os.fsdecode(fila[0])
+
+    def __iter__(self):
+        for (ruta,) in self._conn.execute('SELECT ruta FROM enlaces'):
+            yield os.fsdecode(ruta)
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM enlaces').fetchone()[0]
+
+    def items(self):
+        """Pares (ruta, nombre) en una sola consulta, sin buscar cada clave"""
+        for ruta, nombre in self._conn.execute('SELECT ruta, nombre FROM enlaces'):
+            yield os.fsdecode(ruta), os.fsdecode(nombre)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excepcion):
+        self.close()
+
+
+def _crear_enlace(dir_fd, ruta, siguiente, reservados=NOMBRES_RESERVADOS):
+    """Crea el enlace de una ruta con un nombre libre; devuelve el nombre o None si falla.
+
+    Usa el nombre del archivo y, si ya existe en la carpeta, 'nombre_1.ext',
+    'nombre_2.ext'... Es el propio symlink() el que detecta la colisión, así
+    que no hace falta tener en memoria todos los nombres usados: `siguiente`
+    solo guarda el próximo contador de los nombres que ya chocaron.
+    """
+    nombre = os.path.basename(ruta)
+    base, extension = os.path.splitext(nombre)
+    candidato, contador = nombre, None
+    while True:
+        if candidato not in reservados:
+            try:
+                os.symlink(ruta, candidato, dir_fd=dir_fd)
+            except FileExistsError:
+                pass
+            except OSError as e:
+                log.warning("Error creando enlace para %s: %s", ruta, e)
+                return None
+            else:
+                if contador is not None:
+                    siguiente[nombre] = contador + 1
+                return candidato
+        contador = siguiente.get(nombre, 1) if contador is None else contador + 1
+        candidato = f"{base}_{contador}{extension}"
+
+
+def _crear_lote(dir_fd, lote, siguiente):
+    """Crea un lote de enlaces relativos al descriptor de la carpeta; devuelve los creados"""
+    creados = []
+    for ruta in lote:
+        nombre = _crear_enlace(dir_fd, ruta, siguiente)
+        if nombre is not None:
+            creados.append((ruta, nombre))
+    return creados
+
+
+def _crear_enlaces(dir_fd, rutas, enlaces, hilos, tamano_lote):
+    """Crea los enlaces de las rutas por lotes en paralelo y los anota en `enlaces`; devuelve cuántos creó"""
+    rutas = iter(rutas)
+    siguiente = {}
+    creados = 0
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        # Como mucho 2·hilos lotes en vuelo: la lista de rutas puede ser enorme
+        pendientes = []
+        for lote in iter(lambda: list(islice(rutas, tamano_lote)), []):
+            pendientes.append(pool.submit(_crear_lote, dir_fd, lote, siguiente))
+            if len(pendientes) >= 2 * hilos:
+                lote_creado = pendientes.pop(0).result()
+                enlaces.agregar(lote_creado)
+                creados += len(lote_creado)
+        for futuro in pendientes:
+            lote_creado = futuro.result()
+            enlaces.agregar(lote_creado)
+            creados += len(lote_creado)
+    return creados
+
+
+@instrumentado(filas=lambda creados: creados)
+def materializar_enlaces(carpeta_destino, rutas, preparar=None, hilos=8, tamano_lote=1000):
+    """Crea carpeta_destino con un enlace simbólico por ruta, de forma atómica.
+
+    Los enlaces se crean en una carpeta temporal junto al destino, por lotes
+    en paralelo y relativos a su descriptor (sin resolver la ruta completa en
+    cada llamada). preparar(carpeta_temporal, enlaces) recibe {ruta: nombre}
+    de los enlaces creados (un EnlacesEnDisco) y puede añadir otros archivos,
+    como metadata.json, antes de publicar. Al final la carpeta se renombra al
+    destino, así que nadie ve una carpeta a medias. Devuelve los enlaces
+    creados; si no se creó ninguno, no se publica nada.
+    """
+    padre, nombre_destino = os.path.split(os.path.abspath(carpeta_destino))
+    temporal = tempfile.mkdtemp(prefix=PREFIJO_TEMPORAL, dir=padre)
+    try:
+        with EnlacesEnDisco() as enlaces:
+            dir_fd = os.open(temporal, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                creados = _crear_enlaces(dir_fd, rutas, enlaces, hilos, tamano_lote)
+            finally:
+                os.close(dir_fd)
+
+            if not creados:
+                shutil.rmtree(temporal, ignore_errors=True)
+                return 0
+
+            if preparar is not None:
+                preparar(temporal, enlaces)
+        os.chmod(temporal, 0o755)  # mkdtemp crea la carpeta con 0700
+        _publicar(temporal, os.path.join(padre, nombre_destino))
+        return creados
+    except BaseException:
+        shutil.rmtree(temporal, ignore_errors=True)
+        raise
+
+
+@instrumentado(filas=lambda cambios: sum(cambios) if cambios else 0)
+def actualizar_enlaces(carpeta, rutas, preparar=None, hilos=8, tamano_lote=1000):
+    """Actualiza en su sitio una carpeta de resultados con los resultados nuevos.
+
+    Compara las rutas con los enlaces guardados en metadata.json: solo se
+    crean los enlaces de las rutas nuevas y se borran los de las que ya no
+    están, así que el trabajo en disco es proporcional a los cambios. Los
+    demás enlaces conservan su nombre. La comparación se hace en un
+    EnlacesEnDisco, sin cargar las listas en memoria. preparar(carpeta,
+    enlaces) recibe el {ruta: nombre} final para reescribir metadata.json.
+    Devuelve (añadidos, eliminados), o None si la carpeta no tiene un
+    metadata.json con enlaces y hay que construirla de nuevo.
+    """
+    with EnlacesEnDisco() as enlaces:
+        try:
+            enlaces.agregar(iterar_enlaces(carpeta))
+        except (OSError, ValueError):
+            return None
+        enlaces.comparar(rutas, tamano_lote)
+
+        dir_fd = os.open(carpeta, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for _, nombre in enlaces.sobrantes():
+                try:
+                    os.unlink(nombre, dir_fd=dir_fd)
+                except FileNotFoundError:
+                    pass
+            quitados = enlaces.quitar_sobrantes()
+            # Los enlaces que se quedan siguen en la carpeta: los nombres nuevos no los pisan
+            creados = _crear_enlaces(dir_fd, enlaces.faltantes(), enlaces, hilos, tamano_lote)
+        finally:
+            os.close(dir_fd)
+        if not creados and not quitados:
+            return 0, 0
+
+        if preparar is not None:
+            preparar(carpeta, enlaces)
+        return creados, quitados
+
+
+def iterar_enlaces(carpeta, tamano_bloque=1000):
+    """Recorre los pares (ruta, nombre) del metadata.json de una carpeta de resultados.
+
+    escribir_metadata pone cada enlace en su línea, así que se leen por
+    bloques sin cargar el JSON entero. Lanza OSError si no hay metadata.json y
+    ValueError si no tiene enlaces en ese formato.
+    """
+    with open(os.path.join(carpeta, 'metadata.json'), encoding='utf-8', errors='surrogateescape') as f:
+        for linea in f:
+            if linea == '  "enlaces": {}\n':
+                return
+            if linea == '  "enlaces": {\n':
+                break
+        else:
+            raise ValueError("metadata.json sin enlaces")
+        # Se decodifican bloques de líneas: un json.loads por bloque, no por enlace
+        for lineas in iter(lambda: list(islice(f, tamano_bloque)), []):
+            final = '  }\n' in lineas
+            if final:
+                del lineas[lineas.index('  }\n'):]
+            if lineas:
+                bloque = json.loads('{' + ''.join(lineas).rstrip().rstrip(',') + '}')
+                if len(bloque) != len(lineas) or not all(isinstance(nombre, str) for nombre in bloque.values()):
+                    raise ValueError("Enlaces no válidos en metadata.json")
+                yield from bloque.items()
+            if final:
+                return
+        raise ValueError("metadata.json incompleto")
+
+
+def escribir_metadata(carpeta, datos, enlaces):
+    """Escribe metadata.json (datos + {ruta: nombre}) en streaming y lo sustituye de forma atómica"""
+    ruta_metadata = os.path.join(carpeta, 'metadata.json')
+    temporal = ruta_metadata + '.tmp'
+    with open(temporal, 'w', encoding='utf-8', errors='surrogateescape') as f:
+        f.write('{\n')
+        for clave, valor in datos.items():
+            f.write(f'  {json.dumps(clave)}: {json.dumps(valor, ensure_ascii=False)},\n')
+        f.write('  "enlaces": {')
+        separador = '\n'
+        for ruta, nombre in enlaces.items():
+            f.write(f'{separador}    {json.dumps(ruta, ensure_ascii=False)}: {json.dumps(nombre, ensure_ascii=False)}')
+            separador = ',\n'
+        f.write('\n  }\n}\n')
+    os.replace(temporal, ruta_metadata)
+
+
+def uso_disco(carpeta, enlaces):
+    """Estima los bytes que ocupa una carpeta de resultados sin hacer un lstat() por enlace.
+
+    Cuenta los bloques del directorio y de metadata.json, más un bloque por
+    enlace cuyo destino no cabe en el inodo.
+    """
+    estado = os.stat(carpeta)
+    total = estado.st_blocks * 512
+    try:
+        total += os.stat(os.path.join(carpeta, 'metadata.json')).st_blocks * 512
+    except OSError:
+        pass
+    largos = sum(1 for ruta in enlaces if len(os.fsencode(ruta)) > MAX_ENLACE_EN_INODO)
+    return total + largos * estado.st_blksize
+
+
+def _publicar(temporal, destino):
+    """Renombra la carpeta temporal al destino, reemplazando la anterior si existe"""
+    try:
+        os.rename(temporal, destino)
+        return
+    except OSError:
+        if not os.path.isdir(destino):
+            raise
+    # Destino ocupado: apartar la carpeta anterior, publicar la nueva y borrar la vieja
+    anterior = tempfile.mkdtemp(prefix=PREFIJO_TEMPORAL, dir=os.path.dirname(destino))
+    apartada = os.path.join(anterior, 'anterior')
+    os.rename(destino, apartada)
+    os.rename(temporal, destino)
+    shutil.rmtree(anterior, ignore_errors=True)
+
+
+class IndiceBusquedas:
+    """Índice de las carpetas de resultados guardadas en el caché de búsquedas.
+
+    Una tabla SQLite (indice.db, dentro del propio caché) relaciona cada
+    consulta normalizada con su carpeta, el número de resultados y la firma
+    de la base con la que se construyó (GestorEtiquetasSQLite.firma_busqueda).
+    Reutilizar una búsqueda cuesta una consulta por clave primaria y un
+    stat() de la carpeta: no se recorre el caché ni se leen los enlaces.
+
+    También guarda el último uso, los enlaces y el espacio de cada carpeta, y
+    unos totales mantenidos por triggers, para que desalojar() aplique los
+    límites del caché recorriendo solo las entradas que va a borrar.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(cache_dir, 'indice.db'),
+            timeout=10,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS busquedas (
+                clave TEXT PRIMARY KEY,
+                firma TEXT NOT NULL,
+                carpeta TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                creada REAL NOT NULL,
+                usada REAL NOT NULL
+            )
+        ''')
+        columnas = {fila[1] for fila in self._conn.execute('PRAGMA table_info(busquedas)')}
+        for columna in ('enlaces', 'bytes'):
+            if columna not in columnas:
+                self._conn.execute(f'ALTER TABLE busquedas ADD COLUMN {columna} INTEGER NOT NULL DEFAULT 0')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_busquedas_carpeta ON busquedas(carpeta)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_busquedas_usada ON busquedas(usada)')
+
+        # Totales del caché: desalojar() no tiene que sumar toda la tabla
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS totales (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                entradas INTEGER NOT NULL,
+                bytes INTEGER NOT NULL
+            )
+        ''')
+        self._conn.execute(
+            'INSERT OR IGNORE INTO totales (id, entradas, bytes) '
+            'SELECT 1, COUNT(*), COALESCE(SUM(bytes), 0) FROM busquedas'
+        )
+        self._conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_busquedas_insert
+            AFTER INSERT ON busquedas
+            BEGIN
+                UPDATE totales SET entradas = entradas + 1, bytes = bytes + NEW.bytes;
+            END
+        ''')
+        self._conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_busquedas_delete
+            AFTER DELETE ON busquedas
+            BEGIN
+                UPDATE totales SET entradas = entradas - 1, bytes = bytes - OLD.bytes;
+            END
+        ''')
+        self._conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_busquedas_bytes
+            AFTER UPDATE OF bytes ON busquedas
+            BEGIN
+                UPDATE totales SET bytes = bytes - OLD.bytes + NEW.bytes;
+            END
+        ''')
+
+    @instrumentado(filas=None)
+    def buscar(self, clave, firma):
+        """Devuelve (carpeta, total) si la búsqueda está en caché y al día, o None"""
+        with self._lock:
+            fila = self._conn.execute(
+                'SELECT firma, carpeta, total FROM busquedas WHERE clave = ?', (clave,)
+            ).fetchone()
+            if fila is None:
+                return None
+            firma_guardada, carpeta, total = fila
+            if firma_guardada != firma or not os.path.isdir(carpeta):
+                return None
+            self._conn.execute('UPDATE busquedas SET usada = ? WHERE clave = ?', (time.time(), clave))
+        return carpeta, total
+
+    def carpeta(self, clave):
+        """Devuelve la carpeta registrada para una búsqueda (al día o no), o None"""
+        with self._lock:
+            fila = self._conn.execute('SELECT carpeta FROM busquedas WHERE clave = ?', (clave,)).fetchone()
+        return fila[0] if fila else None
+
+    def registrar(self, clave, firma, carpeta, total, enlaces=None, bytes=None):
+        """Guarda (o sustituye) la carpeta de una búsqueda.
+
+        Si enlaces o bytes son None se conservan los que ya tenía la entrada
+        (p. ej. al parchear una carpeta sin cambios).
+        """
+        ahora = time.time()
+        with self._lock:
+            self._conn.execute('''
+                INSERT INTO busquedas (clave, firma, carpeta, total, creada, usada, enlaces, bytes)
+                VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, 0), COALESCE(?, 0))
+                ON CONFLICT(clave) DO UPDATE SET
+                    firma = excluded.firma,
+                    total = excluded.total,
+                    creada = CASE WHEN carpeta = excluded.carpeta THEN creada ELSE excluded.creada END,
+                    carpeta = excluded.carpeta,
+                    usada = excluded.usada,
+                    enlaces = COALESCE(?, enlaces),
+                    bytes = COALESCE(?, bytes)
+            ''', (clave, firma, carpeta, total, ahora, ahora, enlaces, bytes, enlaces, bytes))
+
+    def olvidar_carpeta(self, carpeta):
+        """Quita del índice la carpeta indicada (p. ej. al borrarla del caché)"""
+        with self._lock:
+            self._conn.execute('DELETE FROM busquedas WHERE carpeta = ?', (carpeta,))
+
+    def totales(self):
+        """Devuelve (entradas, bytes) de todo el caché"""
+        with self._lock:
+            return self._conn.execute('SELECT entradas, bytes FROM totales').fetchone()
+
+    @instrumentado()
+    def desalojar(self, max_entradas=None, max_bytes=None, max_dias=None, proteger=()):
+        """Borra las búsquedas que exceden los límites, de la menos usada a la más reciente.
+
+        Recorre el índice por fecha de último uso y se detiene en la primera
+        entrada que ya cabe en los límites, así que el coste es proporcional a
+        lo que se borra. Las claves de proteger nunca se borran. Devuelve
+        [(carpeta, bytes)] de las carpetas eliminadas.
+        """
+        limite_uso = time.time() - max_dias * 24 * 60 * 60 if max_dias is not None else None
+        desalojadas = []
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                entradas, ocupado = self._conn.execute('SELECT entradas, bytes FROM totales').fetchone()
+                filas = self._conn.execute('SELECT clave, carpeta, bytes, usada FROM busquedas ORDER BY usada')
+                for clave, carpeta, tamano, usada in filas:
+                    sobra = (
+                        (max_entradas is not None and entradas > max_entradas)
+                        or (max_bytes is not None and ocupado > max_bytes)
+                        or (limite_uso is not None and usada < limite_uso)
+                    )
+                    if not sobra:
+                        break
+                    if clave in proteger:
+                        continue
+                    desalojadas.append((clave, carpeta, tamano))
+                    entradas -= 1
+                    ocupado -= tamano
+                self._conn.executemany(
+                    'DELETE FROM busquedas WHERE clave = ?', [(clave,) for clave, _, _ in desalojadas]
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+        # Ya no están en el índice: nadie las va a reutilizar mientras se borran
+        for _, carpeta, _ in desalojadas:
+            shutil.rmtree(carpeta, ignore_errors=True)
+        return [(carpeta, tamano) for _, carpeta, tamano in desalojadas]
+
+    def barrer_huerfanas(self, max_edad_temporal=24 * 60 * 60, min_edad_huerfana=10 * 60):
+        """Borra del caché las carpetas que no están en el índice y las temporales abandonadas.
+
+        Recorre el directorio del caché una vez; pensado para el arranque, no
+        para cada búsqueda. Las carpetas sin registrar más recientes que
+        `min_edad_huerfana` se respetan: una búsqueda en curso las publica
+        antes de llamar a registrar(). Devuelve las carpetas eliminadas.
+        """
+        with self._lock:
+            conocidas = {fila[0] for fila in self._conn.execute('SELECT carpeta FROM busquedas')}
+        ahora = time.time()
+        eliminadas = []
+        with os.scandir(self.cache_dir) as entradas:
+            for entrada in entradas:
+                if not entrada.is_dir(follow_symlinks=False):
+                    continue
+                if entrada.name.startswith(PREFIJO_TEMPORAL):
+                    # Carpeta a medio construir abandonada (p. ej. Nemo se cerró)
+                    edad_minima = max_edad_temporal
+                elif entrada.name.startswith(PREFIJO_BUSQUEDA) and entrada.path not in conocidas:
+                    edad_minima = min_edad_huerfana
+                else:
+                    continue
+                try:
+                    if ahora - entrada.stat(follow_symlinks=False).st_mtime <= edad_minima:
+                        continue
+                except OSError:
+                    continue
+                shutil.rmtree(entrada.path, ignore_errors=True)
+                eliminadas.append(entrada.path)
+        return eliminadas
+
+    def close(self):
+        """Cierra la conexión del índice"""
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,78 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class CacheCarpetas:
+    """Caché en memoria carpeta → {ruta: [etiquetas]} para los emblemas de Nemo.
+
+    Cada carpeta se lee con una sola consulta indexada (obtener_etiquetas_carpeta)
+    la primera vez que Nemo pide información de uno de sus archivos. Las
+    escrituras del propio gestor invalidan solo las carpetas afectadas, a
+    través de agregar_oyente; las de otros procesos se detectan con
+    PRAGMA data_version en la siguiente carga y vacían la caché entera.
+    Cada carga reconcilia antes la carpeta (reconciliar_carpeta), así que un
+    archivo movido aquí desde otra carpeta recupera sus etiquetas.
+    """
+
+    def __init__(self, gestor, max_carpetas=64):
+        self._gestor = gestor
+        self._max_carpetas = max_carpetas
+        self._lock = threading.Lock()
+        # carpeta -> {ruta: [etiquetas]}, en orden de uso (LRU)
+        self._carpetas = OrderedDict()
+        # Cambia con cada invalidación: una carga que la cruza no se guarda
+        self._generacion = 0
+        self._data_version = None
+        gestor.agregar_oyente(self.invalidar)
+
+    def obtener(self, carpeta):
+        """Devuelve las etiquetas de la carpeta si están en caché, o None (no consulta la base)"""
+        with self._lock:
+            etiquetas = self._carpetas.get(carpeta)
+            if etiquetas is not None:
+                self._carpetas.move_to_end(carpeta)
+            return etiquetas
+
+    def cargar(self, carpeta):
+        """Lee las etiquetas de la carpeta de la base y las guarda en caché.
+
+        Pensado para un hilo de trabajo: data_version se compara siempre en
+        la conexión de ese hilo.
+        """
+        # Antes de leer: los archivos perdidos que reaparecen aquí recuperan sus etiquetas
+        self._gestor.reconciliar_carpeta(carpeta)
+        data_version = self._gestor.version_datos()
+        with self._lock:
+            if data_version != self._data_version:
+                # Otra conexión ha escrito: lo guardado puede estar obsoleto
+                self._carpetas.clear()
+                self._generacion += 1
+                self._data_version = data_version
+            generacion = self._generacion
+        
+        etiquetas = self._gestor.obtener_etiquetas_carpeta(carpeta)
+        
+        with self._lock:
+            if generacion == self._generacion:
+                self._carpetas[carpeta] = etiquetas
+                self._carpetas.move_to_end(carpeta)
+                while len(self._carpetas) > self._max_carpetas:
+                    self._carpetas.popitem(last=False)
+        return etiquetas
+
+    def invalidar(self, rutas=None):
+        """Descarta las carpetas que contienen las rutas indicadas (o todas)"""
+        with self._lock:
+            self._generacion += 1
+            if rutas is None:
+                self._carpetas.clear()
+                return
+            for carpeta in {os.path.dirname(ruta) for ruta in rutas}:
+                self._carpetas.pop(carpeta, None)
+
+    def close(self):
+        """Deja de escuchar los cambios del gestor y libera la memoria"""
+        self._gestor.quitar_oyente(self.invalidar)
+        with self._lock:
+            self._carpetas.clear()
@@ -0,0 +1,321 @@
+import json
+import re
+
+# Nodos del árbol de consulta:
+#   ('etiqueta', nombre) | ('not', nodo) | ('and', [nodos]) | ('or', [nodos])
+
+_TOKENS = re.compile(r'''
+    \s*(?:
+        (?P<abre>\()
+      | (?P<cierra>\))
+      | "(?P<comillas>(?:[^"\\]|\\.)*)"
+      | (?P<palabra>[^\s()"]+)
+    )''', re.VERBOSE)
+
+_OPERADORES = {'AND', 'OR', 'NOT'}
+
+# Niveles de anidamiento admitidos (paréntesis y operadores): el analizador
+# es recursivo y cada nivel anida subconsultas en el SQL compilado, cuyo
+# analizador (pila de 100 entradas) falla hacia los 12 niveles
+MAX_PROFUNDIDAD = 10
+
+# Etiquetas de una intersección que se encadenan con JOIN (SQLite admite 64
+# tablas por SELECT); las demás se comprueban con una sola subconsulta
+MAX_ETIQUETAS_JOIN = 8
+
+
+class ErrorConsulta(ValueError):
+    """Consulta de etiquetas mal formada"""
+
+
+def _tokenizar(texto):
+    """Divide la consulta en tokens (tipo, valor)"""
+    tokens = []
+    posicion = 0
+    texto = texto.rstrip()
+    while posicion < len(texto):
+        m = _TOKENS.match(texto, posicion)
+        if m is None or m.end() == posicion:
+            raise ErrorConsulta(f"Carácter inesperado en la posición {posicion + 1}")
+        posicion = m.end()
+        if m.group('abre'):
+            tokens.append(('(', '('))
+        elif m.group('cierra'):
+            tokens.append((')', ')'))
+        elif m.group('comillas') is not None:
+            tokens.append(('etiqueta', re.sub(r'\\(.)', r'\1', m.group('comillas'))))
+        elif m.group('palabra').upper() in _OPERADORES:
+            tokens.append((m.group('palabra').upper(), None))
+        else:
+            tokens.append(('etiqueta', m.group('palabra')))
+    return tokens
+
+
+class _Analizador:
+    """Analizador descendente recursivo:
+
+        expresion := termino (OR termino)*
+        termino   := factor ([AND] factor)*     (AND implícito entre factores)
+        factor    := NOT factor | '(' expresion ')' | etiqueta
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.posicion = 0
+        self.profundidad = 0
+
+    def _actual(self):
+        return self.tokens[self.posicion][0] if self.posicion < len(self.tokens) else None
+
+    def _consumir(self, tipo):
+        if self._actual() != tipo:
+            encontrado = self._actual() or 'fin de la consulta'
+            raise ErrorConsulta(f"Se esperaba {tipo} y se encontró {encontrado}")
+        token = self.tokens[self.posicion]
+        self.posicion += 1
+        return token
+
+    def analizar(self):
+        if not self.tokens:
+            raise ErrorConsulta("La consulta está vacía")
+        nodo = self._expresion()
+        if self._actual() is not None:
+            raise ErrorConsulta(f"Token inesperado: {self.tokens[self.posicion][1] or self._actual()}")
+        if _profundidad(nodo) > MAX_PROFUNDIDAD:
+            raise ErrorConsulta(f"Consulta demasiado anidada (máximo {MAX_PROFUNDIDAD} niveles)")
+        return nodo
+
+    def _expresion(self):
+        hijos = [self._termino()]
+        while self._actual() == 'OR':
+            self._consumir('OR')
+            hijos.append(self._termino())
+        return _combinar('or', hijos)
+
+    def _termino(self):
+        hijos = [self._factor()]
+        while self._actual() in ('AND', 'NOT', '(', 'etiqueta'):
+            if self._actual() == 'AND':
+                self._consumir('AND')
+            hijos.append(self._factor())
+        return _combinar('and', hijos)
+
+    def _factor(self):
+        # Las cadenas de NOT se cuentan sin recursión: NOT NOT x == x
+        negaciones = 0
+        while self._actual() == 'NOT':
+            self._consumir('NOT')
+            negaciones += 1
+        if self._actual() == '(':
+            if self.profundidad >= MAX_PROFUNDIDAD:
+                raise ErrorConsulta(f"Consulta demasiado anidada (máximo {MAX_PROFUNDIDAD} niveles)")
+            self._consumir('(')
+            self.profundidad += 1
+            nodo = self._expresion()
+            self.profundidad -= 1
+            self._consumir(')')
+        else:
+            nodo = ('etiqueta', self._consumir('etiqueta')[1])
+        if negaciones % 2:
+            return nodo[1] if nodo[0] == 'not' else ('not', nodo)
+        return nodo
+
+
+def _profundidad(nodo):
+    """Niveles del árbol de consulta (una etiqueta suelta es 1)"""
+    if nodo[0] == 'etiqueta':
+        return 1
+    if nodo[0] == 'not':
+        return 1 + _profundidad(nodo[1])
+    return 1 + max(_profundidad(hijo) for hijo in nodo[1])
+
+
+def _combinar(operador, hijos):
+    """Crea un nodo AND/OR aplanando los hijos del mismo tipo"""
+    planos = []
+    for hijo in hijos:
+        planos.extend(hijo[1] if hijo[0] == operador else [hijo])
+    return planos[0] if len(planos) == 1 else (operador, planos)
+
+
+def analizar_consulta(texto):
+    """Convierte una consulta como '(a OR b) AND c AND NOT d' en un árbol"""
+    return _Analizador(_tokenizar(texto)).analizar()
+
+
+def etiquetas_de(nodo):
+    """Devuelve los nombres de etiqueta que aparecen en el árbol"""
+    if nodo[0] == 'etiqueta':
+        return [nodo[1]]
+    if nodo[0] == 'not':
+        return etiquetas_de(nodo[1])
+    return [nombre for hijo in nodo[1] for nombre in etiquetas_de(hijo)]
+
+
+def contiene_negacion(nodo):
+    """Indica si el árbol tiene algún NOT (el resultado depende de todo el catálogo)"""
+    if nodo[0] == 'etiqueta':
+        return False
+    if nodo[0] == 'not':
+        return True
+    return any(contiene_negacion(hijo) for hijo in nodo[1])
+
+
+def normalizar_consulta(nodo):
+    """Texto canónico del árbol: consultas equivalentes por orden o espacios dan el mismo"""
+    tipo = nodo[0]
+    if tipo == 'etiqueta':
+        return '"' + nodo[1].replace('\\', '\\\\').replace('"', '\\"') + '"'
+    if tipo == 'not':
+        return 'NOT ' + normalizar_consulta(nodo[1])
+    hijos = sorted(set(normalizar_consulta(hijo) for hijo in nodo[1]))
+    if len(hijos) == 1:
+        return hijos[0]
+    return '(' + f' {tipo.upper()} '.join(hijos) + ')'
+
+
+# Conjuntos especiales tras simplificar etiquetas inexistentes
+_VACIO = ('vacio',)
+_TODOS = ('todos',)
+
+
+def _simplificar(nodo, ids):
+    """Sustituye las etiquetas inexistentes y propaga conjuntos vacíos/completos"""
+    tipo = nodo[0]
+    if tipo == 'etiqueta':
+        return nodo if nodo[1] in ids else _VACIO
+    if tipo == 'not':
+        hijo = _simplificar(nodo[1], ids)
+        if hijo == _VACIO:
+            return _TODOS
+        if hijo == _TODOS:
+            return _VACIO
+        return ('not', hijo)
+    hijos = [_simplificar(hijo, ids) for hijo in nodo[1]]
+    if tipo == 'and':
+        if _VACIO in hijos:
+            return _VACIO
+        hijos = [hijo for hijo in hijos if hijo != _TODOS]
+        if not hijos:
+            return _TODOS
+    else:
+        if _TODOS in hijos:
+            return _TODOS
+        hijos = [hijo for hijo in hijos if hijo != _VACIO]
+        if not hijos:
+            return _VACIO
+    return _combinar(tipo, hijos)
+
+
+def _estimacion(nodo, ids):
+    """Estimación del número de archivos de un nodo a partir de etiquetas.total"""
+    tipo = nodo[0]
+    if tipo == 'etiqueta':
+        return ids[nodo[1]][1]
+    if tipo == 'or':
+        return sum(_estimacion(hijo, ids) for hijo in nodo[1])
+    if tipo == 'and':
+        positivos = [_estimacion(hijo, ids) for hijo in nodo[1] if hijo[0] != 'not']
+        return min(positivos) if positivos else float('inf')
+    return float('inf')  # NOT y TODOS: potencialmente todo el catálogo
+
+
+def sql_interseccion(columna, ids_etiquetas):
+    """JOINs y filtro que exigen todas las etiquetas a la fila de archivo_etiqueta t0.
+
+    `ids_etiquetas` son las etiquetas que faltan por comprobar, de la más rara
+    a la más común (t0 ya recorre otra). Las MAX_ETIQUETAS_JOIN primeras se
+    comprueban por clave primaria con CROSS JOIN; el resto, con un único NOT
+    EXISTS sobre un array JSON, así que no hay límite de etiquetas. Devuelve
+    (joins, filtro, parametros_joins, parametros_filtro); el filtro empieza
+    por ' AND' y va en el WHERE. `columna` es el archivo_id de t0.
+    """
+    encadenadas = ids_etiquetas[:MAX_ETIQUETAS_JOIN]
+    resto = ids_etiquetas[MAX_ETIQUETAS_JOIN:]
+    joins = ''.join(
+        f' CROSS JOIN archivo_etiqueta t{n} ON t{n}.archivo_id = {columna} AND t{n}.etiqueta_id = ?'
+        for n in range(1, len(encadenadas) + 1)
+    )
+    if not resto:
+        return joins, '', list(encadenadas), []
+    filtro = (
+        ' AND NOT EXISTS (SELECT 1 FROM json_each(?) r WHERE NOT EXISTS ('
+        f'SELECT 1 FROM archivo_etiqueta x WHERE x.archivo_id = {columna} AND x.etiqueta_id = r.value))'
+    )
+    return joins, filtro, list(encadenadas), [json.dumps(list(resto))]
+
+
+def _sql_conjunto(nodo, ids):
+    """Compila un nodo a un SELECT de una sola columna archivo_id, con sus parámetros"""
+    tipo = nodo[0]
+
+    if tipo == 'todos':
+        return 'SELECT id AS archivo_id FROM archivos', []
+
+    if tipo == 'etiqueta':
+        return 'SELECT archivo_id FROM archivo_etiqueta WHERE etiqueta_id = ?', [ids[nodo[1]][0]]
+
+    if tipo == 'not':
+        sql, parametros = _sql_conjunto(nodo[1], ids)
+        return f'SELECT id AS archivo_id FROM archivos EXCEPT SELECT archivo_id FROM ({sql})', parametros
+
+    hijos = nodo[1]
+
+    if tipo == 'or':
+        # Un OR de etiquetas sueltas es un único IN sobre el índice
+        hojas = [hijo for hijo in hijos if hijo[0] == 'etiqueta']
+        resto = [hijo for hijo in hijos if hijo[0] != 'etiqueta']
+        partes = []
+        parametros = []
+        if hojas:
+            placeholders = ','.join(['?'] * len(hojas))
+            partes.append(f'SELECT archivo_id FROM archivo_etiqueta WHERE etiqueta_id IN ({placeholders})')
+            parametros += [ids[hoja[1]][0] for hoja in hojas]
+        for hijo in resto:
+            sql, valores = _sql_conjunto(hijo, ids)
+            partes.append(f'SELECT archivo_id FROM ({sql})')
+            parametros += valores
+        return ' UNION '.join(partes), parametros
+
+    # AND: positivos de menor a mayor estimación, después se restan los negativos
+    positivos = sorted((h for h in hijos if h[0] != 'not'), key=lambda h: _estimacion(h, ids))
+    negativos = [h[1] for h in hijos if h[0] == 'not']
+    if not positivos:
+        positivos = [_TODOS]
+
+    hojas = [hijo for hijo in positivos if hijo[0] == 'etiqueta']
+    resto = [hijo for hijo in positivos if hijo[0] != 'etiqueta']
+    partes = []
+    parametros = []
+    if hojas:
+        # Intersección de etiquetas: recorrer la más rara y comprobar el resto por clave primaria
+        joins, filtro, valores_joins, valores_filtro = sql_interseccion(
+            't0.archivo_id', [ids[hoja[1]][0] for hoja in hojas[1:]]
+        )
+        partes.append(f'SELECT t0.archivo_id FROM archivo_etiqueta t0{joins} WHERE t0.etiqueta_id = ?{filtro}')
+        parametros += valores_joins + [ids[hojas[0][1]][0]] + valores_filtro
+    for hijo in resto:
+        sql, valores = _sql_conjunto(hijo, ids)
+        partes.append(f'SELECT archivo_id FROM ({sql})')
+        parametros += valores
+    sql = ' INTERSECT '.join(partes)
+
+    # Los operadores compuestos de SQLite se evalúan de izquierda a derecha:
+    # ((P1 INTERSECT P2) EXCEPT N1) EXCEPT N2
+    for negativo in negativos:
+        sql_negativo, valores = _sql_conjunto(negativo, ids)
+        sql += f' EXCEPT SELECT archivo_id FROM ({sql_negativo})'
+        parametros += valores
+    return sql, parametros
+
+
+def compilar_consulta(nodo, ids):
+    """Compila el árbol a un único SELECT de ids de archivo.
+
+    `ids` es {nombre: (id, total)} de las etiquetas existentes. Devuelve
+    (sql, parametros), o None si la consulta no puede tener resultados.
+    """
+    nodo = _simplificar(nodo, ids)
+    if nodo == _VACIO:
+        return None
+    return _sql_conjunto(nodo, ids)
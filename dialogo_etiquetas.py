@@ -1,10 +1,42 @@
 import gi
 gi.require_version('Gtk', '3.0')
 gi.require_version('Gdk', '3.0')
-from gi.repository import Gtk, Gdk, GObject, Pango
+from gi.repository import Gtk, Gdk, Gio, GObject, Pango
 import os
 import sqlite3
 
+from registro_etiquetas import obtener_registro
+from tareas_etiquetas import ejecutar_en_segundo_plano
+
+log = obtener_registro('dialogo')
+
+
+def mostrar_error(parent, texto):
+    """Muestra un mensaje de error (llamar desde el hilo de GTK)"""
+    dialog = Gtk.MessageDialog(
+        transient_for=parent,
+        modal=True,
+        message_type=Gtk.MessageType.ERROR,
+        buttons=Gtk.ButtonsType.OK,
+        text=texto
+    )
+    dialog.run()
+    dialog.destroy()
+
+
+class EtiquetaDisponible(GObject.Object):
+    """Elemento del modelo de etiquetas disponibles (un chip del FlowBox)"""
+    
+    def __init__(self, nombre):
+        super().__init__()
+        self.nombre = nombre
+
+
+def comparar_etiquetas(a, b, *datos):
+    """Orden alfabético del modelo, el mismo que ORDER BY nombre en la base"""
+    return (a.nombre > b.nombre) - (a.nombre < b.nombre)
+
+
 class DialogoEtiquetas(Gtk.Dialog):
     def __init__(self, parent, gestor_etiquetas, ruta_archivo):
         # Si parent es None, crear diálogo sin padre
@@ -21,8 +53,29 @@ class DialogoEtiquetas(Gtk.Dialog):
             )
         
         self.gestor = gestor_etiquetas
-        self.ruta_archivo = ruta_archivo
-        self.archivo_nombre = os.path.basename(ruta_archivo)
+        
+        # ruta_archivo puede ser una ruta o una lista de rutas (selección múltiple)
+        if isinstance(ruta_archivo, (list, tuple)):
+            self.rutas_archivos = list(ruta_archivo)
+        else:
+            self.rutas_archivos = [ruta_archivo]
+        self.ruta_archivo = self.rutas_archivos[0]
+        self.seleccion_multiple = len(self.rutas_archivos) > 1
+        
+        if self.seleccion_multiple:
+            self.archivo_nombre = f"{len(self.rutas_archivos)} archivos seleccionados"
+        else:
+            self.archivo_nombre = os.path.basename(self.ruta_archivo)
+        
+        self.etiquetas_actuales = []
+        self.etiquetas_originales = set()
+        self.todas_etiquetas = []
+        self.nombres_existentes = set()
+        # nombre -> fila de "Etiquetas actuales" / elemento del modelo de disponibles
+        self.filas_actuales = {}
+        self.chips_disponibles = {}
+        self.cerrado = False
+        self.connect("destroy", self.on_destruido)
         
         self.set_default_size(400, 500)
         self.set_border_width(10)
@@ -36,10 +89,19 @@ class DialogoEtiquetas(Gtk.Dialog):
         # Header con nombre del archivo
         header_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=5)
         label_archivo = Gtk.Label()
-        label_archivo.set_markup(f"<b>Archivo:</b> {self.archivo_nombre}")
+        titulo = "Archivos" if self.seleccion_multiple else "Archivo"
+        label_archivo.set_markup(f"<b>{titulo}:</b> {self.archivo_nombre}")
         label_archivo.set_halign(Gtk.Align.START)
         header_box.pack_start(label_archivo, False, False, 0)
         
+        # Estado de carga: el diálogo se abre al instante y la base se lee en segundo plano
+        self.box_cargando = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=5)
+        self.spinner = Gtk.Spinner()
+        self.box_cargando.pack_start(self.spinner, False, False, 0)
+        self.box_cargando.pack_start(Gtk.Label(label="Cargando etiquetas..."), False, False, 0)
+        self.box_cargando.set_no_show_all(True)
+        header_box.pack_start(self.box_cargando, False, False, 0)
+        
         # Separador
         separator = Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL)
         header_box.pack_start(separator, False, False, 10)
@@ -67,11 +129,11 @@ class DialogoEtiquetas(Gtk.Dialog):
         self.entry_etiqueta.set_hexpand(True)
         self.entry_etiqueta.connect("activate", self.on_anadir_etiqueta)
         
-        btn_anadir = Gtk.Button.new_with_label("Añadir")
-        btn_anadir.connect("clicked", self.on_anadir_etiqueta)
+        self.btn_anadir = Gtk.Button.new_with_label("Añadir")
+        self.btn_anadir.connect("clicked", self.on_anadir_etiqueta)
         
         box_entrada.pack_start(self.entry_etiqueta, True, True, 0)
-        box_entrada.pack_start(btn_anadir, False, False, 0)
+        box_entrada.pack_start(self.btn_anadir, False, False, 0)
         
         parent.pack_start(box_entrada, False, False, 0)
     
@@ -102,11 +164,14 @@ class DialogoEtiquetas(Gtk.Dialog):
         scrolled.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
         scrolled.set_min_content_height(120)
         
-        # FlowBox para etiquetas disponibles (como chips)
+        # FlowBox para etiquetas disponibles (como chips), ligado a un modelo:
+        # mover una etiqueta crea o destruye solo su chip
+        self.modelo_disponibles = Gio.ListStore(item_type=EtiquetaDisponible)
         self.flowbox_etiquetas = Gtk.FlowBox()
         self.flowbox_etiquetas.set_max_children_per_line(3)
         self.flowbox_etiquetas.set_selection_mode(Gtk.SelectionMode.NONE)
         self.flowbox_etiquetas.set_homogeneous(True)
+        self.flowbox_etiquetas.bind_model(self.modelo_disponibles, self.crear_chip_etiqueta)
         
         scrolled.add(self.flowbox_etiquetas)
         frame.add(scrolled)
@@ -120,38 +185,99 @@ class DialogoEtiquetas(Gtk.Dialog):
         box_botones.set_margin_top(10)
         box_botones.set_halign(Gtk.Align.END)
         
-        btn_guardar = Gtk.Button.new_with_label("Guardar")
-        btn_guardar.connect("clicked", self.on_guardar)
-        btn_guardar.get_style_context().add_class("suggested-action")
+        self.btn_guardar = Gtk.Button.new_with_label("Guardar")
+        self.btn_guardar.connect("clicked", self.on_guardar)
+        self.btn_guardar.get_style_context().add_class("suggested-action")
         
         btn_cancelar = Gtk.Button.new_with_label("Cancelar")
         btn_cancelar.connect("clicked", self.on_cancelar)
         
         box_botones.pack_start(btn_cancelar, False, False, 0)
-        box_botones.pack_start(btn_guardar, False, False, 0)
+        box_botones.pack_start(self.btn_guardar, False, False, 0)
         
         parent.pack_start(box_botones, False, False, 0)
     
+    def mostrar_cargando(self, cargando):
+        """Activa o desactiva el estado de carga del diálogo"""
+        self.box_cargando.set_visible(cargando)
+        if cargando:
+            self.spinner.start()
+        else:
+            self.spinner.stop()
+        # Cancelar sigue disponible mientras se carga
+        for widget in (self.entry_etiqueta, self.btn_anadir, self.btn_guardar,
+                       self.listbox_etiquetas, self.flowbox_etiquetas):
+            widget.set_sensitive(not cargando)
+    
     def cargar_etiquetas_actuales(self):
-        """Carga las etiquetas actuales del archivo"""
-        print(f"🔍 Cargando etiquetas actuales para {self.archivo_nombre}")
+        """Carga las etiquetas actuales del archivo en segundo plano"""
+        log.debug("Cargando etiquetas actuales para %s", self.archivo_nombre)
         
         # Limpiar listas
         for widget in self.listbox_etiquetas.get_children():
             self.listbox_etiquetas.remove(widget)
+        self.filas_actuales = {}
+        
+        self.modelo_disponibles.remove_all()
+        self.chips_disponibles = {}
         
-        for widget in self.flowbox_etiquetas.get_children():
-            self.flowbox_etiquetas.remove(widget)
+        self.mostrar_cargando(True)
         
-        # Cargar etiquetas actuales del archivo
-        self.etiquetas_actuales = self.gestor.obtener_etiquetas_archivo(self.ruta_archivo)
-        print(f"📁 Etiquetas cargadas: {[e['nombre'] for e in self.etiquetas_actuales]}")
+        gestor = self.gestor
+        rutas = list(self.rutas_archivos)
+        seleccion_multiple = self.seleccion_multiple
         
-        for etiqueta in self.etiquetas_actuales:
-            self.agregar_fila_etiqueta_actual(etiqueta)
+        def trabajo():
+            # Cargar etiquetas actuales del archivo (en selección múltiple, las comunes a todos)
+            if seleccion_multiple:
+                actuales = gestor.obtener_etiquetas_comunes(rutas)
+            else:
+                actuales = gestor.obtener_etiquetas_archivo(rutas[0])
+                # Sin etiquetas: puede ser un archivo movido o renombrado fuera de Nemo
+                if not actuales and gestor.reconciliar_movidos(rutas):
+                    actuales = gestor.obtener_etiquetas_archivo(rutas[0])
+            return actuales, gestor.obtener_todas_etiquetas()
+        
+        ejecutar_en_segundo_plano(trabajo, self.on_etiquetas_cargadas, self.on_error_carga)
+    
+    def on_etiquetas_cargadas(self, resultado):
+        """Recibe en el hilo de GTK las etiquetas leídas en segundo plano"""
+        if self.cerrado:
+            return
+        actuales, self.todas_etiquetas = resultado
+        self.nombres_existentes = {e['nombre'] for e in self.todas_etiquetas}
+        self.etiquetas_originales = {e['nombre'] for e in actuales}
+        log.debug("Etiquetas cargadas: %s", [e['nombre'] for e in actuales])
+        
+        self.etiquetas_actuales = []
+        for etiqueta in actuales:
+            self.agregar_etiqueta_actual(etiqueta)
         
         # Cargar todas las etiquetas disponibles del sistema
         self.cargar_etiquetas_disponibles()
+        
+        self.mostrar_cargando(False)
+        self.listbox_etiquetas.show_all()
+        self.flowbox_etiquetas.show_all()
+        self.entry_etiqueta.grab_focus()
+    
+    def on_error_carga(self, error):
+        """La lectura falló: se informa y se cierra el diálogo"""
+        if self.cerrado:
+            return
+        mostrar_error(self, f"No se pudieron cargar las etiquetas:\n\n{error}")
+        self.response(Gtk.ResponseType.CANCEL)
+        self.destroy()
+    
+    def on_destruido(self, widget):
+        """Evita que respuestas tardías del hilo de trabajo toquen widgets destruidos"""
+        self.cerrado = True
+    
+    def agregar_etiqueta_actual(self, etiqueta):
+        """Pasa una etiqueta a "Etiquetas actuales" (y quita su chip de disponibles)"""
+        self.etiquetas_actuales.append(etiqueta)
+        self.agregar_fila_etiqueta_actual(etiqueta)
+        self.quitar_de_disponibles(etiqueta['nombre'])
     
     def agregar_fila_etiqueta_actual(self, etiqueta):
         """Añade una etiqueta a la lista de etiquetas actuales"""
@@ -177,24 +303,46 @@ class DialogoEtiquetas(Gtk.Dialog):
         box.pack_start(btn_eliminar, False, False, 0)
         
         row.add(box)
+        row.show_all()
         self.listbox_etiquetas.add(row)
+        self.filas_actuales[etiqueta['nombre']] = row
     
     def cargar_etiquetas_disponibles(self):
         """Carga todas las etiquetas del sistema"""
-        todas_etiquetas = self.gestor.obtener_todas_etiquetas()
-        
-        # Filtrar etiquetas que ya están asignadas
-        etiquetas_actuales_nombres = [e['nombre'] for e in self.etiquetas_actuales]
-        etiquetas_disponibles = [e for e in todas_etiquetas if e['nombre'] not in etiquetas_actuales_nombres]
-        
-        for etiqueta in etiquetas_disponibles:
-            self.agregar_chip_etiqueta(etiqueta)
+        # Filtrar etiquetas que ya están asignadas (todas_etiquetas se leyó al abrir)
+        etiquetas_actuales_nombres = {e['nombre'] for e in self.etiquetas_actuales}
+        elementos = [
+            EtiquetaDisponible(e['nombre']) for e in self.todas_etiquetas
+            if e['nombre'] not in etiquetas_actuales_nombres
+        ]
+        self.chips_disponibles = {elemento.nombre: elemento for elemento in elementos}
+        # Un único cambio en el modelo para toda la lista
+        self.modelo_disponibles.splice(0, self.modelo_disponibles.get_n_items(), elementos)
+    
+    def quitar_de_disponibles(self, nombre_etiqueta):
+        """Quita el chip de una etiqueta; el resto de chips no se toca"""
+        elemento = self.chips_disponibles.pop(nombre_etiqueta, None)
+        if elemento is None:
+            return
+        encontrado, posicion = self.modelo_disponibles.find(elemento)
+        if encontrado:
+            self.modelo_disponibles.remove(posicion)
+    
+    def devolver_a_disponibles(self, nombre_etiqueta):
+        """Vuelve a mostrar el chip de una etiqueta existente en su sitio alfabético"""
+        if nombre_etiqueta in self.chips_disponibles:
+            return
+        if nombre_etiqueta not in self.nombres_existentes:
+            return  # Etiqueta nueva, todavía no guardada: no es una etiqueta disponible
+        elemento = EtiquetaDisponible(nombre_etiqueta)
+        self.chips_disponibles[nombre_etiqueta] = elemento
+        self.modelo_disponibles.insert_sorted(elemento, comparar_etiquetas)
     
-    def agregar_chip_etiqueta(self, etiqueta):
-        """Añade una etiqueta como chip en la sección de disponibles"""
+    def crear_chip_etiqueta(self, elemento):
+        """Crea el chip de una etiqueta disponible (lo llama el FlowBox desde su modelo)"""
         # Crear botón con estilo de chip
         btn = Gtk.Button()
-        btn.set_label(etiqueta['nombre'])
+        btn.set_label(elemento.nombre)
         btn.set_relief(Gtk.ReliefStyle.NONE)
         
         # Aplicar estilo de chip
@@ -202,62 +350,75 @@ class DialogoEtiquetas(Gtk.Dialog):
         ctx.add_class("chip")
         ctx.add_class("suggested-action")
         
-        btn.connect("clicked", self.on_chip_seleccionado, etiqueta['nombre'])
+        btn.connect("clicked", self.on_chip_seleccionado, elemento.nombre)
         btn.set_tooltip_text("Clic para añadir esta etiqueta")
-        
-        self.flowbox_etiquetas.add(btn)
+        btn.show()
+        return btn
     
     def on_anadir_etiqueta(self, widget):
         """Añade una nueva etiqueta desde el entry"""
         texto = self.entry_etiqueta.get_text().strip()
         if texto:
             # Verificar si ya existe
-            etiquetas_existentes = [e['nombre'] for e in self.etiquetas_actuales]
-            if texto not in etiquetas_existentes:
-                nueva_etiqueta = {'nombre': texto, 'color': '#3498db'}
-                self.etiquetas_actuales.append(nueva_etiqueta)
-                self.agregar_fila_etiqueta_actual(nueva_etiqueta)
+            if texto not in self.filas_actuales:
+                self.agregar_etiqueta_actual({'nombre': texto, 'color': '#3498db'})
                 
-                # Limpiar y actualizar
+                # Limpiar
                 self.entry_etiqueta.set_text("")
-                self.actualizar_vista()
             
             self.entry_etiqueta.grab_focus()
     
     def on_eliminar_etiqueta(self, widget, nombre_etiqueta):
         """Elimina una etiqueta de la lista actual"""
         self.etiquetas_actuales = [e for e in self.etiquetas_actuales if e['nombre'] != nombre_etiqueta]
-        self.actualizar_vista()
+        fila = self.filas_actuales.pop(nombre_etiqueta, None)
+        if fila is not None:
+            self.listbox_etiquetas.remove(fila)
+        self.devolver_a_disponibles(nombre_etiqueta)
     
     def on_chip_seleccionado(self, widget, nombre_etiqueta):
         """Añade una etiqueta desde los chips disponibles"""
-        etiqueta = {'nombre': nombre_etiqueta, 'color': '#3498db'}
-        self.etiquetas_actuales.append(etiqueta)
-        self.agregar_fila_etiqueta_actual(etiqueta)
-        self.actualizar_vista()
-    
-    def actualizar_vista(self):
-        """Actualiza toda la vista"""
-        self.listbox_etiquetas.show_all()
-        self.cargar_etiquetas_disponibles()
-        self.flowbox_etiquetas.show_all()
+        if nombre_etiqueta not in self.filas_actuales:
+            self.agregar_etiqueta_actual({'nombre': nombre_etiqueta, 'color': '#3498db'})
     
     def on_guardar(self, widget):
-        """Guarda los cambios en la base de datos"""
+        """Guarda los cambios en la base de datos en segundo plano"""
         try:
             etiquetas_nombres = [e['nombre'] for e in self.etiquetas_actuales]
-            print(f"💾 Guardando etiquetas: {etiquetas_nombres} para {self.archivo_nombre}")
+            log.debug("Guardando etiquetas: %s para %s", etiquetas_nombres, self.archivo_nombre)
+            
+            gestor = self.gestor
+            rutas = list(self.rutas_archivos)
+            originales = set(self.etiquetas_originales)
+            seleccion_multiple = self.seleccion_multiple
+            archivo_nombre = self.archivo_nombre
+            parent = self.get_transient_for()
+            
+            def trabajo():
+                # Guardar en la base de datos
+                if seleccion_multiple:
+                    # Solo se aplican los cambios sobre las etiquetas comunes, en una transacción
+                    return gestor.modificar_etiquetas_lote(
+                        rutas,
+                        agregar=[e for e in etiquetas_nombres if e not in originales],
+                        quitar=[e for e in originales if e not in etiquetas_nombres]
+                    )
+                return gestor.agregar_etiquetas(rutas[0], etiquetas_nombres)
+            
+            def al_terminar(resultado):
+                log.debug("Etiquetas guardadas correctamente")
+            
+            def al_fallar(error):
+                log.error("Error guardando etiquetas de %s: %s", archivo_nombre, error)
+                mostrar_error(parent, f"No se pudieron guardar las etiquetas de {archivo_nombre}:\n\n{error}")
             
-            # Guardar en la base de datos
-            self.gestor.agregar_etiquetas(self.ruta_archivo, etiquetas_nombres)
-            print("✅ Etiquetas guardadas correctamente")
+            ejecutar_en_segundo_plano(trabajo, al_terminar, al_fallar)
             
+            # Cierre optimista: los errores llegan después con al_fallar
             self.response(Gtk.ResponseType.OK)
             self.destroy()
         except Exception as e:
-            print(f"❌ Error guardando etiquetas: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("Error guardando etiquetas: %s", e)
     
     def on_cancelar(self, widget):
         """Cierra el diálogo sin guardar"""
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""Etiquetas desde la línea de órdenes, sin Nemo ni GTK.
+
+Órdenes (con alias en inglés para scripts):
+  etiquetar (tag)    -e ETIQUETA... [RUTA...]   añade etiquetas a los archivos
+  quitar (untag)     -e ETIQUETA... [RUTA...]   quita etiquetas de los archivos
+  listar (list)      [RUTA...]                  etiquetas de cada archivo, o todas con su total
+  buscar (query)     CONSULTA [--contar]        archivos que cumplen una consulta booleana
+  lote (batch)                                  operaciones leídas de stdin
+
+Si etiquetar o quitar no reciben rutas, las leen de stdin. La salida es un
+registro por línea con los campos separados por tabuladores; con -0 los
+registros terminan en NUL (también los de stdin, como en xargs -0) y con
+--json cada registro es un objeto JSON por línea. Los mensajes van a
+stderr: -q deja solo los errores y -v añade los de depuración.
+
+En modo lote cada registro de stdin es una operación, en texto
+  etiquetar<TAB>RUTA<TAB>ETIQUETA[<TAB>ETIQUETA...]
+  quitar<TAB>RUTA<TAB>ETIQUETA[<TAB>ETIQUETA...]
+  listar[<TAB>RUTA]
+  buscar<TAB>CONSULTA
+o como objeto JSON: {"op": "etiquetar", "rutas": [...], "etiquetas": [...]}.
+Todo el lote usa una conexión y una transacción: si una operación falla
+no se guarda ninguna.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from itertools import islice
+
+from consulta_etiquetas import ErrorConsulta
+from gestor_etiquetas import GestorEtiquetasSQLite
+from registro_etiquetas import VARIABLE_NIVEL, configurar_registro, obtener_registro
+
+log = obtener_registro('cli')
+
+# Archivos por llamada a modificar_etiquetas_lote al agrupar operaciones iguales
+TAMANO_GRUPO = 1000
+
+# Alias en inglés -> orden
+ALIAS = {'tag': 'etiquetar', 'untag': 'quitar', 'list': 'listar', 'query': 'buscar', 'batch': 'lote'}
+
+ORDENES_ESCRITURA = ('etiquetar', 'quitar')
+
+
+class ErrorOrden(ValueError):
+    """Operación de un lote mal formada"""
+
+
+class Salida:
+    """Escribe registros como texto separado por tabuladores, terminados en NUL o como JSON"""
+
+    def __init__(self, flujo, nulo=False, como_json=False):
+        self.flujo = flujo
+        self.terminador = '\0' if nulo else '\n'
+        self.como_json = como_json
+
+    def registro(self, campos, objeto):
+        """Escribe un registro: `campos` en modo texto, `objeto` en modo JSON"""
+        if self.como_json:
+            self.flujo.write(json.dumps(objeto, ensure_ascii=False) + '\n')
+        else:
+            self.flujo.write('\t'.join(str(campo) for campo in campos) + self.terminador)
+
+
+def leer_registros(flujo, nulo=False, tamano_bloque=1 << 16):
+    """Genera los registros de un flujo, terminados en salto de línea o en NUL"""
+    if not nulo:
+        for linea in flujo:
+            linea = linea.rstrip('\n')
+            if linea:
+                yield linea
+        return
+    resto = ''
+    for bloque in iter(lambda: flujo.read(tamano_bloque), ''):
+        *completos, resto = (resto + bloque).split('\0')
+        yield from (registro for registro in completos if registro)
+    if resto:
+        yield resto
+
+
+def ruta_absoluta(ruta):
+    """La base guarda rutas absolutas"""
+    return os.path.abspath(ruta)
+
+
+def modificar(gestor, orden, rutas, etiquetas, salida):
+    """Añade o quita etiquetas de las rutas, por grupos; devuelve el total de archivos"""
+    archivos = agregadas = eliminadas = 0
+    rutas = iter(rutas)
+    while True:
+        grupo = [ruta_absoluta(ruta) for ruta in islice(rutas, TAMANO_GRUPO)]
+        if not grupo:
+            break
+        if orden == 'etiquetar':
+            resultado = gestor.modificar_etiquetas_lote(grupo, agregar=etiquetas)
+        else:
+            resultado = gestor.modificar_etiquetas_lote(grupo, quitar=etiquetas)
+        archivos += len(grupo)
+        agregadas += resultado['agregadas']
+        eliminadas += resultado['eliminadas']
+    if salida.como_json:
+        salida.registro((), {'op': orden, 'archivos': archivos, 'agregadas': agregadas, 'eliminadas': eliminadas})
+    return archivos
+
+
+def listar(gestor, rutas, salida):
+    """Escribe las etiquetas de cada ruta, o todas las etiquetas con su total"""
+    if not rutas:
+        for etiqueta in gestor.obtener_todas_etiquetas():
+            salida.registro(
+                (etiqueta['nombre'], etiqueta['total']),
+                {'etiqueta': etiqueta['nombre'], 'total': etiqueta['total']}
+            )
+        return
+    for ruta in map(ruta_absoluta, rutas):
+        nombres = [etiqueta['nombre'] for etiqueta in gestor.obtener_etiquetas_archivo(ruta)]
+        if salida.como_json:
+            salida.registro((), {'ruta': ruta, 'etiquetas': nombres})
+        else:
+            for nombre in nombres:
+                salida.registro((ruta, nombre), None)
+
+
+def buscar(gestor, consulta, salida, contar=False):
+    """Escribe los archivos que cumplen la consulta, o solo cuántos son"""
+    if contar:
+        total = gestor.contar_por_consulta(consulta)
+        salida.registro((total,), {'consulta': consulta, 'total': total})
+        return
+    for pagina in gestor.iterar_por_consulta(consulta):
+        for ruta in pagina:
+            salida.registro((ruta,), {'ruta': ruta})
+
+
+def _lista_textos(objeto, plural, singular):
+    """Valores de `plural` (texto o lista de textos) o de `singular` (texto) en un registro JSON"""
+    if objeto.get(plural):
+        valores = objeto[plural]
+        if isinstance(valores, str):
+            return [valores]
+        if isinstance(valores, list) and all(isinstance(valor, str) for valor in valores):
+            return valores
+        raise ErrorOrden(f"{plural} debe ser texto o una lista de textos")
+    if singular in objeto:
+        if not isinstance(objeto[singular], str):
+            raise ErrorOrden(f"{singular} debe ser texto")
+        return [objeto[singular]]
+    return []
+
+
+def analizar_operacion(registro):
+    """Convierte un registro del lote en (orden, rutas, etiquetas, consulta)"""
+    if registro.startswith('{'):
+        try:
+            objeto = json.loads(registro)
+            orden = ALIAS.get(objeto['op'], objeto['op'])
+        except (ValueError, KeyError, TypeError) as e:
+            raise ErrorOrden(f"JSON no válido: {e}") from None
+        rutas = _lista_textos(objeto, 'rutas', 'ruta')
+        etiquetas = _lista_textos(objeto, 'etiquetas', 'etiqueta')
+        consulta = objeto.get('consulta', '')
+        if not isinstance(consulta, str):
+            raise ErrorOrden("consulta debe ser texto")
+    else:
+        orden, *campos = registro.split('\t')
+        orden = ALIAS.get(orden, orden)
+        rutas = campos[:1]
+        etiquetas = campos[1:]
+        consulta = campos[0] if orden == 'buscar' and campos else ''
+
+    if orden in ORDENES_ESCRITURA:
+        if not rutas or not etiquetas:
+            raise ErrorOrden(f"{orden} necesita una ruta y al menos una etiqueta")
+    elif orden == 'buscar':
+        if not consulta:
+            raise ErrorOrden("buscar necesita una consulta")
+    elif orden != 'listar':
+        raise ErrorOrden(f"orden desconocida: {orden!r}")
+    return orden, rutas, etiquetas, consulta
+
+
+def ejecutar_lote(gestor, registros, salida):
+    """Aplica las operaciones de un lote en una sola transacción; devuelve cuántas"""
+    # Operaciones de escritura seguidas e iguales se agrupan en una llamada
+    pendiente = None  # (orden, etiquetas)
+    rutas_pendientes = []
+    desde = 0  # Primer registro del grupo pendiente, para los mensajes de error
+
+    def aplicar_pendiente(hasta):
+        if pendiente is None or not rutas_pendientes:
+            return
+        try:
+            modificar(gestor, pendiente[0], rutas_pendientes, list(pendiente[1]), salida)
+        except OSError as e:
+            registros = f"{desde}" if desde == hasta else f"{desde}-{hasta}"
+            raise ErrorOrden(f"registro {registros}: {e}") from None
+        rutas_pendientes.clear()
+
+    operaciones = 0
+    with gestor.transaccion():
+        for numero, registro in enumerate(registros, 1):
+            try:
+                orden, rutas, etiquetas, consulta = analizar_operacion(registro)
+            except ErrorOrden as e:
+                raise ErrorOrden(f"registro {numero}: {e}") from None
+            
+            if orden in ORDENES_ESCRITURA:
+                clave = (orden, tuple(etiquetas))
+                if pendiente != clave or len(rutas_pendientes) >= TAMANO_GRUPO:
+                    aplicar_pendiente(numero - 1)
+                    pendiente, desde = clave, numero
+                rutas_pendientes.extend(rutas)
+            else:
+                # Las lecturas ven las escrituras anteriores del lote
+                aplicar_pendiente(numero - 1)
+                pendiente = None
+                try:
+                    if orden == 'listar':
+                        listar(gestor, rutas, salida)
+                    else:
+                        buscar(gestor, consulta, salida)
+                except ErrorConsulta as e:
+                    raise ErrorOrden(f"registro {numero}: {e}") from None
+            operaciones += 1
+        aplicar_pendiente(operaciones)
+    return operaciones
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0], epilog=__doc__.split('\n\n', 1)[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--db', help="base de datos (por defecto la de la extensión)")
+    parser.add_argument('-0', '--nulo', action='store_true', help="registros terminados en NUL")
+    parser.add_argument('--json', action='store_true', help="un objeto JSON por línea")
+    parser.add_argument('-q', '--silencioso', action='store_true', help="solo mensajes de error")
+    parser.add_argument('-v', '--detallado', action='store_true', help="también mensajes de depuración")
+    ordenes = parser.add_subparsers(dest='orden', required=True)
+
+    for orden, alias, ayuda in (('etiquetar', 'tag', "añade etiquetas"), ('quitar', 'untag', "quita etiquetas")):
+        sub = ordenes.add_parser(orden, aliases=[alias], help=ayuda)
+        sub.add_argument('-e', '--etiqueta', dest='etiquetas', action='append', required=True)
+        sub.add_argument('rutas', nargs='*')
+
+    sub = ordenes.add_parser('listar', aliases=['list'], help="etiquetas de archivos o todas")
+    sub.add_argument('rutas', nargs='*')
+
+    sub = ordenes.add_parser('buscar', aliases=['query'], help="archivos que cumplen una consulta")
+    sub.add_argument('consulta', nargs='+')
+    sub.add_argument('--contar', action='store_true')
+
+    ordenes.add_parser('lote', aliases=['batch'], help="operaciones leídas de stdin")
+    return parser
+
+
+def main(argv=None):
+    args = crear_parser().parse_args(argv)
+    orden = ALIAS.get(args.orden, args.orden)
+
+    # Las rutas no UTF-8 se conservan tal cual en la entrada y en la salida
+    sys.stdin.reconfigure(errors='surrogateescape')
+    sys.stdout.reconfigure(errors='surrogateescape')
+    salida = Salida(sys.stdout, nulo=args.nulo, como_json=args.json)
+    if args.silencioso:
+        nivel = 'ERROR'
+    elif args.detallado:
+        nivel = 'DEBUG'
+    else:
+        nivel = os.environ.get(VARIABLE_NIVEL) or 'INFO'
+    configurar_registro(nivel, formato='%(message)s')
+
+    inicio = time.perf_counter()
+    try:
+        with GestorEtiquetasSQLite(args.db) as gestor:
+            if orden in ORDENES_ESCRITURA:
+                rutas = args.rutas or leer_registros(sys.stdin, args.nulo)
+                with gestor.transaccion():
+                    archivos = modificar(gestor, orden, rutas, args.etiquetas, salida)
+                log.info("✅ %d archivos en %.2f s", archivos, time.perf_counter() - inicio)
+            elif orden == 'listar':
+                listar(gestor, args.rutas, salida)
+            elif orden == 'buscar':
+                buscar(gestor, ' '.join(args.consulta), salida, contar=args.contar)
+            else:
+                operaciones = ejecutar_lote(gestor, leer_registros(sys.stdin, args.nulo), salida)
+                log.info("✅ %d operaciones en %.2f s", operaciones, time.perf_counter() - inicio)
+    except (ErrorOrden, ErrorConsulta, OSError) as e:
+        deshecho = "; no se ha guardado nada" if orden != 'listar' and orden != 'buscar' else ""
+        log.error("❌ %s%s", e, deshecho)
+        return 1
+    finally:
+        sys.stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,31 +1,298 @@
 import sqlite3
 import os
+import json
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
 from pathlib import Path
 
+from consulta_etiquetas import analizar_consulta, compilar_consulta, etiquetas_de, sql_interseccion
+from indice_etiquetas import IndiceInvertido, contar_bits, iterar_ids
+from registro_etiquetas import instrumentado, obtener_registro
+
+log = obtener_registro('gestor')
+
+
+# Versión del esquema guardada en PRAGMA user_version. Subirla al cambiar
+# inicializar_db: las bases con otra versión vuelven a pasar por la creación
+# y las migraciones (todas idempotentes); las demás se abren sin tocarlas
+VERSION_ESQUEMA = 5
+
+# Segundos que se guardan las etiquetas de un archivo desaparecido por si
+# reaparece movido a otra carpeta (ver limpiar_archivos_inexistentes)
+GRACIA_PERDIDOS_S = 30 * 24 * 60 * 60
+
+# Etiquetas a partir de las que un OR paginado deja de usar una rama UNION
+# por etiqueta (SQLite admite 500 términos por SELECT compuesto)
+MAX_RAMAS_UNION = 64
+
+
+def _lotes(iterable, tamano):
+    """Agrupa un iterable en listas de como mucho `tamano` elementos"""
+    iterador = iter(iterable)
+    while True:
+        lote = list(islice(iterador, tamano))
+        if not lote:
+            return
+        yield lote
+
+
+def _stat(ruta):
+    """os.stat() que devuelve None si el archivo no existe o no es accesible"""
+    try:
+        return os.stat(ruta)
+    except (OSError, ValueError):
+        return None
+
+
+def _trigramas(texto):
+    """Devuelve los trigramas (subcadenas de 3 caracteres) de un texto"""
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+
+def _frase_fts(texto):
+    """Escapa un texto como frase literal de FTS5"""
+    return '"' + texto.replace('"', '""') + '"'
+
+
+def _distancia_subcadena(patron, texto, maximo=None):
+    """Distancia de edición mínima entre `patron` y cualquier subcadena de `texto`.
+    
+    Cuenta inserciones, borrados, sustituciones y trasposiciones de dos
+    caracteres contiguos ('factrua' está a distancia 1 de 'factura'). Con
+    `maximo`, abandona en cuanto la distancia lo supera y devuelve maximo + 1.
+    """
+    # Levenshtein con inicio libre en `texto`: la primera fila es todo ceros
+    antepenultima = None
+    anterior = [0] * (len(texto) + 1)
+    for i, caracter in enumerate(patron, 1):
+        actual = [i]
+        for j, otro in enumerate(texto, 1):
+            distancia = min(
+                anterior[j] + 1,
+                actual[j - 1] + 1,
+                anterior[j - 1] + (caracter != otro)
+            )
+            if (antepenultima is not None and j > 1 and caracter == texto[j - 2]
+                    and patron[i - 2] == otro):
+                distancia = min(distancia, antepenultima[j - 2] + 1)
+            actual.append(distancia)
+        antepenultima, anterior = anterior, actual
+        # El mínimo de cada fila nunca decrece: la distancia ya no bajará de él
+        if maximo is not None and min(actual) > maximo:
+            return maximo + 1
+    return min(anterior)
+
+
+def _agrupar_etiquetas(texto, filas):
+    """Claves de orden (grupo, -total, nombre, color, total) de las filas que contienen el texto.
+    
+    Grupo 0 es la coincidencia exacta, 1 el prefijo y 2 la subcadena; la
+    comprobación final en Python es la misma para todos los caminos.
+    """
+    resultados = []
+    for nombre, color, total in filas:
+        minusculas = nombre.lower()
+        if texto not in minusculas:
+            continue
+        grupo = 0 if minusculas == texto else 1 if minusculas.startswith(texto) else 2
+        resultados.append((grupo, -total, nombre, color, total))
+    return resultados
+
+
 class GestorEtiquetasSQLite:
-    def __init__(self):
-        self.db_path = Path.home() / '.local' / 'share' / 'nemo-etiquetas' / 'etiquetas.db'
+    def __init__(self, db_path=None, usar_indice=False):
+        if db_path is None:
+            db_path = Path.home() / '.local' / 'share' / 'nemo-etiquetas' / 'etiquetas.db'
+        self.db_path = Path(db_path)
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        # Una conexión persistente por hilo (Nemo, diálogos, trabajos en segundo plano)
+        self._local = threading.local()
+        self._conexiones = []
+        self._lock_conexiones = threading.Lock()
+        
+        # Índice invertido en memoria opcional; se construye en la primera búsqueda
+        self._indice = IndiceInvertido(self) if usar_indice else None
+        
+        # Índice de trigramas de nombres (FTS5); inicializar_db lo desactiva si
+        # el SQLite del sistema no tiene FTS5 o el tokenizador trigram (>= 3.34)
+        self._indice_nombres = True
+        
+        # Funciones avisadas con las rutas modificadas tras cada escritura confirmada
+        self._oyentes = []
+        
         self.inicializar_db()
     
+    def _conectar(self):
+        """Abre una conexión nueva en modo WAL"""
+        # isolation_level=None: las transacciones se controlan con _transaccion()
+        # cached_statements: sqlite3 reutiliza las sentencias preparadas por texto SQL
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=10,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=256
+        )
+        # WAL: los lectores nunca se bloquean por un escritor
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+    
+    def _conexion(self):
+        """Devuelve la conexión persistente del hilo actual"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._conectar()
+            self._local.conn = conn
+            with self._lock_conexiones:
+                self._conexiones.append(conn)
+        return conn
+    
+    @contextmanager
+    def _transaccion(self):
+        """Transacción de escritura; las anidadas se integran en la exterior"""
+        conn = self._conexion()
+        profundidad = getattr(self._local, 'profundidad', 0)
+        if profundidad == 0:
+            conn.execute('BEGIN IMMEDIATE')
+            self._local.cambios = []
+        self._local.profundidad = profundidad + 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.profundidad = profundidad
+            if profundidad == 0:
+                conn.execute('ROLLBACK')
+                self._local.cambios = []
+            raise
+        self._local.profundidad = profundidad
+        if profundidad == 0:
+            conn.execute('COMMIT')
+            # Los avisos esperan al COMMIT: nadie debe releer un cambio que aún puede deshacerse
+            cambios, self._local.cambios = self._local.cambios, []
+            for rutas in cambios:
+                self._avisar_oyentes(rutas)
+    
+    def transaccion(self):
+        """Agrupa varias operaciones del gestor en una sola transacción.
+        
+        Uso: `with gestor.transaccion(): ...`. Las escrituras de dentro se
+        integran en ella y se confirman (y se avisa a los oyentes) una sola
+        vez al salir; si hay una excepción no se guarda ninguna.
+        """
+        return self._transaccion()
+    
+    def agregar_oyente(self, oyente):
+        """Registra oyente(rutas), llamado tras cada escritura confirmada.
+        
+        `rutas` es la lista de archivos cuyas etiquetas o rutas cambiaron, o
+        None si pudo cambiar cualquiera (p. ej. tras importar_pares). El
+        oyente se ejecuta en el hilo que escribió y debe ser rápido.
+        """
+        self._oyentes.append(oyente)
+    
+    def quitar_oyente(self, oyente):
+        """Deja de avisar a un oyente registrado con agregar_oyente"""
+        if oyente in self._oyentes:
+            self._oyentes.remove(oyente)
+    
+    def _notificar_cambios(self, rutas):
+        """Anota las rutas modificadas (None: toda la base); se avisa al confirmar la transacción"""
+        rutas = None if rutas is None else list(rutas)
+        if self._en_transaccion():
+            self._local.cambios.append(rutas)
+        else:
+            self._avisar_oyentes(rutas)
+    
+    def _avisar_oyentes(self, rutas):
+        """Llama a los oyentes registrados con las rutas modificadas"""
+        for oyente in list(self._oyentes):
+            try:
+                oyente(rutas)
+            except Exception as e:
+                log.exception("Error avisando de cambios: %s", e)
+    
+    def close(self):
+        """Cierra todas las conexiones abiertas por el gestor"""
+        if self._indice is not None:
+            self._indice.close()
+        with self._lock_conexiones:
+            conexiones, self._conexiones = self._conexiones, []
+            # Los hilos que vuelvan a usar el gestor abrirán una conexión nueva
+            self._local = threading.local()
+        for conn in conexiones:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
     def inicializar_db(self):
-        with sqlite3.connect(self.db_path) as conn:
+        conn = self._conexion()
+        if conn.execute('PRAGMA user_version').fetchone()[0] == VERSION_ESQUEMA:
+            # Esquema al día: solo comprobar si esta base tiene índice de nombres
+            self._indice_nombres = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'etiquetas_fts'"
+            ).fetchone() is not None
+            return
+        
+        with self._transaccion() as conn:
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS archivos (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     ruta TEXT UNIQUE NOT NULL,
-                    ultima_modificacion REAL NOT NULL
+                    ultima_modificacion REAL NOT NULL,
+                    dispositivo INTEGER,
+                    inodo INTEGER,
+                    tamano INTEGER
                 )
             ''')
             
+            # Migración: identidad del archivo (dispositivo + inodo) para seguir
+            # renombrados y movimientos; se rellena al etiquetar o limpiar
+            columnas = self._columnas(conn, 'archivos')
+            for columna in ('dispositivo', 'inodo', 'tamano'):
+                if columna not in columnas:
+                    conn.execute(f'ALTER TABLE archivos ADD COLUMN {columna} INTEGER')
+            
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS etiquetas (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     nombre TEXT UNIQUE NOT NULL,
-                    color TEXT DEFAULT '#3498db'
+                    color TEXT DEFAULT '#3498db',
+                    version INTEGER NOT NULL DEFAULT 0,
+                    total INTEGER NOT NULL DEFAULT 0
                 )
             ''')
             
+            # Migración: bases creadas antes de existir etiquetas.version
+            columnas = self._columnas(conn, 'etiquetas')
+            if 'version' not in columnas:
+                conn.execute('ALTER TABLE etiquetas ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+            
+            # Migración: contador de archivos por etiqueta, rellenado una sola vez
+            if 'total' not in columnas:
+                conn.execute('ALTER TABLE etiquetas ADD COLUMN total INTEGER NOT NULL DEFAULT 0')
+                conn.execute('''
+                    UPDATE etiquetas SET total = (
+                        SELECT COUNT(*) FROM archivo_etiqueta ae WHERE ae.etiqueta_id = etiquetas.id
+                    )
+                ''')
+                # Los triggers anteriores no mantenían el contador
+                conn.execute('DROP TRIGGER IF EXISTS trg_archivo_etiqueta_insert')
+                conn.execute('DROP TRIGGER IF EXISTS trg_archivo_etiqueta_delete')
+            
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS archivo_etiqueta (
                     archivo_id INTEGER,
@@ -36,13 +303,176 @@ class GestorEtiquetasSQLite:
                 )
             ''')
             
+            # Archivos etiquetados que la limpieza no encontró y que tienen
+            # identidad: se guardan un tiempo (GRACIA_PERDIDOS_S) con sus
+            # etiquetas por si reaparecen en otra carpeta
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS perdidos (
+                    dispositivo INTEGER NOT NULL,
+                    inodo INTEGER NOT NULL,
+                    ruta TEXT NOT NULL,
+                    ultima_modificacion REAL NOT NULL,
+                    tamano INTEGER,
+                    etiquetas TEXT NOT NULL,
+                    perdido REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_perdidos_identidad ON perdidos(dispositivo, inodo)')
+            
+            # Estado persistente de tareas largas (p. ej. punto de control de la limpieza)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS estado (
+                    clave TEXT PRIMARY KEY,
+                    valor
+                )
+            ''')
+            
             # Índices para búsquedas rápidas
             conn.execute('CREATE INDEX IF NOT EXISTS idx_archivo_ruta ON archivos(ruta)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_archivo_identidad ON archivos(dispositivo, inodo)')
+            # Carpeta de cada archivo con la barra final ('/datos/a.pdf' -> '/datos/'):
+            # rtrim quita por la derecha todo lo que no es '/', es decir, el nombre
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_archivo_carpeta ON archivos(rtrim(ruta, replace(ruta, '/', '')))"
+            )
             conn.execute('CREATE INDEX IF NOT EXISTS idx_etiqueta_nombre ON etiquetas(nombre)')
             conn.execute('CREATE INDEX IF NOT EXISTS idx_archivo_etiqueta_a ON archivo_etiqueta(archivo_id)')
-            conn.execute('CREATE INDEX IF NOT EXISTS idx_archivo_etiqueta_e ON archivo_etiqueta(etiqueta_id)')
+            # (etiqueta_id, archivo_id) cubre las búsquedas: recorre una etiqueta ordenada por archivo
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_archivo_etiqueta_ea ON archivo_etiqueta(etiqueta_id, archivo_id)')
+            conn.execute('DROP INDEX IF EXISTS idx_archivo_etiqueta_e')
+            # Búsqueda de etiquetas por prefijo sin distinguir mayúsculas; con el
+            # total, el rango se ordena por uso sin leer la fila de cada etiqueta
+            conn.execute('DROP INDEX IF EXISTS idx_etiqueta_nombre_nocase')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_etiqueta_nocase_total ON etiquetas(nombre COLLATE NOCASE, total)'
+            )
+            
+            self._crear_indice_nombres(conn)
+            
+            # Con cada alta o baja en archivo_etiqueta: etiquetas.version cambia (los
+            # índices en memoria detectan qué etiquetas han quedado obsoletas) y
+            # etiquetas.total mantiene el número exacto de archivos por etiqueta
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_archivo_etiqueta_insert
+                AFTER INSERT ON archivo_etiqueta
+                BEGIN
+                    UPDATE etiquetas SET version = version + 1, total = total + 1
+                    WHERE id = NEW.etiqueta_id;
+                END
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_archivo_etiqueta_delete
+                AFTER DELETE ON archivo_etiqueta
+                BEGIN
+                    UPDATE etiquetas SET version = version + 1, total = total - 1
+                    WHERE id = OLD.etiqueta_id;
+                END
+            ''')
             
-            conn.commit()
+            # Contadores de cambios en archivos para las firmas de búsqueda:
+            # version_archivos (altas y bajas) y version_rutas (renombrados)
+            conn.executemany(
+                'INSERT OR IGNORE INTO estado (clave, valor) VALUES (?, 0)',
+                [('version_archivos',), ('version_rutas',)]
+            )
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_archivos_insert
+                AFTER INSERT ON archivos
+                BEGIN
+                    UPDATE estado SET valor = valor + 1 WHERE clave = 'version_archivos';
+                END
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_archivos_delete
+                AFTER DELETE ON archivos
+                BEGIN
+                    UPDATE estado SET valor = valor + 1 WHERE clave = 'version_archivos';
+                END
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_archivos_ruta
+                AFTER UPDATE OF ruta ON archivos
+                BEGIN
+                    UPDATE estado SET valor = valor + 1 WHERE clave = 'version_rutas';
+                END
+            ''')
+            
+            conn.execute(f'PRAGMA user_version = {VERSION_ESQUEMA}')
+    
+    def _crear_indice_nombres(self, conn):
+        """Crea la tabla FTS5 de trigramas sobre etiquetas.nombre y sus triggers"""
+        existia = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'etiquetas_fts'"
+        ).fetchone() is not None
+        try:
+            conn.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS etiquetas_fts USING fts5(
+                    nombre, content='etiquetas', content_rowid='id', tokenize='trigram'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            log.warning("Índice de nombres no disponible (%s); se usará una búsqueda lineal", e)
+            self._indice_nombres = False
+            return
+        
+        if not existia:
+            # Base anterior al índice: indexar las etiquetas existentes una vez
+            conn.execute("INSERT INTO etiquetas_fts (etiquetas_fts) VALUES ('rebuild')")
+        
+        # Número de etiquetas por trigrama, para elegir los más selectivos
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS etiquetas_fts_vocab USING fts5vocab(etiquetas_fts, 'row')")
+        
+        # Tabla de contenido externo: los triggers replican altas, bajas y renombrados
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_etiquetas_fts_insert
+            AFTER INSERT ON etiquetas
+            BEGIN
+                INSERT INTO etiquetas_fts (rowid, nombre) VALUES (NEW.id, NEW.nombre);
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_etiquetas_fts_delete
+            AFTER DELETE ON etiquetas
+            BEGIN
+                INSERT INTO etiquetas_fts (etiquetas_fts, rowid, nombre) VALUES ('delete', OLD.id, OLD.nombre);
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_etiquetas_fts_update
+            AFTER UPDATE OF nombre ON etiquetas
+            BEGIN
+                INSERT INTO etiquetas_fts (etiquetas_fts, rowid, nombre) VALUES ('delete', OLD.id, OLD.nombre);
+                INSERT INTO etiquetas_fts (rowid, nombre) VALUES (NEW.id, NEW.nombre);
+            END
+        ''')
+    
+    def _columnas(self, conn, tabla):
+        """Devuelve los nombres de columna de una tabla"""
+        return {row[1] for row in conn.execute(f'PRAGMA table_info({tabla})')}
+    
+    def _versiones_etiquetas(self, conn, ids_etiquetas):
+        """Devuelve {id: version} de las etiquetas indicadas"""
+        cursor = conn.execute(
+            'SELECT id, version FROM etiquetas WHERE id IN (SELECT value FROM json_each(?))',
+            (json.dumps(list(ids_etiquetas)),)
+        )
+        return dict(cursor.fetchall())
+    
+    def _leer_estado(self, conn, clave, por_defecto=None):
+        """Lee un valor de la tabla estado"""
+        fila = conn.execute('SELECT valor FROM estado WHERE clave = ?', (clave,)).fetchone()
+        return fila[0] if fila else por_defecto
+    
+    def _guardar_estado(self, conn, clave, valor):
+        """Guarda (o borra, si valor es None) un valor de la tabla estado"""
+        if valor is None:
+            conn.execute('DELETE FROM estado WHERE clave = ?', (clave,))
+        else:
+            conn.execute('INSERT OR REPLACE INTO estado (clave, valor) VALUES (?, ?)', (clave, valor))
+    
+    def _en_transaccion(self):
+        """Indica si el hilo actual está dentro de una transacción abierta"""
+        return getattr(self._local, 'profundidad', 0) > 0
     
     def _obtener_o_crear_archivo(self, conn, ruta_archivo):
         """Obtiene ID de archivo o lo crea si no existe"""
@@ -55,9 +485,11 @@ class GestorEtiquetasSQLite:
         if resultado:
             return resultado[0]
         else:
+            st = os.stat(ruta_archivo)
             cursor = conn.execute(
-                'INSERT INTO archivos (ruta, ultima_modificacion) VALUES (?, ?)',
-                (ruta_archivo, os.path.getmtime(ruta_archivo))
+                'INSERT INTO archivos (ruta, ultima_modificacion, dispositivo, inodo, tamano) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (ruta_archivo, st.st_mtime, st.st_dev, st.st_ino, st.st_size)
             )
             return cursor.lastrowid
 
@@ -78,112 +510,1088 @@ class GestorEtiquetasSQLite:
             )
             return cursor.lastrowid
 
+    def _etiquetas_guardadas(self, conn, ruta_archivo):
+        """Devuelve {nombre: id} de las etiquetas guardadas para un archivo"""
+        cursor = conn.execute('''
+            SELECT e.nombre, e.id
+            FROM archivos a
+            JOIN archivo_etiqueta ae ON ae.archivo_id = a.id
+            JOIN etiquetas e ON e.id = ae.etiqueta_id
+            WHERE a.ruta = ?
+        ''', (ruta_archivo,))
+        return dict(cursor.fetchall())
+
+    def _calcular_delta(self, guardadas, etiquetas):
+        """Compara las etiquetas guardadas con las nuevas"""
+        nuevas = list(dict.fromkeys(etiquetas))
+        conjunto_nuevas = set(nuevas)
+        return {
+            'agregadas': [e for e in nuevas if e not in guardadas],
+            'eliminadas': [e for e in guardadas if e not in conjunto_nuevas]
+        }
+
+    @instrumentado(filas=lambda delta: len(delta['agregadas']) + len(delta['eliminadas']))
     def agregar_etiquetas(self, ruta_archivo, etiquetas):
-        """Añade etiquetas a un archivo"""
-        print(f"💾 Gestor: Guardando {len(etiquetas)} etiquetas para {ruta_archivo}")
+        """Guarda las etiquetas de un archivo aplicando solo los cambios.
+
+        Devuelve {'agregadas': [...], 'eliminadas': [...]} con los nombres
+        que realmente cambiaron; si no hay cambios no se escribe nada.
+        """
+        delta = self._calcular_delta(self._etiquetas_guardadas(self._conexion(), ruta_archivo), etiquetas)
+        if not delta['agregadas'] and not delta['eliminadas']:
+            return delta
         
-        with sqlite3.connect(self.db_path) as conn:
-            # Primero limpiar etiquetas existentes para este archivo
+        with self._transaccion() as conn:
+            # Recalcular dentro de la transacción por si otro proceso escribió entre medias
+            guardadas = self._etiquetas_guardadas(conn, ruta_archivo)
+            delta = self._calcular_delta(guardadas, etiquetas)
+            if not delta['agregadas'] and not delta['eliminadas']:
+                return delta
+            
             archivo_id = self._obtener_o_crear_archivo(conn, ruta_archivo)
+            ids_agregadas = [self._obtener_o_crear_etiqueta(conn, nombre) for nombre in delta['agregadas']]
+            ids_eliminadas = [guardadas[nombre] for nombre in delta['eliminadas']]
             
-            # Eliminar relaciones existentes
-            conn.execute('DELETE FROM archivo_etiqueta WHERE archivo_id = ?', (archivo_id,))
+            if self._indice is not None:
+                versiones_antes = self._versiones_etiquetas(conn, ids_agregadas + ids_eliminadas)
             
-            # Añadir nuevas etiquetas
-            for etiqueta_nombre in etiquetas:
-                etiqueta_id = self._obtener_o_crear_etiqueta(conn, etiqueta_nombre)
-                
-                # Relacionar archivo con etiqueta
-                conn.execute(
+            if ids_eliminadas:
+                conn.executemany(
+                    'DELETE FROM archivo_etiqueta WHERE archivo_id = ? AND etiqueta_id = ?',
+                    [(archivo_id, etiqueta_id) for etiqueta_id in ids_eliminadas]
+                )
+            
+            if ids_agregadas:
+                conn.executemany(
                     'INSERT OR IGNORE INTO archivo_etiqueta VALUES (?, ?)',
-                    (archivo_id, etiqueta_id)
+                    [(archivo_id, etiqueta_id) for etiqueta_id in ids_agregadas]
+                )
+            
+            if self._indice is not None:
+                versiones_despues = self._versiones_etiquetas(conn, ids_agregadas + ids_eliminadas)
+            
+            self._notificar_cambios([ruta_archivo])
+        
+        if self._indice is not None:
+            if self._en_transaccion():
+                # Dentro de una transacción externa el cambio aún puede deshacerse
+                self._indice.invalidar(ids_agregadas + ids_eliminadas)
+            else:
+                self._indice.aplicar_cambios(
+                    archivo_id, ids_agregadas, ids_eliminadas, versiones_antes, versiones_despues
                 )
-                print(f"  ✅ Etiqueta añadida: {etiqueta_nombre}")
+        
+        log.debug("%s (+%d / -%d)", ruta_archivo, len(delta['agregadas']), len(delta['eliminadas']))
+        return delta
+
+    @instrumentado(filas=lambda resultado: resultado['agregadas'] + resultado['eliminadas'])
+    def modificar_etiquetas_lote(self, rutas_archivos, agregar=(), quitar=()):
+        """Añade y quita etiquetas de muchos archivos en una sola transacción"""
+        rutas = list(dict.fromkeys(rutas_archivos))
+        agregar = list(dict.fromkeys(agregar))
+        quitar = [e for e in dict.fromkeys(quitar) if e not in agregar]
+        resultado = {'agregadas': 0, 'eliminadas': 0}
+        if not rutas or not (agregar or quitar):
+            return resultado
+        
+        # Las listas viajan como un único parámetro JSON y se resuelven con json_each
+        rutas_json = json.dumps(rutas)
+        
+        with self._transaccion() as conn:
+            if agregar:
+                # Solo los archivos que aún no están en la base necesitan stat()
+                nuevas = [row[0] for row in conn.execute('''
+                    SELECT j.value
+                    FROM json_each(?) j
+                    LEFT JOIN archivos a ON a.ruta = j.value
+                    WHERE a.id IS NULL
+                ''', (rutas_json,))]
+                conn.executemany(
+                    'INSERT INTO archivos (ruta, ultima_modificacion, dispositivo, inodo, tamano) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    ((ruta, st.st_mtime, st.st_dev, st.st_ino, st.st_size)
+                     for ruta, st in ((ruta, os.stat(ruta)) for ruta in nuevas))
+                )
+                conn.executemany(
+                    'INSERT OR IGNORE INTO etiquetas (nombre) VALUES (?)',
+                    ((nombre,) for nombre in agregar)
+                )
+                cursor = conn.execute('''
+                    INSERT OR IGNORE INTO archivo_etiqueta (archivo_id, etiqueta_id)
+                    SELECT a.id, e.id
+                    FROM json_each(?) jr
+                    JOIN archivos a ON a.ruta = jr.value
+                    CROSS JOIN json_each(?) je
+                    JOIN etiquetas e ON e.nombre = je.value
+                ''', (rutas_json, json.dumps(agregar)))
+                resultado['agregadas'] = cursor.rowcount
             
-            conn.commit()
-        print("💾 Gestor: Guardado completado")
+            if quitar:
+                cursor = conn.execute('''
+                    DELETE FROM archivo_etiqueta
+                    WHERE archivo_id IN (
+                        SELECT a.id FROM json_each(?) j JOIN archivos a ON a.ruta = j.value
+                    )
+                    AND etiqueta_id IN (
+                        SELECT e.id FROM json_each(?) j JOIN etiquetas e ON e.nombre = j.value
+                    )
+                ''', (rutas_json, json.dumps(quitar)))
+                resultado['eliminadas'] = cursor.rowcount
+            
+            if resultado['agregadas'] or resultado['eliminadas']:
+                self._notificar_cambios(rutas)
+            
+            if self._indice is not None:
+                ids_afectadas = [row[0] for row in conn.execute(
+                    'SELECT id FROM etiquetas WHERE nombre IN (SELECT value FROM json_each(?))',
+                    (json.dumps(agregar + quitar),)
+                )]
+        
+        if self._indice is not None:
+            # Las etiquetas tocadas por el lote se recargan en la próxima búsqueda
+            self._indice.invalidar(ids_afectadas)
+        
+        log.debug("Lote de %d archivos (+%d / -%d)", len(rutas), resultado['agregadas'], resultado['eliminadas'])
+        return resultado
 
+    @instrumentado()
+    def obtener_etiquetas_comunes(self, rutas_archivos):
+        """Obtiene las etiquetas que comparten todos los archivos indicados"""
+        rutas = list(dict.fromkeys(rutas_archivos))
+        if not rutas:
+            return []
+        try:
+            cursor = self._conexion().execute('''
+                SELECT e.nombre, e.color
+                FROM json_each(?) j
+                JOIN archivos a ON a.ruta = j.value
+                JOIN archivo_etiqueta ae ON ae.archivo_id = a.id
+                JOIN etiquetas e ON e.id = ae.etiqueta_id
+                GROUP BY e.id
+                HAVING COUNT(*) = ?
+                ORDER BY e.nombre
+            ''', (json.dumps(rutas), len(rutas)))
+            return [{'nombre': row[0], 'color': row[1]} for row in cursor]
+        except sqlite3.Error:
+            return []
+
+    @instrumentado()
     def obtener_etiquetas_archivo(self, ruta_archivo):
         """Obtiene todas las etiquetas de un archivo"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute('''
-                    SELECT t.nombre, t.color 
-                    FROM etiquetas t
-                    JOIN archivo_etiqueta ae ON t.id = ae.etiqueta_id
-                    JOIN archivos a ON a.id = ae.archivo_id
-                    WHERE a.ruta = ?
-                ''', (ruta_archivo,))
-                
-                return [{'nombre': row[0], 'color': row[1]} for row in cursor]
+            cursor = self._conexion().execute('''
+                SELECT t.nombre, t.color 
+                FROM etiquetas t
+                JOIN archivo_etiqueta ae ON t.id = ae.etiqueta_id
+                JOIN archivos a ON a.id = ae.archivo_id
+                WHERE a.ruta = ?
+            ''', (ruta_archivo,))
+            
+            return [{'nombre': row[0], 'color': row[1]} for row in cursor]
         except:
             return []
 
+    @instrumentado()
+    def obtener_etiquetas_carpeta(self, carpeta):
+        """Obtiene {ruta: [nombres]} de los archivos etiquetados de una carpeta (sin subcarpetas).
+        
+        Una sola consulta de igualdad sobre idx_archivo_carpeta (la condición
+        repite su expresión): solo se leen los archivos de la propia carpeta,
+        no los de todas sus subcarpetas. INDEXED BY evita que el planificador
+        prefiera recorrer archivos en orden de ruta para ahorrarse el ORDER BY.
+        """
+        try:
+            cursor = self._conexion().execute('''
+                SELECT a.ruta, e.nombre
+                FROM archivos a INDEXED BY idx_archivo_carpeta
+                JOIN archivo_etiqueta ae ON ae.archivo_id = a.id
+                JOIN etiquetas e ON e.id = ae.etiqueta_id
+                WHERE rtrim(a.ruta, replace(a.ruta, '/', '')) = ?
+                ORDER BY a.ruta, e.nombre
+            ''', (os.path.join(carpeta, ''),))
+            resultado = {}
+            for ruta, nombre in cursor:
+                resultado.setdefault(ruta, []).append(nombre)
+            return resultado
+        except sqlite3.Error as e:
+            log.error("Error leyendo etiquetas de %s: %s", carpeta, e)
+            return {}
+    
+    def version_datos(self):
+        """PRAGMA data_version de la conexión del hilo actual: cambia cuando otra conexión escribe"""
+        return self._conexion().execute('PRAGMA data_version').fetchone()[0]
+
+    @instrumentado()
     def obtener_todas_etiquetas(self):
-        """Obtiene todas las etiquetas del sistema"""
+        """Obtiene todas las etiquetas del sistema con su número de archivos"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute('SELECT nombre, color FROM etiquetas ORDER BY nombre')
-                return [{'nombre': row[0], 'color': row[1]} for row in cursor]
+            cursor = self._conexion().execute('SELECT nombre, color, total FROM etiquetas ORDER BY nombre')
+            return [{'nombre': row[0], 'color': row[1], 'total': row[2]} for row in cursor]
         except:
             return []
+    
+    @instrumentado()
+    def buscar_etiquetas(self, texto, limite=50, tolerancia=None):
+        """Busca etiquetas por nombre sin distinguir mayúsculas.
+        
+        Devuelve [{'nombre', 'color', 'total'}]: primero la coincidencia exacta,
+        después las de prefijo, las de subcadena y, si faltan resultados, las
+        que contienen el texto con erratas; en cada grupo, las más usadas antes.
+        `tolerancia` es el número de errores admitidos (por defecto uno por cada
+        cuatro caracteres) y `limite=None` devuelve todas las coincidencias.
+        """
+        texto = texto.strip().lower()
+        if not texto:
+            return []
+        try:
+            conn = self._conexion()
+            # Cada grupo se ordena y se corta en SQL (LIMIT -1 es sin límite)
+            restantes = -1 if limite is None else limite
+            # Exacta y prefijo: un rango sobre idx_etiqueta_nocase_total, que
+            # cubre el orden; solo se leen las filas de las etiquetas elegidas
+            rango = (texto, texto[:-1] + chr(ord(texto[-1]) + 1))
+            resultados = _agrupar_etiquetas(texto, conn.execute('''
+                SELECT nombre, color, total FROM etiquetas WHERE id IN (
+                    SELECT id FROM etiquetas
+                    WHERE nombre COLLATE NOCASE >= ? AND nombre COLLATE NOCASE < ?
+                    ORDER BY nombre = ? COLLATE NOCASE DESC, total DESC, nombre
+                    LIMIT ?
+                )
+            ''', (*rango, texto, restantes)))
+            
+            if limite is None or len(resultados) < limite:
+                # NOCASE solo pliega ASCII: con otras letras ('Ñ'/'ñ') hay prefijos
+                # fuera del rango, que llegan con las subcadenas y no deben cortarse
+                restantes = -1 if limite is None or not texto.isascii() else limite - len(resultados)
+                if self._indice_nombres and len(texto) >= 3:
+                    cursor = conn.execute('''
+                        SELECT e.nombre, e.color, e.total
+                        FROM etiquetas_fts f
+                        JOIN etiquetas e ON e.id = f.rowid
+                        WHERE etiquetas_fts MATCH ?
+                        AND NOT (e.nombre COLLATE NOCASE >= ? AND e.nombre COLLATE NOCASE < ?)
+                        ORDER BY e.total DESC, e.nombre
+                        LIMIT ?
+                    ''', (_frase_fts(texto), *rango, restantes))
+                else:
+                    # Sin índice o con menos de un trigrama (el filtro del buscador
+                    # con una o dos letras): recorrido lineal por subcadena, sin
+                    # los prefijos (posición 1), que ya salieron del rango
+                    cursor = conn.execute('''
+                        SELECT nombre, color, total FROM etiquetas
+                        WHERE instr(lower(nombre), ?) > 1
+                        ORDER BY total DESC, nombre
+                        LIMIT ?
+                    ''', (texto, restantes))
+                resultados += _agrupar_etiquetas(texto, cursor)
+            
+            if tolerancia is None:
+                tolerancia = len(texto) // 4
+            if tolerancia and self._indice_nombres and (limite is None or len(resultados) < limite):
+                resultados += self._etiquetas_aproximadas(conn, texto, tolerancia, {r[2] for r in resultados})
+            
+            resultados.sort()
+            if limite is not None:
+                resultados = resultados[:limite]
+            return [{'nombre': r[2], 'color': r[3], 'total': r[4]} for r in resultados]
+        except sqlite3.Error as e:
+            log.error("Error buscando etiquetas '%s': %s", texto, e)
+            return []
+    
+    def _etiquetas_aproximadas(self, conn, texto, tolerancia, excluir, candidatas=200):
+        """Etiquetas que contienen `texto` con como mucho `tolerancia` errores.
+        
+        Si el texto es corto para esa tolerancia se baja a la que todavía se
+        puede garantizar; por debajo de un error garantizado (textos de 4 a 6
+        caracteres) se busca un error entre las etiquetas que conservan alguno
+        de sus trigramas, sin garantía de encontrarlas todas.
+        """
+        trigramas = _trigramas(texto)
+        if not trigramas:
+            return []
+        # Cada error rompe como mucho 4 trigramas (una trasposición de dos
+        # caracteres cuenta como un error), así que de cualesquiera
+        # 4·tolerancia + 1 trigramas del texto al menos uno sigue intacto en
+        # una coincidencia: basta con buscar los más raros
+        tolerancia = max(1, min(tolerancia, (len(trigramas) - 1) // 4))
+        necesarios = min(4 * tolerancia + 1, len(trigramas))
+        cursor = conn.execute(
+            'SELECT term FROM etiquetas_fts_vocab '
+            'WHERE term IN (SELECT value FROM json_each(?)) ORDER BY doc LIMIT ?',
+            (json.dumps(sorted(trigramas)), necesarios)
+        )
+        selectivos = [row[0] for row in cursor]
+        if not selectivos:
+            return []  # Ningún trigrama aparece en ninguna etiqueta
+        cursor = conn.execute('''
+            SELECT e.nombre, e.color, e.total
+            FROM etiquetas_fts f
+            JOIN etiquetas e ON e.id = f.rowid
+            WHERE etiquetas_fts MATCH ?
+            ORDER BY e.total DESC
+            LIMIT ?
+        ''', (' OR '.join(_frase_fts(t) for t in selectivos), candidatas))
+        
+        # Filtro barato antes de calcular distancias: una coincidencia conserva
+        # al menos len(trigramas) - 4·tolerancia trigramas del texto
+        minimo = max(1, len(trigramas) - 4 * tolerancia)
+        resultados = []
+        for nombre, color, total in cursor:
+            if nombre in excluir:
+                continue
+            minusculas = nombre.lower()
+            if minimo > 1 and len(trigramas & _trigramas(minusculas)) < minimo:
+                continue
+            distancia = _distancia_subcadena(texto, minusculas, tolerancia)
+            if distancia <= tolerancia:
+                # Detrás de las coincidencias exactas, por número de errores
+                resultados.append((2 + distancia, -total, nombre, color, total))
+        return resultados
+
+    def _resolver_etiquetas(self, conn, nombres):
+        """Devuelve [(id, num_archivos)] de las etiquetas existentes, de la más rara a la más común"""
+        placeholders = ','.join(['?'] * len(nombres))
+        cursor = conn.execute(
+            f'SELECT id, total FROM etiquetas WHERE nombre IN ({placeholders}) ORDER BY total',
+            nombres
+        )
+        return cursor.fetchall()
+
+    def _sql_busqueda(self, ids, operador):
+        """Construye la consulta (id, ruta) de una búsqueda, ordenada por archivos.id.
+
+        Devuelve (sql, parametros): parametros(desde, limite) completa los valores
+        para la paginación por clave; desde=0 y limite=-1 recorren todo.
+        """
+        if operador == 'AND':
+            # Se parte de la etiqueta más rara y se comprueban las demás por clave
+            # primaria; CROSS JOIN fija ese orden de recorrido en SQLite
+            joins, filtro, valores_joins, valores_filtro = sql_interseccion(
+                't0.archivo_id', [id_ for id_, _ in ids[1:]]
+            )
+            sql = f'''
+                SELECT a.id, a.ruta
+                FROM archivo_etiqueta t0{joins}
+                CROSS JOIN archivos a ON a.id = t0.archivo_id
+                WHERE t0.etiqueta_id = ? AND t0.archivo_id > ?{filtro}
+                ORDER BY t0.archivo_id
+                LIMIT ?
+            '''
+            
+            def parametros(desde, limite):
+                return valores_joins + [ids[0][0], desde] + valores_filtro + [limite]
+        
+        elif len(ids) > MAX_RAMAS_UNION:
+            # OR de muchas etiquetas: un solo recorrido por clave de archivos.id que
+            # comprueba cada archivo contra la lista por clave primaria
+            sql = '''
+                SELECT a.id, a.ruta
+                FROM archivos a
+                WHERE a.id > ? AND EXISTS (
+                    SELECT 1 FROM archivo_etiqueta x
+                    WHERE x.archivo_id = a.id AND x.etiqueta_id IN (SELECT value FROM json_each(?))
+                )
+                ORDER BY a.id
+                LIMIT ?
+            '''
+            lista = json.dumps([id_ for id_, _ in ids])
+            
+            def parametros(desde, limite):
+                return [desde, lista, limite]
+        
+        else:  # OR - Archivos que tienen AL MENOS UNA etiqueta
+            # Cada rama lee como mucho `limite` filas de su etiqueta: una página
+            # cuesta O(etiquetas x página), no O(resultados)
+            ramas = ' UNION '.join([
+                'SELECT archivo_id FROM (SELECT archivo_id FROM archivo_etiqueta '
+                'WHERE etiqueta_id = ? AND archivo_id > ? ORDER BY archivo_id LIMIT ?)'
+            ] * len(ids))
+            sql = f'''
+                SELECT a.id, a.ruta
+                FROM ({ramas}) u
+                CROSS JOIN archivos a ON a.id = u.archivo_id
+                ORDER BY u.archivo_id
+                LIMIT ?
+            '''
+            
+            def parametros(desde, limite):
+                valores = []
+                for id_, _ in ids:
+                    valores += [id_, desde, limite]
+                return valores + [limite]
+        
+        return sql, parametros
+
+    def _preparar_busqueda(self, conn, etiquetas, operador):
+        """Resuelve los ids de una búsqueda; devuelve None si no puede haber resultados"""
+        nombres = list(dict.fromkeys(etiquetas))
+        if not nombres:
+            return None
+        ids = self._resolver_etiquetas(conn, nombres)
+        if not ids or (operador == 'AND' and len(ids) < len(nombres)):
+            return None  # En AND, una etiqueta inexistente vacía la intersección
+        return ids
 
+    @instrumentado()
     def buscar_por_etiquetas(self, etiquetas, operador='AND'):
         """Busca archivos que tengan ciertas etiquetas"""
-        with sqlite3.connect(self.db_path) as conn:
-            placeholders = ','.join(['?'] * len(etiquetas))
-            
-            if operador == 'AND':
-                # Archivos que tienen TODAS las etiquetas
-                query = f'''
-                    SELECT a.ruta 
-                    FROM archivos a
-                    WHERE (
-                        SELECT COUNT(*) 
-                        FROM archivo_etiqueta ae 
-                        JOIN etiquetas e ON e.id = ae.etiqueta_id 
-                        WHERE ae.archivo_id = a.id 
-                        AND e.nombre IN ({placeholders})
-                    ) = ?
-                '''
-                cursor = conn.execute(query, etiquetas + [len(etiquetas)])
-            
-            else:  # OR - Archivos que tienen AL MENOS UNA etiqueta
-                query = f'''
-                    SELECT DISTINCT a.ruta 
-                    FROM archivos a
-                    JOIN archivo_etiqueta ae ON a.id = ae.archivo_id
-                    JOIN etiquetas e ON e.id = ae.etiqueta_id
-                    WHERE e.nombre IN ({placeholders})
-                '''
-                cursor = conn.execute(query, etiquetas)
-            
-            return [row[0] for row in cursor]
-
-    def limpiar_archivos_inexistentes(self):
-        """Elimina archivos que ya no existen del sistema"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute('SELECT id, ruta FROM archivos')
-            for archivo_id, ruta in cursor:
-                if not os.path.exists(ruta):
-                    conn.execute('DELETE FROM archivos WHERE id = ?', (archivo_id,))
-            conn.commit()
+        conn = self._conexion()
+        
+        if self._indice is not None:
+            return self._rutas_de_ids(conn, iterar_ids(self._mapa_indice(conn, etiquetas, operador)))
+        
+        ids = self._preparar_busqueda(conn, etiquetas, operador)
+        if ids is None:
+            return []
+        sql, parametros = self._sql_busqueda(ids, operador)
+        return [row[1] for row in conn.execute(sql, parametros(0, -1))]
+
+    def iterar_por_etiquetas(self, etiquetas, operador='AND', tamano_pagina=1000):
+        """Recorre los resultados de una búsqueda en páginas de rutas.
+
+        Paginación por clave sobre archivos.id: cada página es una consulta
+        corta y no queda ningún cursor abierto entre páginas.
+        """
+        conn = self._conexion()
+        
+        if self._indice is not None:
+            mapa = self._mapa_indice(conn, etiquetas, operador)
+            for lote in _lotes(iterar_ids(mapa), tamano_pagina):
+                yield self._rutas_de_ids(conn, lote)
+            return
+        
+        ids = self._preparar_busqueda(conn, etiquetas, operador)
+        if ids is None:
+            return
+        sql, parametros = self._sql_busqueda(ids, operador)
+        desde = 0
+        while True:
+            filas = conn.execute(sql, parametros(desde, tamano_pagina)).fetchall()
+            if filas:
+                yield [ruta for _, ruta in filas]
+            if len(filas) < tamano_pagina:
+                return
+            desde = filas[-1][0]
+
+    @instrumentado()
+    def contar_por_etiquetas(self, etiquetas, operador='AND'):
+        """Cuenta los archivos de una búsqueda sin traer sus rutas"""
+        conn = self._conexion()
+        
+        if self._indice is not None:
+            return contar_bits(self._mapa_indice(conn, etiquetas, operador))
+        
+        ids = self._preparar_busqueda(conn, etiquetas, operador)
+        if ids is None:
+            return 0
+        if operador == 'AND':
+            sql, parametros = self._sql_busqueda(ids, operador)
+            return conn.execute(f'SELECT COUNT(*) FROM ({sql})', parametros(0, -1)).fetchone()[0]
+        # En OR basta un IN sobre el índice, sin la UNION que necesita la paginación
+        placeholders = ','.join(['?'] * len(ids))
+        cursor = conn.execute(f'''
+            SELECT COUNT(*)
+            FROM archivos a
+            WHERE a.id IN (
+                SELECT archivo_id FROM archivo_etiqueta WHERE etiqueta_id IN ({placeholders})
+            )
+        ''', [id_ for id_, _ in ids])
+        return cursor.fetchone()[0]
+
+    def _mapa_indice(self, conn, etiquetas, operador):
+        """Resuelve la búsqueda con operaciones de bits sobre el índice en memoria"""
+        nombres = list(dict.fromkeys(etiquetas))
+        if not nombres:
+            return 0
+        placeholders = ','.join(['?'] * len(nombres))
+        ids = [row[0] for row in conn.execute(
+            f'SELECT id FROM etiquetas WHERE nombre IN ({placeholders})', nombres
+        )]
+        if not ids or (operador == 'AND' and len(ids) < len(nombres)):
+            return 0
+        return self._indice.buscar(ids, operador)
+
+    def _compilar_consulta(self, conn, consulta):
+        """Analiza y compila una consulta booleana; None si no puede tener resultados"""
+        arbol = analizar_consulta(consulta)
+        nombres = list(dict.fromkeys(etiquetas_de(arbol)))
+        placeholders = ','.join(['?'] * len(nombres))
+        cursor = conn.execute(
+            f'SELECT nombre, id, total FROM etiquetas WHERE nombre IN ({placeholders})', nombres
+        )
+        return compilar_consulta(arbol, {nombre: (id_, total) for nombre, id_, total in cursor})
+
+    @instrumentado()
+    def buscar_por_consulta(self, consulta):
+        """Busca archivos con una consulta booleana, p. ej. '(a OR b) AND c AND NOT d'.
+
+        La consulta se compila a una única sentencia SQL con INTERSECT/UNION/EXCEPT;
+        lanza ErrorConsulta si está mal formada.
+        """
+        conn = self._conexion()
+        compilada = self._compilar_consulta(conn, consulta)
+        if compilada is None:
+            return []
+        sql, parametros = compilada
+        cursor = conn.execute(f'SELECT a.ruta FROM archivos a WHERE a.id IN ({sql}) ORDER BY a.id', parametros)
+        return [row[0] for row in cursor]
+
+    def iterar_por_consulta(self, consulta, tamano_pagina=1000):
+        """Recorre los resultados de una consulta booleana en páginas de rutas.
+
+        La consulta se evalúa una sola vez; solo se retienen los ids (enteros
+        compactos) y las rutas se resuelven página a página.
+        """
+        conn = self._conexion()
+        compilada = self._compilar_consulta(conn, consulta)
+        if compilada is None:
+            return
+        sql, parametros = compilada
+        ids = array('q', (row[0] for row in conn.execute(
+            f'SELECT archivo_id FROM ({sql}) ORDER BY archivo_id', parametros
+        )))
+        for lote in _lotes(ids, tamano_pagina):
+            pagina = self._rutas_de_ids(conn, lote)
+            if pagina:
+                yield pagina
+
+    @instrumentado()
+    def contar_por_consulta(self, consulta):
+        """Cuenta los archivos de una consulta booleana sin traer sus rutas"""
+        conn = self._conexion()
+        compilada = self._compilar_consulta(conn, consulta)
+        if compilada is None:
+            return 0
+        sql, parametros = compilada
+        return conn.execute(f'SELECT COUNT(*) FROM archivos WHERE id IN ({sql})', parametros).fetchone()[0]
+
+    @instrumentado()
+    def firma_busqueda(self, etiquetas, con_negacion=False):
+        """Firma del estado de la base del que depende el resultado de una búsqueda.
+        
+        Incluye etiquetas.version de cada etiqueta (sus triggers la incrementan
+        con cada alta o baja) y el contador de renombrados; con negaciones,
+        también el de altas y bajas de archivos, porque el resultado depende de
+        todo el catálogo. Si la firma guardada con un resultado coincide con la
+        actual, el resultado sigue siendo válido.
+        """
+        conn = self._conexion()
+        nombres = sorted(set(etiquetas))
+        versiones = dict(conn.execute(
+            'SELECT nombre, version FROM etiquetas WHERE nombre IN (SELECT value FROM json_each(?))',
+            (json.dumps(nombres),)
+        ).fetchall())
+        firma = {
+            'etiquetas': [[nombre, versiones.get(nombre)] for nombre in nombres],
+            'rutas': self._leer_estado(conn, 'version_rutas', 0)
+        }
+        if con_negacion:
+            firma['archivos'] = self._leer_estado(conn, 'version_archivos', 0)
+        return json.dumps(firma, ensure_ascii=False)
+
+    def _rutas_de_ids(self, conn, ids, tamano_lote=50000):
+        """Traduce ids de archivo a rutas, por lotes y en orden de id"""
+        rutas = []
+        for lote in _lotes(ids, tamano_lote):
+            cursor = conn.execute(
+                'SELECT ruta FROM archivos WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id',
+                (json.dumps(lote),)
+            )
+            rutas.extend(row[0] for row in cursor)
+        return rutas
+
+    @instrumentado(filas=lambda resultado: resultado['revisados'])
+    def limpiar_archivos_inexistentes(self, tamano_lote=1000, hilos=16, progreso=None):
+        """Elimina archivos que ya no existen del sistema.
+
+        Recorre archivos por lotes de id, comprueba su existencia en paralelo y
+        borra cada lote en una transacción corta, sin retener el bloqueo de
+        escritura mientras se consulta el disco. El último id revisado se guarda
+        en la tabla estado, así que una ejecución interrumpida continúa donde se
+        quedó. progreso(revisados, total, eliminados) se llama tras cada lote.
+        
+        Un archivo puede haberse movido a una carpeta que la limpieza no mira:
+        los eliminados con identidad y etiquetas pasan a la tabla perdidos,
+        donde reconciliar_movidos y reconciliar_carpeta los recuperan si
+        reaparecen, y solo se olvidan tras GRACIA_PERDIDOS_S.
+        """
+        conn = self._conexion()
+        desde = self._leer_estado(conn, 'limpieza_ultimo_id', 0)
+        total = conn.execute('SELECT COUNT(*) FROM archivos').fetchone()[0]
+        revisados = 0
+        if desde:
+            revisados = conn.execute('SELECT COUNT(*) FROM archivos WHERE id <= ?', (desde,)).fetchone()[0]
+            log.info("Reanudando limpieza desde el archivo %d", desde)
+        eliminados = 0
+        apartados = 0
+        # Carpetas ya listadas en esta limpieza y sus archivos sin etiquetar, por identidad
+        escaneadas = set()
+        candidatos = {}
+        
+        # stat() en paralelo: en montajes de red la latencia domina sobre la CPU
+        with ThreadPoolExecutor(max_workers=hilos) as pool:
+            while True:
+                filas = conn.execute(
+                    'SELECT id, ruta, ultima_modificacion, dispositivo, inodo, tamano '
+                    'FROM archivos WHERE id > ? ORDER BY id LIMIT ?',
+                    (desde, tamano_lote)
+                ).fetchall()
+                if not filas:
+                    break
+                desde = filas[-1][0]
+                
+                stats = pool.map(_stat, [fila[1] for fila in filas])
+                perdidos = []
+                identidades = []
+                for (archivo_id, ruta, *identidad), st in zip(filas, stats):
+                    if st is None:
+                        perdidos.append((archivo_id, ruta, identidad))
+                    elif identidad != [st.st_mtime, st.st_dev, st.st_ino, st.st_size]:
+                        # Aprovechar el stat para completar o refrescar la identidad
+                        identidades.append((st.st_mtime, st.st_dev, st.st_ino, st.st_size, archivo_id))
+                
+                # Antes de borrar, intentar seguir los renombrados dentro de la misma carpeta
+                desaparecidos = [ruta for _, ruta, _ in perdidos]
+                if perdidos:
+                    movidos = self._seguir_movidos(perdidos, candidatos, escaneadas, hilos)
+                    recuperados = {anterior for anterior, _ in movidos}
+                    desaparecidos = [ruta for ruta in desaparecidos if ruta not in recuperados]
+                
+                with self._transaccion() as conn_escritura:
+                    if identidades:
+                        conn_escritura.executemany(
+                            'UPDATE archivos SET ultima_modificacion = ?, dispositivo = ?, inodo = ?, tamano = ? '
+                            'WHERE id = ?',
+                            identidades
+                        )
+                    if desaparecidos:
+                        apartados += conn_escritura.execute('''
+                            INSERT INTO perdidos
+                                (dispositivo, inodo, ruta, ultima_modificacion, tamano, etiquetas, perdido)
+                            SELECT a.dispositivo, a.inodo, a.ruta, a.ultima_modificacion, a.tamano,
+                                   (SELECT json_group_array(ae.etiqueta_id)
+                                    FROM archivo_etiqueta ae WHERE ae.archivo_id = a.id),
+                                   ?
+                            FROM archivos a
+                            WHERE a.ruta IN (SELECT value FROM json_each(?))
+                              AND a.dispositivo IS NOT NULL AND a.inodo IS NOT NULL
+                              AND EXISTS (SELECT 1 FROM archivo_etiqueta ae WHERE ae.archivo_id = a.id)
+                        ''', (time.time(), json.dumps(desaparecidos))).rowcount
+                        conn_escritura.execute(
+                            'DELETE FROM archivos WHERE ruta IN (SELECT value FROM json_each(?))',
+                            (json.dumps(desaparecidos),)
+                        )
+                        self._notificar_cambios(desaparecidos)
+                    self._guardar_estado(conn_escritura, 'limpieza_ultimo_id', desde)
+                
+                revisados += len(filas)
+                eliminados += len(desaparecidos)
+                if progreso is not None:
+                    progreso(revisados, total, eliminados)
+        
+        # Recorrido completo: la próxima limpieza empieza desde el principio
+        with self._transaccion() as conn_escritura:
+            self._guardar_estado(conn_escritura, 'limpieza_ultimo_id', None)
+            caducados = conn_escritura.execute(
+                'DELETE FROM perdidos WHERE perdido < ?', (time.time() - GRACIA_PERDIDOS_S,)
+            ).rowcount
+        
+        log.info("Limpieza completada (%d revisados, %d eliminados, %d en espera, %d perdidos olvidados)",
+                 revisados, eliminados, apartados, caducados)
+        return {'revisados': revisados, 'eliminados': eliminados, 'perdidos': apartados, 'total': total}
+    
+    def _rutas_en_carpetas(self, carpetas):
+        """Lista los archivos regulares de las carpetas indicadas (sin recursión)"""
+        rutas = []
+        for carpeta in carpetas:
+            try:
+                with os.scandir(carpeta) as entradas:
+                    rutas.extend(e.path for e in entradas if e.is_file(follow_symlinks=False))
+            except OSError:
+                continue
+        return rutas
+
+    def _candidatos_movidos(self, conn, rutas, hilos):
+        """{(dispositivo, inodo): (ruta, stat)} de las rutas que la base aún no conoce"""
+        rutas = list(dict.fromkeys(rutas))
+        if not rutas:
+            return {}
+        
+        # Solo interesan las rutas que aún no conoce la base
+        nuevas = [row[0] for row in conn.execute('''
+            SELECT j.value
+            FROM json_each(?) j
+            LEFT JOIN archivos a ON a.ruta = j.value
+            WHERE a.id IS NULL
+        ''', (json.dumps(rutas),))]
+        if not nuevas:
+            return {}
+        
+        with ThreadPoolExecutor(max_workers=hilos) as pool:
+            stats = list(pool.map(_stat, nuevas))
+        return {
+            (st.st_dev, st.st_ino): (ruta, st)
+            for ruta, st in zip(nuevas, stats) if st is not None
+        }
+    
+    def _es_movimiento(self, ruta_anterior, tamano, mtime, st):
+        """Si la fila (ruta_anterior, tamano, mtime) es el archivo de `st` tras moverse"""
+        # Mismo tamaño y mtime: descarta inodos reutilizados por otro archivo
+        if st.st_size != tamano or st.st_mtime != mtime:
+            return False
+        # Si la ruta anterior sigue existiendo es un enlace duro, no un movimiento
+        return not os.path.lexists(ruta_anterior)
+    
+    def _aplicar_movidos(self, movidos):
+        """Pasa cada fila (ruta_anterior, ruta_nueva, archivo_id) a su ruta nueva"""
+        if not movidos:
+            return []
+        with self._transaccion() as conn_escritura:
+            # Una ruta nueva etiquetada mientras tanto ya tiene su propia fila
+            ocupadas = {row[0] for row in conn_escritura.execute(
+                'SELECT ruta FROM archivos WHERE ruta IN (SELECT value FROM json_each(?))',
+                (json.dumps([ruta_nueva for _, ruta_nueva, _ in movidos]),)
+            )}
+            movidos = [movido for movido in movidos if movido[1] not in ocupadas]
+            if movidos:
+                conn_escritura.executemany(
+                    'UPDATE archivos SET ruta = ? WHERE id = ?',
+                    [(ruta_nueva, archivo_id) for _, ruta_nueva, archivo_id in movidos]
+                )
+                self._notificar_cambios([ruta for anterior, nueva, _ in movidos for ruta in (anterior, nueva)])
+        if movidos:
+            log.info("%d archivos movidos vueltos a enlazar", len(movidos))
+        return [(anterior, nueva) for anterior, nueva, _ in movidos]
+    
+    def _seguir_movidos(self, perdidos, candidatos, escaneadas, hilos):
+        """Vuelve a enlazar los archivos perdidos de un lote de la limpieza.
+        
+        perdidos son (archivo_id, ruta, [mtime, dispositivo, inodo, tamano]).
+        Cada carpeta se lista y se consulta una sola vez por limpieza: los
+        lotes comparten `escaneadas` y `candidatos` ({(dispositivo, inodo):
+        (ruta, stat)}), y la fila perdida se busca por su propia identidad.
+        """
+        carpetas = {os.path.dirname(ruta) for _, ruta, _ in perdidos} - escaneadas
+        if carpetas:
+            escaneadas.update(carpetas)
+            candidatos.update(self._candidatos_movidos(self._conexion(), self._rutas_en_carpetas(carpetas), hilos))
+        
+        movidos = []
+        for archivo_id, ruta_anterior, (mtime, dispositivo, inodo, tamano) in perdidos:
+            ruta_nueva, st = candidatos.get((dispositivo, inodo), (None, None))
+            if ruta_nueva is not None and self._es_movimiento(ruta_anterior, tamano, mtime, st):
+                del candidatos[(dispositivo, inodo)]
+                movidos.append((ruta_anterior, ruta_nueva, archivo_id))
+        return self._aplicar_movidos(movidos)
+    
+    @instrumentado()
+    def reconciliar_movidos(self, rutas_candidatas, hilos=16):
+        """Vuelve a enlazar archivos movidos o renombrados fuera de la extensión.
+
+        Para cada ruta candidata que todavía no está en la base se busca, por
+        (dispositivo, inodo), una fila cuya ruta ya no existe y cuyo tamaño y
+        mtime coinciden; esa fila pasa a la nueva ruta y conserva sus etiquetas.
+        No se lee el contenido de ningún archivo. Devuelve [(ruta_anterior, ruta_nueva)].
+        """
+        conn = self._conexion()
+        por_identidad = self._candidatos_movidos(conn, rutas_candidatas, hilos)
+        if not por_identidad:
+            return []
+        
+        # Búsqueda en bloque por el índice (dispositivo, inodo)
+        cursor = conn.execute('''
+            SELECT a.id, a.ruta, a.dispositivo, a.inodo, a.tamano, a.ultima_modificacion
+            FROM json_each(?) j
+            JOIN archivos a
+              ON a.dispositivo = json_extract(j.value, '$[0]')
+             AND a.inodo = json_extract(j.value, '$[1]')
+        ''', (json.dumps(list(por_identidad)),))
+        
+        movidos = []
+        for archivo_id, ruta_anterior, dispositivo, inodo, tamano, mtime in cursor.fetchall():
+            ruta_nueva, st = por_identidad.get((dispositivo, inodo), (None, None))
+            if ruta_nueva is None:
+                continue  # Esta identidad ya se asignó a otra fila
+            # Puede haber varias filas con la misma identidad (inodos reutilizados):
+            # la candidata solo se consume cuando una de ellas encaja
+            if not self._es_movimiento(ruta_anterior, tamano, mtime, st):
+                continue
+            del por_identidad[(dispositivo, inodo)]
+            movidos.append((ruta_anterior, ruta_nueva, archivo_id))
+        
+        # Las candidatas que no encajan con ninguna fila pueden ser archivos perdidos
+        return self._aplicar_movidos(movidos) + self._restaurar_perdidos(conn, por_identidad)
     
+    @instrumentado(filas=len)
+    def reconciliar_carpeta(self, carpeta, hilos=4):
+        """Devuelve sus etiquetas a los archivos perdidos que reaparecen en una carpeta.
+        
+        Pensado para cada carga de carpeta: si la tabla perdidos está vacía no
+        hace nada y, si no, compara sus inodos con los que da scandir() (sin un
+        stat() por archivo); solo las coincidencias pasan por
+        reconciliar_movidos. Devuelve [(ruta_anterior, ruta_nueva)].
+        """
+        try:
+            conn = self._conexion()
+            if conn.execute('SELECT 1 FROM perdidos LIMIT 1').fetchone() is None:
+                return []
+            try:
+                dispositivo = os.stat(carpeta).st_dev
+                with os.scandir(carpeta) as entradas:
+                    por_inodo = {e.inode(): e.path for e in entradas if e.is_file(follow_symlinks=False)}
+            except OSError:
+                return []
+            if not por_inodo:
+                return []
+            coincidencias = [por_inodo[row[0]] for row in conn.execute('''
+                SELECT DISTINCT p.inodo
+                FROM json_each(?) j
+                JOIN perdidos p ON p.dispositivo = ? AND p.inodo = j.value
+            ''', (json.dumps(list(por_inodo)), dispositivo))]
+            if not coincidencias:
+                return []
+            return self._restaurar_perdidos(conn, self._candidatos_movidos(conn, coincidencias, hilos))
+        except sqlite3.Error as e:
+            log.error("Error reconciliando %s: %s", carpeta, e)
+            return []
+    
+    def _restaurar_perdidos(self, conn, por_identidad):
+        """Vuelve a crear, con sus etiquetas, las filas de perdidos que están en por_identidad.
+        
+        por_identidad es {(dispositivo, inodo): (ruta, stat)} de rutas que la
+        base no conoce, como lo devuelve _candidatos_movidos. Se restauran las
+        etiquetas que todavía existen. Devuelve [(ruta_anterior, ruta_nueva)].
+        """
+        if not por_identidad:
+            return []
+        filas = conn.execute('''
+            SELECT p.rowid, p.ruta, p.dispositivo, p.inodo, p.tamano, p.ultima_modificacion, p.etiquetas
+            FROM json_each(?) j
+            JOIN perdidos p
+              ON p.dispositivo = json_extract(j.value, '$[0]')
+             AND p.inodo = json_extract(j.value, '$[1]')
+            ORDER BY p.perdido DESC
+        ''', (json.dumps(list(por_identidad)),)).fetchall()
+        
+        restaurados = []
+        for fila, ruta_anterior, dispositivo, inodo, tamano, mtime, etiquetas in filas:
+            ruta_nueva, st = por_identidad.get((dispositivo, inodo), (None, None))
+            if ruta_nueva is None or not self._es_movimiento(ruta_anterior, tamano, mtime, st):
+                continue
+            del por_identidad[(dispositivo, inodo)]
+            restaurados.append((fila, ruta_anterior, ruta_nueva, st, etiquetas))
+        if not restaurados:
+            return []
+        
+        with self._transaccion() as conn_escritura:
+            for fila, _, ruta_nueva, st, etiquetas in restaurados:
+                conn_escritura.execute('DELETE FROM perdidos WHERE rowid = ?', (fila,))
+                # Si la ruta se etiquetó mientras tanto, se suman las etiquetas a su fila
+                conn_escritura.execute(
+                    'INSERT OR IGNORE INTO archivos (ruta, ultima_modificacion, dispositivo, inodo, tamano) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (ruta_nueva, st.st_mtime, st.st_dev, st.st_ino, st.st_size)
+                )
+                conn_escritura.execute('''
+                    INSERT OR IGNORE INTO archivo_etiqueta (archivo_id, etiqueta_id)
+                    SELECT a.id, e.id
+                    FROM archivos a, etiquetas e
+                    WHERE a.ruta = ? AND e.id IN (SELECT value FROM json_each(?))
+                ''', (ruta_nueva, etiquetas))
+            self._notificar_cambios([ruta_nueva for _, _, ruta_nueva, _, _ in restaurados])
+        log.info("%d archivos perdidos recuperados con sus etiquetas", len(restaurados))
+        return [(ruta_anterior, ruta_nueva) for _, ruta_anterior, ruta_nueva, _, _ in restaurados]
+
+    def _objetos_diferibles(self, conn):
+        """Índices secundarios y triggers por fila que una carga masiva puede rehacer al final"""
+        return conn.execute('''
+            SELECT type, name, sql FROM sqlite_master
+            WHERE sql IS NOT NULL
+            AND (
+                (type = 'index' AND tbl_name IN ('archivos', 'etiquetas', 'archivo_etiqueta'))
+                OR (type = 'trigger' AND tbl_name IN ('archivos', 'archivo_etiqueta'))
+            )
+        ''').fetchall()
+    
+    @instrumentado(filas=lambda resultado: resultado['leidos'])
+    def importar_pares(self, pares, tamano_lote=50000, diferir_indices=True,
+                       comprobar_archivos=False, lotes_por_transaccion=20, progreso=None):
+        """Carga masiva de asignaciones (ruta, etiqueta) desde cualquier iterable.
+        
+        Lee el iterable por lotes de `tamano_lote` pares, así que la memoria no
+        depende del tamaño de la entrada, y los inserta con executemany. Las
+        asignaciones que ya existían se ignoran.
+        
+        Con diferir_indices (por defecto) toda la carga va en una transacción:
+        se quitan los índices secundarios y los triggers de archivos y
+        archivo_etiqueta, se insertan los datos y después se vuelven a crear los
+        índices de una vez y se recalculan etiquetas.total/version y los
+        contadores de las firmas. Los lectores siguen viendo la base anterior,
+        con sus índices, hasta el COMMIT. Sin diferir_indices se confirma cada
+        `lotes_por_transaccion` lotes y los triggers mantienen todo al día,
+        apto para importar sobre una base en uso.
+        
+        Con comprobar_archivos se hace stat() de cada ruta y se omiten las que
+        no existen; si no, los archivos se dan de alta sin identidad y la
+        limpieza la completa más adelante.
+        
+        Devuelve {'leidos', 'asignaciones', 'archivos', 'etiquetas', 'omitidos', 'segundos'}.
+        """
+        inicio = time.perf_counter()
+        resultado = {'leidos': 0, 'asignaciones': 0, 'archivos': 0, 'etiquetas': 0, 'omitidos': 0}
+        
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            if diferir_indices:
+                with self._transaccion() as conn:
+                    diferidos = self._objetos_diferibles(conn)
+                    for tipo, nombre, _ in diferidos:
+                        conn.execute(f'DROP {tipo.upper()} {nombre}')
+                    
+                    for lote in _lotes(pares, tamano_lote):
+                        self._importar_lote(conn, lote, resultado, pool if comprobar_archivos else None)
+                        if progreso is not None:
+                            progreso(resultado['leidos'])
+                    
+                    # Índices de una vez (ordenando, no fila a fila) y triggers de vuelta
+                    for _, _, sql in diferidos:
+                        conn.execute(sql)
+                    self._recalcular_contadores(conn, resultado['archivos'])
+                    if resultado['asignaciones']:
+                        self._notificar_cambios(None)
+            else:
+                lotes = _lotes(pares, tamano_lote)
+                while True:
+                    with self._transaccion() as conn:
+                        procesados = 0
+                        for lote in islice(lotes, lotes_por_transaccion):
+                            self._importar_lote(conn, lote, resultado, pool if comprobar_archivos else None)
+                            procesados += 1
+                        if resultado['asignaciones']:
+                            self._notificar_cambios(None)
+                    if progreso is not None and procesados:
+                        progreso(resultado['leidos'])
+                    if procesados < lotes_por_transaccion:
+                        break
+        
+        if self._indice is not None:
+            self._indice.invalidar()
+        self._conexion().execute('PRAGMA optimize')
+        
+        resultado['segundos'] = time.perf_counter() - inicio
+        log.info("Importados %d pares en %.1f s (+%d asignaciones, +%d archivos, +%d etiquetas, %d omitidos)",
+                 resultado['leidos'], resultado['segundos'], resultado['asignaciones'],
+                 resultado['archivos'], resultado['etiquetas'], resultado['omitidos'])
+        return resultado
+    
+    def _importar_lote(self, conn, lote, resultado, pool=None):
+        """Inserta un lote de pares (ruta, etiqueta) y acumula las cifras en resultado"""
+        resultado['leidos'] += len(lote)
+        validos = [(ruta, etiqueta.strip()) for ruta, etiqueta in lote if ruta and etiqueta and etiqueta.strip()]
+        
+        rutas = list(dict.fromkeys(ruta for ruta, _ in validos))
+        if pool is not None:
+            stats = dict(zip(rutas, pool.map(_stat, rutas)))
+            validos = [(ruta, etiqueta) for ruta, etiqueta in validos if stats[ruta] is not None]
+            filas_archivos = [
+                (ruta, st.st_mtime, st.st_dev, st.st_ino, st.st_size)
+                for ruta, st in stats.items() if st is not None
+            ]
+        else:
+            filas_archivos = [(ruta, 0, None, None, None) for ruta in rutas]
+        resultado['omitidos'] += len(lote) - len(validos)
+        
+        cursor = conn.executemany(
+            'INSERT OR IGNORE INTO archivos (ruta, ultima_modificacion, dispositivo, inodo, tamano) '
+            'VALUES (?, ?, ?, ?, ?)',
+            filas_archivos
+        )
+        resultado['archivos'] += cursor.rowcount
+        cursor = conn.executemany(
+            'INSERT OR IGNORE INTO etiquetas (nombre) VALUES (?)',
+            ((nombre,) for nombre in dict.fromkeys(etiqueta for _, etiqueta in validos))
+        )
+        resultado['etiquetas'] += cursor.rowcount
+        
+        # Ids resueltos en bloque y filas ordenadas por clave: las inserciones en
+        # el árbol de archivo_etiqueta van casi siempre al final, no al azar
+        ids_archivos = dict(conn.execute(
+            'SELECT ruta, id FROM archivos WHERE ruta IN (SELECT value FROM json_each(?))',
+            (json.dumps(rutas),)
+        ))
+        ids_etiquetas = dict(conn.execute(
+            'SELECT nombre, id FROM etiquetas WHERE nombre IN (SELECT value FROM json_each(?))',
+            (json.dumps(list({etiqueta for _, etiqueta in validos})),)
+        ))
+        cursor = conn.executemany(
+            'INSERT OR IGNORE INTO archivo_etiqueta (archivo_id, etiqueta_id) VALUES (?, ?)',
+            sorted({(ids_archivos[ruta], ids_etiquetas[etiqueta]) for ruta, etiqueta in validos})
+        )
+        resultado['asignaciones'] += cursor.rowcount
+    
+    def _recalcular_contadores(self, conn, archivos_nuevos):
+        """Rehace lo que mantienen los triggers diferidos en una carga masiva"""
+        # Solo cambian (y cambian de versión) las etiquetas cuyo total no cuadra
+        conn.execute('''
+            UPDATE etiquetas SET version = version + 1, total = c.n
+            FROM (
+                SELECT etiqueta_id, COUNT(*) AS n FROM archivo_etiqueta GROUP BY etiqueta_id
+            ) c
+            WHERE c.etiqueta_id = etiquetas.id AND etiquetas.total != c.n
+        ''')
+        if archivos_nuevos:
+            conn.execute("UPDATE estado SET valor = valor + 1 WHERE clave = 'version_archivos'")
+    
+    def iterar_asignaciones(self, tamano_pagina=10000):
+        """Recorre todas las asignaciones como (ruta, [etiquetas]) por páginas de archivos.
+        
+        Paginación por clave sobre archivos.id, como iterar_por_etiquetas: la
+        memoria no depende del tamaño de la base. Los archivos sin etiquetas
+        no aparecen.
+        """
+        conn = self._conexion()
+        desde = 0
+        while True:
+            # Último id de la página; puede haber páginas sin etiquetas que no son la última
+            hasta = conn.execute(
+                'SELECT MAX(id) FROM (SELECT id FROM archivos WHERE id > ? ORDER BY id LIMIT ?)',
+                (desde, tamano_pagina)
+            ).fetchone()[0]
+            if hasta is None:
+                return
+            filas = conn.execute('''
+                SELECT ae.archivo_id, a.ruta, e.nombre
+                FROM archivo_etiqueta ae
+                JOIN archivos a ON a.id = ae.archivo_id
+                JOIN etiquetas e ON e.id = ae.etiqueta_id
+                WHERE ae.archivo_id > ? AND ae.archivo_id <= ?
+                ORDER BY ae.archivo_id, e.nombre
+            ''', (desde, hasta))
+            
+            archivo_actual, ruta_actual, etiquetas = None, None, []
+            for archivo_id, ruta, nombre in filas:
+                if archivo_id != archivo_actual:
+                    if etiquetas:
+                        yield ruta_actual, etiquetas
+                    archivo_actual, ruta_actual, etiquetas = archivo_id, ruta, []
+                etiquetas.append(nombre)
+            if etiquetas:
+                yield ruta_actual, etiquetas
+            desde = hasta
+    
+    @instrumentado()
     def obtener_todas_etiquetas_archivo(self, ruta_archivo):
         """Obtiene todas las etiquetas de un archivo con mejor manejo de errores"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute('''
-                    SELECT t.nombre, t.color 
-                    FROM etiquetas t
-                    JOIN archivo_etiqueta ae ON t.id = ae.etiqueta_id
-                    JOIN archivos a ON a.id = ae.archivo_id
-                    WHERE a.ruta = ?
-                ''', (ruta_archivo,))
-                
-                resultado = [{'nombre': row[0], 'color': row[1]} for row in cursor]
-                print(f"🔍 Obtenidas {len(resultado)} etiquetas para {os.path.basename(ruta_archivo)}")
-                return resultado
+            cursor = self._conexion().execute('''
+                SELECT t.nombre, t.color 
+                FROM etiquetas t
+                JOIN archivo_etiqueta ae ON t.id = ae.etiqueta_id
+                JOIN archivos a ON a.id = ae.archivo_id
+                WHERE a.ruta = ?
+            ''', (ruta_archivo,))
+            
+            resultado = [{'nombre': row[0], 'color': row[1]} for row in cursor]
+            return resultado
         except Exception as e:
-            print(f"❌ Error obteniendo etiquetas: {e}")
+            log.error("Error obteniendo etiquetas de %s: %s", ruta_archivo, e)
             return []
@@ -0,0 +1,154 @@
+import json
+import re
+import threading
+from collections import OrderedDict
+
+# Posiciones de los bits activos de cada valor de byte
+_BITS_POR_BYTE = [tuple(bit for bit in range(8) if valor >> bit & 1) for valor in range(256)]
+_TRAMOS_NO_NULOS = re.compile(rb'[^\x00]+')
+
+
+def crear_mapa_bits(ids):
+    """Construye un mapa de bits (entero de Python) a partir de ids de archivo"""
+    if not ids:
+        return 0
+    datos = bytearray(max(ids) // 8 + 1)
+    for archivo_id in ids:
+        datos[archivo_id >> 3] |= 1 << (archivo_id & 7)
+    return int.from_bytes(datos, 'little')
+
+
+def contar_bits(mapa_bits):
+    """Cuenta los ids activos de un mapa de bits"""
+    if hasattr(mapa_bits, 'bit_count'):
+        return mapa_bits.bit_count()
+    return bin(mapa_bits).count('1')  # Python < 3.10
+
+
+def iterar_ids(mapa_bits, desde=0):
+    """Recorre en orden ascendente los ids activos de un mapa de bits (>= desde)"""
+    if desde > 0:
+        mapa_bits &= ~((1 << desde) - 1)
+    if not mapa_bits:
+        return
+    datos = mapa_bits.to_bytes((mapa_bits.bit_length() + 7) // 8, 'little')
+    # Saltar los bytes a cero se hace en C con la expresión regular
+    for tramo in _TRAMOS_NO_NULOS.finditer(datos):
+        for posicion in range(tramo.start(), tramo.end()):
+            base = posicion << 3
+            for bit in _BITS_POR_BYTE[datos[posicion]]:
+                yield base + bit
+
+
+class IndiceInvertido:
+    """Índice en memoria etiqueta → mapa de bits de ids de archivo.
+
+    Las listas de cada etiqueta se cargan bajo demanda en la primera búsqueda
+    que las necesita y se guardan junto a la columna etiquetas.version, que los
+    triggers de archivo_etiqueta incrementan con cada cambio. Cuando
+    PRAGMA data_version indica que otra conexión ha escrito, solo se descartan
+    las etiquetas cuya versión ya no coincide.
+    """
+
+    def __init__(self, gestor, max_etiquetas=256):
+        self._gestor = gestor
+        self._max_etiquetas = max_etiquetas
+        self._lock = threading.Lock()
+        self._conn = None
+        self._data_version = None
+        # etiqueta_id -> (version, mapa_bits), en orden de uso (LRU)
+        self._listas = OrderedDict()
+
+    def _conexion(self):
+        """Conexión propia de solo lectura: su data_version refleja las escrituras de las demás"""
+        if self._conn is None:
+            self._conn = self._gestor._conectar()
+        return self._conn
+
+    def _sincronizar(self, conn):
+        """Descarta las listas modificadas por otras conexiones desde la última consulta"""
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+        if not self._listas:
+            return
+        cursor = conn.execute(
+            'SELECT id, version FROM etiquetas WHERE id IN (SELECT value FROM json_each(?))',
+            (json.dumps(list(self._listas)),)
+        )
+        versiones = dict(cursor.fetchall())
+        for etiqueta_id, (version, _) in list(self._listas.items()):
+            if versiones.get(etiqueta_id) != version:
+                del self._listas[etiqueta_id]
+
+    def _lista(self, conn, etiqueta_id):
+        """Devuelve el mapa de bits de una etiqueta, cargándolo si hace falta"""
+        entrada = self._listas.get(etiqueta_id)
+        if entrada is None:
+            # Versión y contenido se leen en la misma instantánea
+            conn.execute('BEGIN')
+            try:
+                fila = conn.execute('SELECT version FROM etiquetas WHERE id = ?', (etiqueta_id,)).fetchone()
+                ids = [row[0] for row in conn.execute(
+                    'SELECT archivo_id FROM archivo_etiqueta WHERE etiqueta_id = ?', (etiqueta_id,)
+                )]
+            finally:
+                conn.execute('COMMIT')
+            entrada = (fila[0] if fila else None, crear_mapa_bits(ids))
+            self._listas[etiqueta_id] = entrada
+            while len(self._listas) > self._max_etiquetas:
+                self._listas.popitem(last=False)
+        else:
+            self._listas.move_to_end(etiqueta_id)
+        return entrada[1]
+
+    def buscar(self, ids_etiquetas, operador='AND'):
+        """Devuelve el mapa de bits de los archivos que cumplen la búsqueda"""
+        if not ids_etiquetas:
+            return 0
+        with self._lock:
+            conn = self._conexion()
+            self._sincronizar(conn)
+            mapas = [self._lista(conn, etiqueta_id) for etiqueta_id in ids_etiquetas]
+        resultado = mapas[0]
+        for mapa in mapas[1:]:
+            resultado = resultado & mapa if operador == 'AND' else resultado | mapa
+        return resultado
+
+    def aplicar_cambios(self, archivo_id, agregadas, eliminadas, versiones_antes, versiones_despues):
+        """Aplica a las listas cargadas el cambio que acaba de confirmar el gestor"""
+        with self._lock:
+            for etiqueta_id, agregar in [(e, True) for e in agregadas] + [(e, False) for e in eliminadas]:
+                entrada = self._listas.get(etiqueta_id)
+                if entrada is None:
+                    continue
+                version, mapa = entrada
+                if version == versiones_despues.get(etiqueta_id):
+                    continue  # Ya se cargó con el cambio incluido
+                if version != versiones_antes.get(etiqueta_id):
+                    del self._listas[etiqueta_id]  # Hubo otro cambio entre medias
+                    continue
+                if agregar:
+                    mapa |= 1 << archivo_id
+                else:
+                    mapa &= ~(1 << archivo_id)
+                self._listas[etiqueta_id] = (versiones_despues.get(etiqueta_id), mapa)
+
+    def invalidar(self, ids_etiquetas=None):
+        """Descarta las listas indicadas (o todas) para recargarlas en la próxima búsqueda"""
+        with self._lock:
+            if ids_etiquetas is None:
+                self._listas.clear()
+            else:
+                for etiqueta_id in ids_etiquetas:
+                    self._listas.pop(etiqueta_id, None)
+
+    def close(self):
+        """Libera la memoria y la conexión del índice"""
+        with self._lock:
+            self._listas.clear()
+            self._data_version = None
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -10,6 +10,14 @@ cp __init__.py ~/.local/share/nemo-python/extensions/nemo-etiquetas/
 cp nemo_etiquetas.py ~/.local/share/nemo-python/extensions/
 cp gestor_etiquetas.py ~/.local/share/nemo-python/extensions/nemo-etiquetas/
 cp dialogo_etiquetas.py ~/.local/share/nemo-python/extensions/nemo-etiquetas/
+cp indice_etiquetas.py ~/.local/share/nemo-python/extensions/nemo-etiquetas/
+cp consulta_etiquetas.py ~/.local/share/nemo-python/extensions/nemo-etiquetas/
+cp cache_carpetas.py ~/.local/share/nemo-python/extensions/nemo-etiquetas/
+cp tareas_etiquetas.py ~/.local/share/nemo-python/extensions/nemo-etiquetas/
+cp cache_busquedas.py ~/.local/share/nemo-python/extensions/nemo-etiquetas/
+cp intercambio_etiquetas.py ~/.local/share/nemo-python/extensions/nemo-etiquetas/
+cp etiquetas_cli.py ~/.local/share/nemo-python/extensions/nemo-etiquetas/
+cp registro_etiquetas.py ~/.local/share/nemo-python/extensions/nemo-etiquetas/
 
 # Dar permisos
 chmod +x ~/.local/share/nemo-python/extensions/nemo_etiquetas.py
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Importación y exportación masiva de etiquetas en JSONL o CSV.
+
+Formatos (UTF-8; las rutas que no lo son se conservan con surrogateescape):
+  - JSONL: un objeto por línea, {"ruta": ..., "etiquetas": [...]} o
+    {"ruta": ..., "etiqueta": ...}. La exportación usa la primera forma.
+  - CSV: filas ruta,etiqueta, con cabecera opcional "ruta,etiqueta".
+
+Todo se procesa en streaming: la memoria no depende del tamaño del archivo.
+
+Uso: python3 intercambio_etiquetas.py importar|exportar ARCHIVO [--formato jsonl|csv]
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+
+from gestor_etiquetas import GestorEtiquetasSQLite
+from registro_etiquetas import VARIABLE_NIVEL, configurar_registro
+
+FORMATOS = ('jsonl', 'csv')
+
+
+class ErrorFormato(ValueError):
+    """Línea o fila que no se puede interpretar"""
+
+
+def detectar_formato(ruta_archivo):
+    """Deduce el formato por la extensión (.csv o, si no, JSONL)"""
+    return 'csv' if ruta_archivo.lower().endswith('.csv') else 'jsonl'
+
+
+def leer_pares_jsonl(lineas):
+    """Genera (ruta, etiqueta) a partir de líneas JSONL"""
+    for numero, linea in enumerate(lineas, 1):
+        if not linea.strip():
+            continue
+        try:
+            objeto = json.loads(linea)
+            ruta = objeto['ruta']
+            etiquetas = objeto['etiquetas'] if 'etiquetas' in objeto else [objeto['etiqueta']]
+        except (ValueError, KeyError, TypeError) as e:
+            raise ErrorFormato(f"línea {numero}: {e}") from None
+        if isinstance(etiquetas, str):
+            etiquetas = [etiquetas]
+        # Solo texto: un número o null llegaría a la base como otra ruta u otra etiqueta
+        if not isinstance(ruta, str):
+            raise ErrorFormato(f"línea {numero}: la ruta debe ser texto, no {json.dumps(ruta)}")
+        if not isinstance(etiquetas, list):
+            raise ErrorFormato(f"línea {numero}: las etiquetas deben ser una lista de textos")
+        for etiqueta in etiquetas:
+            if not isinstance(etiqueta, str):
+                raise ErrorFormato(f"línea {numero}: las etiquetas deben ser texto, no {json.dumps(etiqueta)}")
+            yield ruta, etiqueta
+
+
+def leer_pares_csv(lineas):
+    """Genera (ruta, etiqueta) a partir de filas CSV ruta,etiqueta"""
+    for numero, fila in enumerate(csv.reader(lineas), 1):
+        if not fila:
+            continue
+        if len(fila) != 2:
+            raise ErrorFormato(f"fila {numero}: se esperaban 2 columnas y hay {len(fila)}")
+        if numero == 1 and fila == ['ruta', 'etiqueta']:
+            continue
+        yield fila[0], fila[1]
+
+
+def importar(gestor, ruta_archivo, formato=None, **opciones):
+    """Importa un archivo JSONL o CSV con importar_pares; devuelve sus cifras"""
+    formato = formato or detectar_formato(ruta_archivo)
+    leer = leer_pares_csv if formato == 'csv' else leer_pares_jsonl
+    with open(ruta_archivo, encoding='utf-8', errors='surrogateescape', newline='') as f:
+        return gestor.importar_pares(leer(f), **opciones)
+
+
+def exportar(gestor, ruta_archivo, formato=None):
+    """Exporta todas las asignaciones a JSONL o CSV; devuelve el número de archivos"""
+    formato = formato or detectar_formato(ruta_archivo)
+    archivos = 0
+    temporal = ruta_archivo + '.tmp'
+    with open(temporal, 'w', encoding='utf-8', errors='surrogateescape', newline='') as f:
+        if formato == 'csv':
+            escritor = csv.writer(f)
+            escritor.writerow(['ruta', 'etiqueta'])
+            for ruta, etiquetas in gestor.iterar_asignaciones():
+                escritor.writerows((ruta, etiqueta) for etiqueta in etiquetas)
+                archivos += 1
+        else:
+            for ruta, etiquetas in gestor.iterar_asignaciones():
+                f.write(json.dumps({'ruta': ruta, 'etiquetas': etiquetas}, ensure_ascii=False) + '\n')
+                archivos += 1
+    # Nunca dejar una exportación a medias con el nombre final
+    os.replace(temporal, ruta_archivo)
+    return archivos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('accion', choices=('importar', 'exportar'))
+    parser.add_argument('archivo')
+    parser.add_argument('--formato', choices=FORMATOS)
+    parser.add_argument('--db', help="base de datos (por defecto la de la extensión)")
+    parser.add_argument('--comprobar-archivos', action='store_true',
+                        help="omitir las rutas que no existen en este equipo")
+    parser.add_argument('--sin-diferir-indices', action='store_true',
+                        help="mantener índices y triggers durante la carga (base en uso)")
+    args = parser.parse_args()
+    # El resumen de importar_pares se registra como INFO
+    configurar_registro(os.environ.get(VARIABLE_NIVEL) or 'INFO', formato='%(message)s')
+
+    with GestorEtiquetasSQLite(args.db) as gestor:
+        if args.accion == 'exportar':
+            archivos = exportar(gestor, args.archivo, args.formato)
+            print(f"📤 Exportados {archivos} archivos a {args.archivo}")
+            return 0
+        try:
+            resultado = importar(
+                gestor, args.archivo, args.formato,
+                diferir_indices=not args.sin_diferir_indices,
+                comprobar_archivos=args.comprobar_archivos,
+                progreso=lambda leidos: print(f"  … {leidos} pares", file=sys.stderr)
+            )
+        except ErrorFormato as e:
+            deshecho = "no se ha importado nada" if not args.sin_diferir_indices else "importación interrumpida"
+            print(f"❌ {args.archivo}: {e}; {deshecho}", file=sys.stderr)
+            return 1
+        if resultado['segundos']:
+            print(f"⏱️ {resultado['leidos'] / resultado['segundos']:.0f} pares/s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,33 +5,154 @@ gi.require_version('Nemo', '3.0')
 gi.require_version('Gtk', '3.0')
 gi.require_version('Gdk', '3.0')
 
-from gi.repository import Nemo, GObject, Gtk, Gdk
+from gi.repository import Nemo, GObject, Gtk, Gdk, GLib
 import os
 import sys
+import signal
+import logging
 import subprocess
+import threading
+import json
 
 # IMPORTANTE: Añade la ruta a la carpeta nemo-etiquetas donde están los otros módulos
 extension_dir = os.path.join(os.path.dirname(__file__), 'nemo-etiquetas')
 sys.path.insert(0, extension_dir)
 
+log = logging.getLogger('etiquetas.nemo')
+
+# Los diálogos GTK se importan en su primer uso (mostrar_dialogo_etiquetas)
 try:
     from gestor_etiquetas import GestorEtiquetasSQLite
-    from dialogo_etiquetas import DialogoEtiquetas
+    from tareas_etiquetas import ejecutar_en_segundo_plano
+    from cache_carpetas import CacheCarpetas
+    from cache_busquedas import (
+        IndiceBusquedas, actualizar_enlaces, escribir_metadata, materializar_enlaces, uso_disco
+    )
+    from consulta_etiquetas import (
+        ErrorConsulta, analizar_consulta, contiene_negacion, etiquetas_de, normalizar_consulta
+    )
+    from registro_etiquetas import configurar_registro, metricas
+    # Nivel con NEMO_ETIQUETAS_LOG; por defecto solo avisos y errores
+    configurar_registro()
     MODULOS_CARGADOS = True
-    print("✅ ETIQUETAS: Módulos cargados correctamente")
+    log.debug("Módulos cargados correctamente")
 except ImportError as e:
-    print(f"❌ ETIQUETAS: Error importando módulos: {e}")
+    log.error("Error importando módulos: %s", e)
     MODULOS_CARGADOS = False
 
-class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
+# Espera tras la última pulsación antes de filtrar la lista de etiquetas
+RETARDO_FILTRO_MS = 150
+
+# Etiquetas que deja visibles el filtro: las mejores coincidencias, no todas
+MAX_ETIQUETAS_FILTRO = 500
+
+# Columnas del modelo de etiquetas del buscador
+COL_NOMBRE, COL_CONTADOR = range(2)
+
+# Segundos tras el arranque antes de limpiar el caché de búsquedas
+RETARDO_LIMPIEZA_S = 10
+
+def _entero_entorno(nombre, defecto):
+    """Lee un entero de una variable de entorno, o el valor por defecto"""
+    try:
+        return int(os.environ[nombre])
+    except (KeyError, ValueError):
+        return defecto
+
+# Límites del caché de búsquedas; se desaloja de la menos usada a la más reciente
+MAX_BUSQUEDAS_CACHE = _entero_entorno("NEMO_ETIQUETAS_CACHE_BUSQUEDAS", 10)
+MAX_MB_CACHE = _entero_entorno("NEMO_ETIQUETAS_CACHE_MB", 256)
+MAX_DIAS_CACHE = _entero_entorno("NEMO_ETIQUETAS_CACHE_DIAS", 30)
+
+# Emblema (del tema de iconos) de los archivos con etiquetas
+EMBLEMA_ETIQUETADO = "emblem-default"
+
+# Atributo de NemoFileInfo que muestra la columna "Etiquetas" de la vista de lista
+ATRIBUTO_ETIQUETAS = "etiquetas"
+
+class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider, Nemo.InfoProvider, Nemo.ColumnProvider):
     def __init__(self):
-        print("Inicializando extensión de etiquetas...")
-        self.gestor = GestorEtiquetasSQLite()
-        self.cargar_estilos()
-        self.limpiar_cache_antiguo()
+        # Arranque sin E/S: la base, el CSS y la limpieza se preparan al usarlos
+        log.debug("Inicializando extensión de etiquetas")
+        self._gestor = None
+        self._cache_carpetas = None
+        self._indice_busquedas = None
+        # La base puede abrirse a la vez desde varios trabajos de fondo
+        self._apertura = threading.Lock()
+        self.estilos_cargados = False
+        # Una sola limpieza del caché a la vez
+        self.limpieza_en_curso = threading.Lock()
+        # carpeta -> [(provider, handle, closure, file)] esperando a que se cargue
+        self.pendientes_carpetas = {}
+        if MODULOS_CARGADOS:
+            GLib.timeout_add_seconds(RETARDO_LIMPIEZA_S, self.programar_limpieza_cache)
+            if metricas.activas:
+                # kill -USR1 <pid de nemo> vuelca las métricas sin parar Nemo
+                GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, self.volcar_metricas)
+    
+    @property
+    def gestor(self):
+        """Gestor de etiquetas, abierto en el primer uso"""
+        if self._gestor is None:
+            with self._apertura:
+                if self._gestor is None:
+                    # Índice invertido en memoria para que las búsquedas no vuelvan a SQLite cada vez
+                    gestor = GestorEtiquetasSQLite(usar_indice=True)
+                    gestor.agregar_oyente(self.on_etiquetas_modificadas)
+                    self._gestor = gestor
+        return self._gestor
+    
+    @property
+    def cache_carpetas(self):
+        """Etiquetas por carpeta para los emblemas: una consulta por carpeta, no por archivo"""
+        if self._cache_carpetas is None:
+            gestor = self.gestor
+            with self._apertura:
+                if self._cache_carpetas is None:
+                    self._cache_carpetas = CacheCarpetas(gestor)
+        return self._cache_carpetas
+    
+    @property
+    def indice_busquedas(self):
+        """Índice de las carpetas de resultados del caché de búsquedas"""
+        if self._indice_busquedas is None:
+            with self._apertura:
+                if self._indice_busquedas is None:
+                    self._indice_busquedas = IndiceBusquedas(os.path.expanduser("~/.cache/nemo-etiquetas"))
+        return self._indice_busquedas
+    
+    def volcar_metricas(self):
+        """Escribe las métricas de rendimiento en su archivo (NEMO_ETIQUETAS_METRICAS)"""
+        try:
+            log.info("Métricas volcadas en %s", metricas.volcar())
+        except OSError as e:
+            log.error("Error volcando métricas: %s", e)
+        return True  # Mantener el manejador de la señal
+    
+    def programar_limpieza_cache(self):
+        """Primera limpieza tras el arranque: también barre las carpetas huérfanas"""
+        self.lanzar_limpieza_cache(barrer=True)
+        return False  # Una sola vez
+    
+    def lanzar_limpieza_cache(self, barrer=False, proteger=()):
+        """Limpia el caché de búsquedas en un hilo aparte, sin bloquear Nemo"""
+        if self._indice_busquedas is None:
+            # El índice (y sus tablas) se abre en un trabajo de fondo, no en el hilo de GTK
+            ejecutar_en_segundo_plano(
+                lambda: self.indice_busquedas,
+                lambda indice: self.lanzar_limpieza_cache(barrer, proteger)
+            )
+            return
+        threading.Thread(
+            target=self.limpiar_cache_antiguo, args=(barrer, proteger),
+            name='etiquetas-limpieza', daemon=True
+        ).start()
     
     def cargar_estilos(self):
-        """Carga los estilos CSS para la aplicación"""
+        """Carga los estilos CSS para la aplicación (una sola vez, al abrir el primer diálogo)"""
+        if self.estilos_cargados:
+            return
+        self.estilos_cargados = True
         css = """
         .chip {
             border-radius: 12px;
@@ -57,25 +178,110 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
         if not MODULOS_CARGADOS:
             return []
             
-        if len(files) != 1:
-            return []
-        
         # Solo mostrar para archivos regulares, no directorios
-        file = files[0]
-        if file.is_directory():
+        archivos = [f for f in files if not f.is_directory()]
+        if not archivos:
             return []
         
-        print(f"✅ ETIQUETAS: Creando menú para {file.get_name()}")
-        
-        item = Nemo.MenuItem(
-            name="EtiquetasExtension::GestionarEtiquetas",
-            label="🏷️ Gestionar Etiquetas",
-            tip="Añadir o quitar etiquetas del archivo"
-        )
+        if len(archivos) == 1:
+            log.debug("Creando menú para %s", archivos[0].get_name())
+            item = Nemo.MenuItem(
+                name="EtiquetasExtension::GestionarEtiquetas",
+                label="🏷️ Gestionar Etiquetas",
+                tip="Añadir o quitar etiquetas del archivo"
+            )
+        else:
+            # Selección múltiple: un único diálogo y una única transacción
+            item = Nemo.MenuItem(
+                name="EtiquetasExtension::GestionarEtiquetasLote",
+                label=f"🏷️ Gestionar Etiquetas ({len(archivos)} archivos)",
+                tip="Añadir o quitar etiquetas de todos los archivos seleccionados"
+            )
         # Pasar la ventana como parámetro adicional
-        item.connect('activate', self.mostrar_dialogo_etiquetas, window, files[0])
+        item.connect('activate', self.mostrar_dialogo_etiquetas, window, archivos)
         return [item]
     
+    def get_columns(self):
+        """Columna "Etiquetas" de la vista de lista (Nemo la ordena por su texto)"""
+        return [Nemo.Column(
+            name="EtiquetasExtension::columna_etiquetas",
+            attribute=ATRIBUTO_ETIQUETAS,
+            label="Etiquetas",
+            description="Etiquetas asignadas al archivo"
+        )]
+    
+    def update_file_info_full(self, provider, handle, closure, file):
+        """Añade emblema y columna de etiquetas; la carpeta se lee en segundo plano"""
+        if not MODULOS_CARGADOS or file.get_uri_scheme() != 'file':
+            return Nemo.OperationResult.COMPLETE
+        
+        ruta = file.get_location().get_path()
+        carpeta = os.path.dirname(ruta)
+        # Sin caché todavía no se toca la base aquí: abrirla (y migrarla tras una
+        # actualización) le toca al trabajo de fondo, no al hilo de GTK
+        cache = self._cache_carpetas
+        etiquetas_carpeta = cache.obtener(carpeta) if cache is not None else None
+        if etiquetas_carpeta is not None:
+            self.aplicar_info_etiquetas(file, etiquetas_carpeta.get(ruta))
+            return Nemo.OperationResult.COMPLETE
+        
+        # Todos los archivos de la carpeta esperan a la misma consulta
+        pendientes = self.pendientes_carpetas.setdefault(carpeta, [])
+        pendientes.append((provider, handle, closure, file))
+        if len(pendientes) == 1:
+            ejecutar_en_segundo_plano(
+                lambda: self.cache_carpetas.cargar(carpeta),
+                lambda etiquetas: self.on_carpeta_cargada(carpeta, etiquetas),
+                lambda error: self.on_carpeta_fallida(carpeta, error)
+            )
+        return Nemo.OperationResult.IN_PROGRESS
+    
+    def cancel_update(self, provider, handle):
+        """Nemo ya no necesita la información pedida con este handle"""
+        for carpeta, pendientes in list(self.pendientes_carpetas.items()):
+            # PyGObject crea un envoltorio nuevo por llamada: `is` nunca coincide,
+            # pero la igualdad de los boxed compara el puntero de C
+            restantes = [p for p in pendientes if p[1] != handle]
+            if len(restantes) != len(pendientes):
+                # Se mantiene la entrada (aunque quede vacía) hasta que la carga termine
+                self.pendientes_carpetas[carpeta] = restantes
+    
+    def on_carpeta_cargada(self, carpeta, etiquetas_carpeta):
+        """Completa en el hilo de GTK las peticiones que esperaban a la carpeta"""
+        for provider, handle, closure, file in self.pendientes_carpetas.pop(carpeta, []):
+            self.aplicar_info_etiquetas(file, etiquetas_carpeta.get(file.get_location().get_path()))
+            Nemo.info_provider_update_complete_invoke(
+                closure, provider, handle, Nemo.OperationResult.COMPLETE
+            )
+    
+    def on_carpeta_fallida(self, carpeta, error):
+        """La carpeta no se pudo leer: se completan las peticiones sin etiquetas"""
+        log.error("Error leyendo las etiquetas de %s: %s", carpeta, error)
+        self.on_carpeta_cargada(carpeta, {})
+    
+    def aplicar_info_etiquetas(self, file, etiquetas):
+        """Marca con un emblema los archivos con etiquetas y rellena la columna"""
+        if etiquetas:
+            file.add_emblem(EMBLEMA_ETIQUETADO)
+        # Siempre con valor: sin atributo Nemo mostraría la celda como desconocida
+        file.add_string_attribute(ATRIBUTO_ETIQUETAS, ", ".join(etiquetas or []))
+    
+    def on_etiquetas_modificadas(self, rutas):
+        """Oyente del gestor (en el hilo que escribió): refrescar los emblemas afectados"""
+        GLib.idle_add(self.refrescar_emblemas, rutas)
+    
+    def refrescar_emblemas(self, rutas):
+        """Pide a Nemo que vuelva a consultar los archivos modificados que tenga cargados"""
+        if rutas is None:
+            # Cambio masivo (importación): el caché por carpeta ya se vació y no
+            # hay forma de invalidar todo Nemo; se verá al recargar cada carpeta
+            return False
+        for ruta in rutas:
+            file = Nemo.FileInfo.lookup_for_uri(GLib.filename_to_uri(ruta, None))
+            if file is not None:
+                file.invalidate_extension_info()
+        return False  # No repetir el idle
+    
     def get_background_items(self, window, file):
         """Items del menú para fondo del directorio"""
         if not MODULOS_CARGADOS:
@@ -91,11 +297,29 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
         
         return [item_buscar]
     
-    def mostrar_dialogo_etiquetas(self, menu, window, file):
+    def on_base_fallida(self, error):
+        """La base de etiquetas no se pudo abrir o leer en segundo plano"""
+        log.error("Error accediendo a la base de etiquetas: %s", error)
+    
+    def mostrar_dialogo_etiquetas(self, menu, window, files):
         """Muestra el diálogo de gestión de etiquetas"""
+        if self._gestor is None:
+            # Primer uso: la base se abre (y migra) en un trabajo de fondo
+            ejecutar_en_segundo_plano(
+                lambda: self.gestor,
+                lambda gestor: self.mostrar_dialogo_etiquetas(menu, window, files),
+                self.on_base_fallida
+            )
+            return
         try:
-            ruta = file.get_location().get_path()
-            print(f"✅ ETIQUETAS: Abriendo diálogo para {ruta}")
+            # Primer uso: importar el diálogo e instalar sus estilos
+            from dialogo_etiquetas import DialogoEtiquetas
+            self.cargar_estilos()
+            
+            rutas = [f.get_location().get_path() for f in files]
+            # Un archivo: ruta simple; varios: lista de rutas
+            ruta = rutas[0] if len(rutas) == 1 else rutas
+            log.debug("Abriendo diálogo para %d archivo(s)", len(rutas))
             
             # SOLUCIÓN ROBUSTA: Manejar cuando window es None
             parent = None
@@ -105,7 +329,7 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
                 if isinstance(window, Gtk.Window):
                     parent = window
                 else:
-                    print("⚠️  ETIQUETAS: Window no es una ventana Gtk válida")
+                    log.warning("Window no es una ventana Gtk válida")
             
             # Si no tenemos ventana padre, buscar entre las ventanas abiertas
             if parent is None:
@@ -117,52 +341,55 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
                         break
             
             if parent is None:
-                print("⚠️  ETIQUETAS: Abriendo diálogo sin ventana padre")
+                log.info("Abriendo diálogo sin ventana padre")
             else:
-                print(f"✅ ETIQUETAS: Usando ventana padre: {parent.get_title()}")
+                log.debug("Usando ventana padre: %s", parent.get_title())
             
             dialogo = DialogoEtiquetas(parent, self.gestor, ruta)
             response = dialogo.run()
             
             if response == Gtk.ResponseType.OK:
-                print("✅ ETIQUETAS: Diálogo cerrado con Guardar")
+                log.debug("Diálogo cerrado con Guardar")
             else:
-                print("✅ ETIQUETAS: Diálogo cerrado con Cancelar")
+                log.debug("Diálogo cerrado con Cancelar")
                 
         except Exception as e:
-            print(f"❌ ETIQUETAS: Error mostrando diálogo: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("Error mostrando diálogo: %s", e)
             
             # Fallback: intentar abrir el diálogo sin ventana padre
             try:
-                print("🔄 ETIQUETAS: Intentando fallback sin ventana padre...")
+                log.info("Intentando fallback sin ventana padre")
                 dialogo = DialogoEtiquetas(None, self.gestor, ruta)
                 dialogo.run()
             except Exception as e2:
-                print(f"❌ ETIQUETAS: Fallback también falló: {e2}")
+                log.error("Fallback también falló: %s", e2)
     
     
     def buscar_archivos_por_etiqueta(self, etiqueta):
         """Busca archivos que tengan una etiqueta específica"""
         try:
             archivos = self.gestor.buscar_por_etiquetas([etiqueta], operador='OR')
-            print(f"🔍 Encontrados {len(archivos)} archivos con etiqueta '{etiqueta}':")
-            for archivo in archivos:
-                print(f"  📄 {os.path.basename(archivo)}")
+            log.debug("Encontrados %d archivos con etiqueta '%s'", len(archivos), etiqueta)
             return archivos
         except Exception as e:
-            print(f"❌ Error buscando archivos: {e}")
+            log.error("Error buscando archivos: %s", e)
             return []
 
     def mostrar_buscador_etiquetas(self, menu, window, file):
         """Muestra el diálogo de búsqueda por etiquetas con filtro en tiempo real"""
+        log.debug("Abriendo buscador de etiquetas")
+        # La base se abre (y migra, la primera vez) y se lee fuera del hilo de GTK
+        ejecutar_en_segundo_plano(
+            lambda: self.gestor.obtener_todas_etiquetas(),
+            lambda etiquetas: self.construir_buscador_etiquetas(window, etiquetas),
+            self.on_base_fallida
+        )
+    
+    def construir_buscador_etiquetas(self, window, etiquetas):
+        """Crea el diálogo de búsqueda con las etiquetas ya leídas"""
         try:
-            print("🔍 Abriendo buscador de etiquetas mejorado...")
-            
-            # Obtener todas las etiquetas disponibles
-            self.todas_etiquetas = self.gestor.obtener_todas_etiquetas()
-            print(f"🔍 Etiquetas disponibles: {[e['nombre'] for e in self.todas_etiquetas]}")
+            self.todas_etiquetas = etiquetas
+            log.debug("Etiquetas disponibles: %d", len(self.todas_etiquetas))
             
             # Crear diálogo de búsqueda
             dialogo_busqueda = Gtk.Dialog(
@@ -186,6 +413,9 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
             self.entry_buscar.set_placeholder_text("Escribe para filtrar etiquetas...")
             self.entry_buscar.set_hexpand(True)
             self.entry_buscar.connect("changed", self.on_filtrar_etiquetas)
+            self.texto_filtro = ""
+            self.coincidencias_filtro = set()
+            self.filtro_pendiente = None
             
             box_busqueda.pack_start(label_buscar, False, False, 0)
             box_busqueda.pack_start(self.entry_buscar, True, True, 0)
@@ -198,18 +428,42 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
             frame_etiquetas.set_margin_end(10)
             frame_etiquetas.set_margin_bottom(10)
             
-            # ListBox para etiquetas (ahora con doble clic para buscar)
-            self.listbox_etiquetas = Gtk.ListBox()
-            self.listbox_etiquetas.set_selection_mode(Gtk.SelectionMode.SINGLE)
-            self.listbox_etiquetas.connect("row-activated", self.on_etiqueta_seleccionada)
-            
-            # Llenar la lista inicial
-            self.actualizar_lista_etiquetas(self.todas_etiquetas)
+            # Lista de etiquetas sobre un modelo: se llena una vez y el filtro solo
+            # cambia qué filas son visibles (doble clic para buscar)
+            self.modelo_etiquetas = self.crear_modelo_etiquetas(self.todas_etiquetas)
+            self.filtro_etiquetas = self.modelo_etiquetas.filter_new()
+            self.filtro_etiquetas.set_visible_func(self.etiqueta_visible)
+            
+            self.vista_etiquetas = Gtk.TreeView(model=self.filtro_etiquetas)
+            self.vista_etiquetas.set_headers_visible(False)
+            self.vista_etiquetas.set_enable_search(False)
+            self.vista_etiquetas.set_fixed_height_mode(True)
+            self.vista_etiquetas.get_selection().set_mode(Gtk.SelectionMode.SINGLE)
+            self.vista_etiquetas.connect("row-activated", self.on_etiqueta_seleccionada)
+            
+            columna = Gtk.TreeViewColumn()
+            columna.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            columna.set_expand(True)
+            # Icono de etiqueta
+            render_icono = Gtk.CellRendererPixbuf(icon_name="tag-symbolic")
+            columna.pack_start(render_icono, False)
+            render_nombre = Gtk.CellRendererText(ypad=5)
+            columna.pack_start(render_nombre, True)
+            columna.add_attribute(render_nombre, "text", COL_NOMBRE)
+            self.vista_etiquetas.append_column(columna)
+            
+            # Contador de archivos, mantenido por triggers en la base de datos
+            render_contador = Gtk.CellRendererText(xalign=1.0, xpad=10, ypad=5)
+            render_contador.set_property("foreground-rgba", self.vista_etiquetas.get_style_context().get_color(Gtk.StateFlags.INSENSITIVE))
+            columna_contador = Gtk.TreeViewColumn("Archivos", render_contador, text=COL_CONTADOR)
+            columna_contador.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            columna_contador.set_fixed_width(120)
+            self.vista_etiquetas.append_column(columna_contador)
             
             scrolled = Gtk.ScrolledWindow()
             scrolled.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
             scrolled.set_min_content_height(200)
-            scrolled.add(self.listbox_etiquetas)
+            scrolled.add(self.vista_etiquetas)
             frame_etiquetas.add(scrolled)
             content_area.pack_start(frame_etiquetas, True, True, 0)
             
@@ -232,88 +486,69 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
             
             dialogo_busqueda.show_all()
             response = dialogo_busqueda.run()
+            self.cancelar_filtro_pendiente()
             dialogo_busqueda.destroy()
             
         except Exception as e:
-            print(f"❌ Error mostrando buscador: {e}")
-            import traceback
-            traceback.print_exc()
-
-    def actualizar_lista_etiquetas(self, etiquetas):
-        """Actualiza la lista de etiquetas en el diálogo de búsqueda"""
-        # Limpiar lista actual
-        for widget in self.listbox_etiquetas.get_children():
-            self.listbox_etiquetas.remove(widget)
-        
-        # Añadir etiquetas filtradas
+            log.exception("Error mostrando buscador: %s", e)
+
+    def crear_modelo_etiquetas(self, etiquetas):
+        """Crea el modelo de la lista de etiquetas del buscador"""
+        modelo = Gtk.ListStore(str, str)
         for etiqueta in etiquetas:
-            row = Gtk.ListBoxRow()
-            box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
-            box.set_margin_top(5)
-            box.set_margin_bottom(5)
-            box.set_margin_start(10)
-            box.set_margin_end(10)
-            
-            # Icono de etiqueta
-            icono = Gtk.Image.new_from_icon_name("tag-symbolic", Gtk.IconSize.BUTTON)
-            
-            label_etiqueta = Gtk.Label(label=etiqueta['nombre'])
-            label_etiqueta.set_halign(Gtk.Align.START)
-            label_etiqueta.set_hexpand(True)
-            
-            # Contador de archivos (opcional)
-            label_contador = Gtk.Label(label="? archivos")
-            label_contador.get_style_context().add_class("dim-label")
-            
-            box.pack_start(icono, False, False, 0)
-            box.pack_start(label_etiqueta, True, True, 0)
-            box.pack_start(label_contador, False, False, 0)
-            row.add(box)
-            
-            # Guardar el nombre de la etiqueta en la fila
-            row.etiqueta_nombre = etiqueta['nombre']
-            
-            self.listbox_etiquetas.add(row)
-        
-        self.listbox_etiquetas.show_all()
+            modelo.append([etiqueta['nombre'], f"{etiqueta.get('total', 0)} archivos"])
+        return modelo
+
+    def etiqueta_visible(self, modelo, iter_fila, datos):
+        """Función de visibilidad del filtro: la etiqueta coincide con el texto buscado"""
+        return not self.texto_filtro or modelo[iter_fila][COL_NOMBRE] in self.coincidencias_filtro
 
     def on_filtrar_etiquetas(self, entry):
-        """Filtra la lista de etiquetas en tiempo real"""
-        texto = entry.get_text().lower().strip()
-        
-        if texto == "":
-            # Mostrar todas las etiquetas
-            etiquetas_filtradas = self.todas_etiquetas
-        else:
-            # Filtrar etiquetas que contengan el texto
-            etiquetas_filtradas = [
-                e for e in self.todas_etiquetas 
-                if texto in e['nombre'].lower()
-            ]
-        
-        self.actualizar_lista_etiquetas(etiquetas_filtradas)
-        print(f"🔍 Filtrado: '{texto}' -> {len(etiquetas_filtradas)} etiquetas")
+        """Programa el filtrado de la lista; las pulsaciones seguidas se agrupan"""
+        self.cancelar_filtro_pendiente()
+        self.filtro_pendiente = GLib.timeout_add(RETARDO_FILTRO_MS, self.aplicar_filtro_etiquetas)
+
+    def cancelar_filtro_pendiente(self):
+        """Cancela un filtrado programado que aún no se ha ejecutado"""
+        if self.filtro_pendiente is not None:
+            GLib.source_remove(self.filtro_pendiente)
+            self.filtro_pendiente = None
+
+    def aplicar_filtro_etiquetas(self):
+        """Filtra la lista de etiquetas cambiando solo la visibilidad de las filas"""
+        self.filtro_pendiente = None
+        self.texto_filtro = self.entry_buscar.get_text().lower().strip()
+        # Subcadena, prefijo y erratas, resueltos con el índice de nombres de la base
+        self.coincidencias_filtro = {
+            e['nombre'] for e in self.gestor.buscar_etiquetas(self.texto_filtro, limite=MAX_ETIQUETAS_FILTRO)
+        }
+        self.filtro_etiquetas.refilter()
+        if log.isEnabledFor(logging.DEBUG):
+            # iter_n_children recorre todo el filtro: solo si se va a mostrar
+            log.debug("Filtrado: '%s' -> %d etiquetas", self.texto_filtro, self.filtro_etiquetas.iter_n_children(None))
+        return False  # No repetir el temporizador
 
-    def on_etiqueta_seleccionada(self, listbox, row):
+    def on_etiqueta_seleccionada(self, vista, path, columna):
         """Cuando se hace doble clic en una etiqueta, buscar archivos"""
-        if hasattr(row, 'etiqueta_nombre'):
-            etiqueta_nombre = row.etiqueta_nombre
-            print(f"🔍 Buscando archivos con etiqueta: {etiqueta_nombre}")
-            archivos = self.gestor.buscar_por_etiquetas([etiqueta_nombre], operador='OR')
-            
-            if archivos:
-                print(f"✅ Encontrados {len(archivos)} archivos con '{etiqueta_nombre}':")
-                for archivo in archivos:
-                    print(f"   📄 {os.path.basename(archivo)}")
+        modelo = vista.get_model()
+        iter_fila = modelo.get_iter(path)
+        if iter_fila is not None:
+            etiqueta_nombre = modelo[iter_fila][COL_NOMBRE]
+            log.debug("Buscando archivos con etiqueta: %s", etiqueta_nombre)
+            busqueda = {'etiquetas': [etiqueta_nombre], 'operador': 'OR'}
+            total = self.contar_resultados(busqueda)
+            
+            if total:
+                log.debug("Encontrados %d archivos con '%s'", total, etiqueta_nombre)
                 
                 # Mostrar resultados en un diálogo
-                self.mostrar_resultados_busqueda(archivos, etiqueta_nombre)
+                self.mostrar_resultados_busqueda(busqueda, etiqueta_nombre)
             else:
-                print(f"❌ No se encontraron archivos con la etiqueta '{etiqueta_nombre}'")
+                log.debug("No se encontraron archivos con la etiqueta '%s'", etiqueta_nombre)
                 
                 # Mostrar mensaje de no resultados
                 dialog = Gtk.MessageDialog(
-                    transient_for=listbox.get_toplevel(),
+                    transient_for=vista.get_toplevel(),
                     modal=True,
                     message_type=Gtk.MessageType.INFO,
                     buttons=Gtk.ButtonsType.OK,
@@ -325,7 +560,7 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
     def on_busqueda_avanzada(self, widget):
         """Diálogo para búsqueda avanzada con múltiples etiquetas"""
         try:
-            print("🔍 Iniciando búsqueda avanzada...")
+            log.debug("Iniciando búsqueda avanzada")
             
             # Diálogo de búsqueda avanzada
             dialog = Gtk.Dialog(
@@ -342,12 +577,26 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
             label_instrucciones.set_markup(
                 "<b>Selecciona múltiples etiquetas para buscar:</b>\n"
                 "• <b>AND</b>: Archivos que tienen TODAS las etiquetas seleccionadas\n"  
-                "• <b>OR</b>: Archivos que tienen AL MENOS UNA etiqueta seleccionada"
+                "• <b>OR</b>: Archivos que tienen AL MENOS UNA etiqueta seleccionada\n"
+                "O escribe una consulta con <b>AND</b>, <b>OR</b>, <b>NOT</b> y paréntesis "
+                "(usa comillas para etiquetas con espacios)"
             )
             label_instrucciones.set_margin_bottom(10)
             label_instrucciones.set_line_wrap(True)
             content_area.pack_start(label_instrucciones, False, False, 0)
             
+            # Consulta booleana libre; si tiene texto, tiene prioridad sobre las casillas
+            box_consulta = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=5)
+            box_consulta.set_margin_bottom(10)
+            label_consulta = Gtk.Label(label="Consulta:")
+            self.entry_consulta = Gtk.Entry()
+            self.entry_consulta.set_placeholder_text("(cliente-x OR cliente-y) AND factura AND NOT borrador")
+            self.entry_consulta.set_hexpand(True)
+            self.entry_consulta.connect("activate", self.on_ejecutar_busqueda_avanzada, dialog)
+            box_consulta.pack_start(label_consulta, False, False, 0)
+            box_consulta.pack_start(self.entry_consulta, True, True, 0)
+            content_area.pack_start(box_consulta, False, False, 0)
+            
             # Lista de etiquetas con checkboxes
             scrolled = Gtk.ScrolledWindow()
             scrolled.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
@@ -419,9 +668,7 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
             dialog.destroy()
             
         except Exception as e:
-            print(f"❌ Error en búsqueda avanzada: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("Error en búsqueda avanzada: %s", e)
 
     def on_limpiar_seleccion_avanzada(self, widget):
         """Limpia todos los checkboxes de la búsqueda avanzada"""
@@ -432,6 +679,11 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
     def on_ejecutar_busqueda_avanzada(self, widget, dialog):
         """Ejecuta la búsqueda avanzada con las etiquetas seleccionadas"""
         try:
+            consulta = self.entry_consulta.get_text().strip()
+            if consulta:
+                self.ejecutar_consulta(consulta, dialog)
+                return
+            
             # Obtener etiquetas seleccionadas
             etiquetas_seleccionadas = []
             for row in self.lista_checks_avanzada.get_children():
@@ -454,22 +706,23 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
             # Determinar operador
             operador = 'AND' if self.combo_operador.get_active() == 0 else 'OR'
             
-            print(f"🔍 Búsqueda avanzada ejecutando: {etiquetas_seleccionadas} ({operador})")
+            log.debug("Búsqueda avanzada ejecutando: %s (%s)", etiquetas_seleccionadas, operador)
             
-            # Ejecutar búsqueda
-            archivos = self.gestor.buscar_por_etiquetas(etiquetas_seleccionadas, operador=operador)
+            # Ejecutar búsqueda (solo el recuento; los resultados se recorren por páginas)
+            busqueda = {'etiquetas': etiquetas_seleccionadas, 'operador': operador}
+            total = self.contar_resultados(busqueda)
             
             # Cerrar diálogo actual
             dialog.response(Gtk.ResponseType.OK)
             
-            if archivos:
-                print(f"✅ Encontrados {len(archivos)} archivos con búsqueda {operador}")
+            if total:
+                log.debug("Encontrados %d archivos con búsqueda %s", total, operador)
                 
                 # Mostrar resultados en Nemo
                 descripcion = f"{operador}: {', '.join(etiquetas_seleccionadas)}"
-                self.mostrar_resultados_busqueda(archivos, descripcion)
+                self.mostrar_resultados_busqueda(busqueda, descripcion)
             else:
-                print("❌ No se encontraron archivos")
+                log.debug("No se encontraron archivos")
                 
                 # Mostrar mensaje
                 msg_dialog = Gtk.MessageDialog(
@@ -483,194 +736,207 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
                 msg_dialog.destroy()
                 
         except Exception as e:
-            print(f"❌ Error ejecutando búsqueda avanzada: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("Error ejecutando búsqueda avanzada: %s", e)
 
-    def mostrar_resultados_busqueda(self, archivos, etiqueta_nombre):
+    def ejecutar_consulta(self, consulta, dialog):
+        """Ejecuta una consulta booleana escrita en la búsqueda avanzada"""
+        busqueda = {'consulta': consulta}
+        try:
+            total = self.contar_resultados(busqueda)
+        except ErrorConsulta as e:
+            error_dialog = Gtk.MessageDialog(
+                transient_for=dialog,
+                modal=True,
+                message_type=Gtk.MessageType.WARNING,
+                buttons=Gtk.ButtonsType.OK,
+                text=f"Consulta no válida: {e}"
+            )
+            error_dialog.run()
+            error_dialog.destroy()
+            return
+        
+        log.debug("Consulta '%s': %d archivos", consulta, total)
+        dialog.response(Gtk.ResponseType.OK)
+        
+        if total:
+            self.mostrar_resultados_busqueda(busqueda, consulta)
+        else:
+            msg_dialog = Gtk.MessageDialog(
+                transient_for=dialog,
+                modal=True,
+                message_type=Gtk.MessageType.INFO,
+                buttons=Gtk.ButtonsType.OK,
+                text=f"No se encontraron archivos para la consulta:\n\n{consulta}"
+            )
+            msg_dialog.run()
+            msg_dialog.destroy()
+
+    def contar_resultados(self, busqueda):
+        """Cuenta los resultados de una búsqueda por etiquetas o por consulta"""
+        if 'consulta' in busqueda:
+            return self.gestor.contar_por_consulta(busqueda['consulta'])
+        return self.gestor.contar_por_etiquetas(busqueda['etiquetas'], busqueda['operador'])
+
+    def iterar_resultados(self, busqueda):
+        """Recorre las rutas de una búsqueda página a página, sin cargarlas todas"""
+        if 'consulta' in busqueda:
+            paginas = self.gestor.iterar_por_consulta(busqueda['consulta'])
+        else:
+            paginas = self.gestor.iterar_por_etiquetas(busqueda['etiquetas'], busqueda['operador'])
+        for pagina in paginas:
+            yield from pagina
+
+    def clave_busqueda(self, busqueda):
+        """Texto normalizado de una búsqueda: el mismo para búsquedas equivalentes"""
+        if 'consulta' in busqueda:
+            return 'consulta:' + normalizar_consulta(analizar_consulta(busqueda['consulta']))
+        etiquetas = sorted(set(busqueda['etiquetas']))
+        # Con una sola etiqueta AND y OR son la misma búsqueda
+        operador = busqueda['operador'] if len(etiquetas) > 1 else 'OR'
+        return f"{operador}:{json.dumps(etiquetas, ensure_ascii=False)}"
+
+    def firma_busqueda(self, busqueda):
+        """Firma de la base de la que dependen los resultados (ver firma_busqueda del gestor)"""
+        if 'consulta' in busqueda:
+            nodo = analizar_consulta(busqueda['consulta'])
+            return self.gestor.firma_busqueda(etiquetas_de(nodo), contiene_negacion(nodo))
+        return self.gestor.firma_busqueda(busqueda['etiquetas'])
+
+    def mostrar_resultados_busqueda(self, busqueda, etiqueta_nombre):
         """Sistema de cache inteligente que reutiliza resultados existentes"""
         try:
-            if not archivos:
-                dialog = Gtk.MessageDialog(
-                    transient_for=None,
-                    modal=True,
-                    message_type=Gtk.MessageType.INFO,
-                    buttons=Gtk.ButtonsType.OK,
-                    text=f"No se encontraron archivos con la etiqueta '{etiqueta_nombre}'"
-                )
-                dialog.run()
-                dialog.destroy()
-                return
-            
-            print(f"📂 Buscando en cache o creando vista para {len(archivos)} archivos...")
-            
-            # Crear directorio cache si no existe
-            cache_dir = os.path.expanduser("~/.cache/nemo-etiquetas")
-            os.makedirs(cache_dir, exist_ok=True)
-            
-            # Generar hash único de esta búsqueda
-            import hashlib
-            contenido_hash = f"{','.join(sorted(archivos))}:{etiqueta_nombre}"
-            hash_busqueda = hashlib.md5(contenido_hash.encode('utf-8')).hexdigest()[:12]
-            
-            # Buscar carpeta existente con el mismo hash
-            carpeta_existente = None
-            for item in os.listdir(cache_dir):
-                item_path = os.path.join(cache_dir, item)
-                if os.path.isdir(item_path) and hash_busqueda in item:
-                    # Verificar que los enlaces aún sean válidos
-                    if self.verificar_enlaces_validos(item_path, archivos):
-                        carpeta_existente = item_path
-                        print(f"  🔍 Cache encontrado: {carpeta_existente}")
-                        break
-            
-            if carpeta_existente:
-                # Reutilizar cache existente
-                carpeta_resultados = carpeta_existente
-                print(f"  ✅ Reutilizando cache existente")
+            # Reutilizar: una consulta al índice del caché y otra, pequeña, para la firma
+            clave = self.clave_busqueda(busqueda)
+            firma = self.firma_busqueda(busqueda)
+            en_cache = self.indice_busquedas.buscar(clave, firma)
+            
+            if en_cache:
+                carpeta_resultados, total = en_cache
+                log.debug("Reutilizando cache existente: %s", carpeta_resultados)
                 
                 # Actualizar timestamp para mantenerlo "fresco"
                 os.utime(carpeta_resultados, None)
                 
             else:
-                # Crear nueva carpeta de resultados
-                from datetime import datetime
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                nombre_carpeta = f"busqueda_{timestamp}_{hash_busqueda}"
-                carpeta_resultados = os.path.join(cache_dir, nombre_carpeta)
-                os.makedirs(carpeta_resultados, exist_ok=True)
-                
-                print(f"  📁 Nueva carpeta cache: {carpeta_resultados}")
-                
-                # Crear enlaces simbólicos
-                archivos_procesados = self.crear_enlaces_simbolicos(carpeta_resultados, archivos)
-                
-                if archivos_procesados == 0:
-                    print("❌ No se pudieron crear enlaces")
+                total = self.contar_resultados(busqueda)
+                if not total:
                     dialog = Gtk.MessageDialog(
                         transient_for=None,
                         modal=True,
-                        message_type=Gtk.MessageType.ERROR,
+                        message_type=Gtk.MessageType.INFO,
                         buttons=Gtk.ButtonsType.OK,
-                        text="Error: No se pudieron crear enlaces a los archivos encontrados"
+                        text=f"No se encontraron archivos con la etiqueta '{etiqueta_nombre}'"
                     )
                     dialog.run()
                     dialog.destroy()
                     return
                 
-                # Crear metadata de la búsqueda
-                self.crear_metadata_busqueda(carpeta_resultados, archivos, etiqueta_nombre, hash_busqueda)
+                log.debug("Creando vista para %d archivos", total)
+                
+                # El nombre de la carpeta solo necesita el hash de la clave, no de los resultados
+                import hashlib
+                hash_busqueda = hashlib.md5(clave.encode('utf-8', 'surrogateescape')).hexdigest()[:12]
+                # Al escribir la metadata se anotan enlaces y espacio para el desalojo del caché
+                resumen = {}
+                def preparar(carpeta, enlaces):
+                    self.crear_metadata_busqueda(carpeta, enlaces, total, etiqueta_nombre, hash_busqueda)
+                    resumen['enlaces'] = len(enlaces)
+                    resumen['bytes'] = uso_disco(carpeta, enlaces)
+                
+                # Si la búsqueda ya tenía carpeta, parchearla: solo cambian los enlaces afectados
+                carpeta_anterior = self.indice_busquedas.carpeta(clave)
+                cambios = None
+                if carpeta_anterior and os.path.isdir(carpeta_anterior):
+                    cambios = actualizar_enlaces(
+                        carpeta_anterior, self.iterar_resultados(busqueda), preparar=preparar
+                    )
+                
+                if cambios is not None:
+                    carpeta_resultados = carpeta_anterior
+                    agregados, eliminados = cambios
+                    log.debug("Carpeta actualizada: +%d / -%d enlaces", agregados, eliminados)
+                    os.utime(carpeta_resultados, None)
+                    self.indice_busquedas.registrar(clave, firma, carpeta_resultados, total, **resumen)
+                else:
+                    # Crear directorio cache si no existe
+                    cache_dir = os.path.expanduser("~/.cache/nemo-etiquetas")
+                    os.makedirs(cache_dir, exist_ok=True)
+                    
+                    # Crear nueva carpeta de resultados
+                    from datetime import datetime
+                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    nombre_carpeta = f"busqueda_{timestamp}_{hash_busqueda}"
+                    carpeta_resultados = os.path.join(cache_dir, nombre_carpeta)
+                    
+                    log.debug("Nueva carpeta cache: %s", carpeta_resultados)
+                    
+                    # Crear enlaces simbólicos y metadata en una carpeta temporal que
+                    # se publica de golpe: Nemo nunca ve la carpeta a medias
+                    archivos_procesados = materializar_enlaces(
+                        carpeta_resultados, self.iterar_resultados(busqueda), preparar=preparar
+                    )
+                    log.debug("%d enlaces creados", archivos_procesados)
+                    
+                    if archivos_procesados == 0:
+                        log.error("No se pudieron crear enlaces en %s", carpeta_resultados)
+                        dialog = Gtk.MessageDialog(
+                            transient_for=None,
+                            modal=True,
+                            message_type=Gtk.MessageType.ERROR,
+                            buttons=Gtk.ButtonsType.OK,
+                            text="Error: No se pudieron crear enlaces a los archivos encontrados"
+                        )
+                        dialog.run()
+                        dialog.destroy()
+                        return
+                    
+                    self.indice_busquedas.registrar(clave, firma, carpeta_resultados, total, **resumen)
+                    
+                    # La carpeta anterior (sin metadata parcheable) ha quedado obsoleta
+                    if carpeta_anterior and carpeta_anterior != carpeta_resultados:
+                        import shutil
+                        shutil.rmtree(carpeta_anterior, ignore_errors=True)
             
             # Abrir la carpeta en Nemo
             self.abrir_carpeta_nemo(carpeta_resultados)
             
             # Mostrar información al usuario
-            self.mostrar_info_usuario(archivos, etiqueta_nombre, carpeta_resultados, bool(carpeta_existente))
-            
-            # Limpiar cache antiguo periódicamente
-            if not carpeta_existente:  # Solo limpiar cuando creamos nueva carpeta
-                self.limpiar_cache_antiguo()
-            
-        except Exception as e:
-            print(f"❌ Error en mostrar_resultados_busqueda: {e}")
-            import traceback
-            traceback.print_exc()
-
-    def verificar_enlaces_validos(self, carpeta, archivos_esperados):
-        """Verifica que todos los enlaces en la carpeta apunten a los archivos esperados"""
-        try:
-            archivos_esperados_set = set(archivos_esperados)
-            archivos_encontrados = set()
-            
-            for item in os.listdir(carpeta):
-                item_path = os.path.join(carpeta, item)
-                
-                # Saltar el archivo de metadata
-                if item == "metadata.json":
-                    continue
-                    
-                if os.path.islink(item_path):
-                    try:
-                        objetivo = os.readlink(item_path)
-                        if objetivo in archivos_esperados_set:
-                            archivos_encontrados.add(objetivo)
-                        else:
-                            return False  # Enlace apunta a archivo incorrecto
-                    except:
-                        return False  # Enlace roto
-                else:
-                    return False  # Archivo que no es enlace
+            self.mostrar_info_usuario(total, etiqueta_nombre, carpeta_resultados, bool(en_cache))
             
-            # Verificar que tenemos todos los archivos esperados
-            return archivos_encontrados == archivos_esperados_set
+            # Limpiar cache antiguo periódicamente, sin tocar la búsqueda que se acaba de abrir
+            if not en_cache:  # Solo limpiar cuando creamos nueva carpeta
+                self.lanzar_limpieza_cache(proteger={clave})
             
         except Exception as e:
-            print(f"❌ Error verificando enlaces: {e}")
-            return False
-
-    def crear_enlaces_simbolicos(self, carpeta_destino, archivos):
-        """Crea enlaces simbólicos optimizados"""
-        archivos_procesados = 0
-        
-        for archivo_original in archivos:
-            try:
-                nombre_archivo = os.path.basename(archivo_original)
-                nombre_base, extension = os.path.splitext(nombre_archivo)
-                
-                # Generar nombre único para el enlace
-                contador = 1
-                nombre_enlace = nombre_archivo
-                ruta_enlace = os.path.join(carpeta_destino, nombre_enlace)
-                
-                while os.path.exists(ruta_enlace):
-                    # Si ya existe un enlace que apunta al mismo archivo, reutilizarlo
-                    if os.path.islink(ruta_enlace) and os.readlink(ruta_enlace) == archivo_original:
-                        break
-                    nombre_enlace = f"{nombre_base}_{contador}{extension}"
-                    ruta_enlace = os.path.join(carpeta_destino, nombre_enlace)
-                    contador += 1
-                
-                # Solo crear enlace si no existe
-                if not os.path.exists(ruta_enlace):
-                    os.symlink(archivo_original, ruta_enlace)
-                    archivos_procesados += 1
-                    print(f"  🔗 Enlace creado: {nombre_enlace}")
-                    
-            except Exception as e:
-                print(f"  ❌ Error creando enlace para {archivo_original}: {e}")
-        
-        return archivos_procesados
+            log.exception("Error en mostrar_resultados_busqueda: %s", e)
 
-    def crear_metadata_busqueda(self, carpeta, archivos, etiqueta_nombre, hash_busqueda):
+    def crear_metadata_busqueda(self, carpeta, enlaces, total_archivos, etiqueta_nombre, hash_busqueda):
         """Crea archivo de metadata para tracking y reutilización"""
-        import json
         from datetime import datetime
         
         metadata = {
             "hash_busqueda": hash_busqueda,
             "etiqueta": etiqueta_nombre,
-            "total_archivos": len(archivos),
-            "fecha_creacion": datetime.now().isoformat(),
-            "archivos": archivos
+            "total_archivos": total_archivos,
+            "fecha_creacion": datetime.now().isoformat()
         }
         
-        metadata_path = os.path.join(carpeta, "metadata.json")
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, indent=2, ensure_ascii=False)
+        # Guarda también {ruta: enlace}: es lo que permite parchear la carpeta después
+        escribir_metadata(carpeta, metadata, enlaces)
 
     def abrir_carpeta_nemo(self, carpeta):
         """Abre la carpeta en Nemo"""
         try:
             subprocess.Popen(['nemo', carpeta])
-            print(f"✅ Nemo abierto en: {carpeta}")
+            log.debug("Nemo abierto en: %s", carpeta)
         except Exception as e:
-            print(f"❌ Error abriendo Nemo: {e}")
+            log.error("Error abriendo Nemo: %s", e)
             try:
                 os.system(f"nemo '{carpeta}' &")
             except:
                 pass
 
-    def mostrar_info_usuario(self, archivos, etiqueta_nombre, carpeta_resultados, cache_reutilizado):
+    def mostrar_info_usuario(self, total_archivos, etiqueta_nombre, carpeta_resultados, cache_reutilizado):
         """Muestra información al usuario sobre la búsqueda"""
         if cache_reutilizado:
             estado_cache = "✅ (Resultados reutilizados del cache)"
@@ -681,7 +947,7 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
 
     📊 Resultados:
     • Etiqueta: {etiqueta_nombre}
-    • Archivos encontrados: {len(archivos)}
+    • Archivos encontrados: {total_archivos}
     • Ubicación: {carpeta_resultados}
 
     💡 Características del sistema:
@@ -704,67 +970,32 @@ class EtiquetasExtension(GObject.GObject, Nemo.MenuProvider):
         dialog.destroy()
 
 
-    def limpiar_cache_antiguo(self):
+    def limpiar_cache_antiguo(self, barrer=False, proteger=()):
         """Limpia búsquedas temporales manteniendo las más usadas recientemente"""
+        if not self.limpieza_en_curso.acquire(blocking=False):
+            return
         try:
-            cache_dir = os.path.expanduser("~/.cache/nemo-etiquetas")
-            if not os.path.exists(cache_dir):
-                return
+            if barrer:
+                # Carpetas que el índice no conoce (versiones anteriores) o temporales abandonadas
+                for carpeta in self.indice_busquedas.barrer_huerfanas():
+                    log.info("Limpiada carpeta cache huérfana: %s", os.path.basename(carpeta))
+            
+            # El índice sabe qué sobra: no se recorre el caché ni se lee ningún metadata.json
+            desalojadas = self.indice_busquedas.desalojar(
+                max_entradas=MAX_BUSQUEDAS_CACHE,
+                max_bytes=MAX_MB_CACHE * 1024 * 1024,
+                max_dias=MAX_DIAS_CACHE,
+                proteger=proteger
+            )
+            for carpeta, tamano in desalojadas:
+                log.debug("Limpiada carpeta cache: %s (%.0f KiB)", os.path.basename(carpeta), tamano / 1024)
             
-            import time
-            import json
-            
-            ahora = time.time()
-            carpeta_info = []
-            
-            # Recolectar información de todas las carpetas de cache
-            for item in os.listdir(cache_dir):
-                item_path = os.path.join(cache_dir, item)
-                if os.path.isdir(item_path) and item.startswith("busqueda_"):
-                    try:
-                        # Leer metadata si existe
-                        metadata_path = os.path.join(item_path, "metadata.json")
-                        if os.path.exists(metadata_path):
-                            with open(metadata_path, 'r') as f:
-                                metadata = json.load(f)
-                                fecha_creacion = metadata.get('fecha_creacion', '')
-                        else:
-                            fecha_creacion = ''
-                        
-                        # Obtener tiempo de última modificación (uso)
-                        mtime = os.path.getmtime(item_path)
-                        dias_antiguedad = (ahora - mtime) / (24 * 60 * 60)
-                        
-                        carpeta_info.append({
-                            'path': item_path,
-                            'mtime': mtime,
-                            'dias_antiguedad': dias_antiguedad,
-                            'metadata': fecha_creacion,
-                            'nombre': item
-                        })
-                        
-                    except Exception as e:
-                        print(f"❌ Error procesando {item}: {e}")
-            
-            # Ordenar por antigüedad (más antiguas primero)
-            carpeta_info.sort(key=lambda x: x['mtime'])
-            
-            # Mantener máximo 10 carpetas y eliminar las > 30 días
-            max_carpetas = 10
-            eliminadas = 0
-            
-            for i, info in enumerate(carpeta_info):
-                if i < len(carpeta_info) - max_carpetas or info['dias_antiguedad'] > 30:
-                    try:
-                        import shutil
-                        shutil.rmtree(info['path'])
-                        eliminadas += 1
-                        print(f"🗑️ Limpiada carpeta cache: {info['nombre']} ({info['dias_antiguedad']:.1f} días)")
-                    except Exception as e:
-                        print(f"❌ Error limpiando {info['nombre']}: {e}")
-            
-            if eliminadas > 0:
-                print(f"📊 Cache limpiado: {eliminadas} carpetas eliminadas")
+            if desalojadas:
+                entradas, ocupado = self.indice_busquedas.totales()
+                log.info("Cache limpiado: %d carpetas eliminadas, quedan %d (%.1f MiB)",
+                         len(desalojadas), entradas, ocupado / (1024 * 1024))
                 
         except Exception as e:
-            print(f"❌ Error en limpiar_cache_antiguo: {e}")
+            log.exception("Error en limpiar_cache_antiguo: %s", e)
+        finally:
+            self.limpieza_en_curso.release()
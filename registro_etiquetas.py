@@ -0,0 +1,207 @@
+"""Registro (logging) y métricas de rendimiento de la extensión.
+
+Los mensajes van al logger "etiquetas" y sus hijos; el nivel se elige con
+la variable de entorno NEMO_ETIQUETAS_LOG (DEBUG, INFO, WARNING, ERROR;
+por defecto WARNING, así que Nemo no escribe nada mientras todo va bien).
+
+Las métricas son opcionales: con NEMO_ETIQUETAS_METRICAS=1 (o con la ruta
+del archivo de volcado) los métodos decorados con @instrumentado cuentan
+llamadas, errores y filas tocadas y guardan un histograma de latencias.
+Sin la variable el decorador devuelve la función tal cual, sin coste.
+"""
+
+import atexit
+import bisect
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+RAIZ = 'etiquetas'
+
+VARIABLE_NIVEL = 'NEMO_ETIQUETAS_LOG'
+VARIABLE_METRICAS = 'NEMO_ETIQUETAS_METRICAS'
+
+FORMATO = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# Límites superiores (ms) de los cubos del histograma; el último es infinito
+LIMITES_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def obtener_registro(nombre):
+    """Logger hijo de "etiquetas" para un módulo"""
+    return logging.getLogger(f'{RAIZ}.{nombre}')
+
+
+def configurar_registro(nivel=None, flujo=None, formato=FORMATO):
+    """Manda los mensajes de "etiquetas" a stderr con el nivel dado o el del entorno.
+
+    Se puede llamar varias veces: solo cambian el nivel, el flujo y el formato.
+    """
+    nivel = nivel or os.environ.get(VARIABLE_NIVEL) or 'WARNING'
+    if isinstance(nivel, str):
+        nivel = logging.getLevelName(nivel.upper())
+        if not isinstance(nivel, int):
+            nivel = logging.WARNING
+
+    raiz = logging.getLogger(RAIZ)
+    raiz.setLevel(nivel)
+    raiz.propagate = False
+    for manejador in raiz.handlers:
+        if getattr(manejador, '_etiquetas', False):
+            break
+    else:
+        manejador = logging.StreamHandler()
+        manejador._etiquetas = True
+        raiz.addHandler(manejador)
+    manejador.setStream(flujo or sys.stderr)
+    manejador.setFormatter(logging.Formatter(formato))
+    return raiz
+
+
+def _destino_metricas():
+    """Archivo de volcado según NEMO_ETIQUETAS_METRICAS, o None si están apagadas"""
+    valor = os.environ.get(VARIABLE_METRICAS, '').strip()
+    if not valor or valor == '0':
+        return None
+    if valor in ('1', 'true', 'si', 'sí'):
+        return os.path.expanduser(f'~/.cache/nemo-etiquetas/metricas-{os.getpid()}.json')
+    return os.path.expanduser(valor)
+
+
+class Metricas:
+    """Contadores e histogramas de latencia por operación, seguros entre hilos"""
+
+    def __init__(self, destino=None):
+        self.destino = destino
+        self.inicio = time.time()
+        self._cerrojo = threading.Lock()
+        # nombre -> [llamadas, errores, filas, total_ms, max_ms, cubos]
+        self._operaciones = {}
+
+    @property
+    def activas(self):
+        return self.destino is not None
+
+    def registrar(self, nombre, milisegundos, filas=None, error=False):
+        """Anota una llamada a una operación"""
+        cubo = bisect.bisect_left(LIMITES_MS, milisegundos)
+        with self._cerrojo:
+            datos = self._operaciones.get(nombre)
+            if datos is None:
+                datos = self._operaciones[nombre] = [0, 0, 0, 0.0, 0.0, [0] * (len(LIMITES_MS) + 1)]
+            datos[0] += 1
+            datos[1] += error
+            datos[2] += filas or 0
+            datos[3] += milisegundos
+            datos[4] = max(datos[4], milisegundos)
+            datos[5][cubo] += 1
+
+    @staticmethod
+    def _percentil(cubos, llamadas, fraccion):
+        """Límite superior del cubo donde cae el percentil (una cota, no el valor exacto)"""
+        objetivo = fraccion * llamadas
+        acumulado = 0
+        for limite, cuenta in zip(LIMITES_MS + (None,), cubos):
+            acumulado += cuenta
+            if acumulado >= objetivo:
+                return limite
+        return None
+
+    def resumen(self):
+        """Diccionario serializable con las cifras de cada operación"""
+        with self._cerrojo:
+            operaciones = {nombre: (datos[:5] + [list(datos[5])]) for nombre, datos in self._operaciones.items()}
+
+        etiquetas_cubos = [f'<={limite}' for limite in LIMITES_MS] + [f'>{LIMITES_MS[-1]}']
+        resultado = {}
+        for nombre, (llamadas, errores, filas, total, maximo, cubos) in sorted(operaciones.items()):
+            resultado[nombre] = {
+                'llamadas': llamadas,
+                'errores': errores,
+                'filas': filas,
+                'total_ms': round(total, 3),
+                'media_ms': round(total / llamadas, 3),
+                'max_ms': round(maximo, 3),
+                'p50_ms': self._percentil(cubos, llamadas, 0.5),
+                'p95_ms': self._percentil(cubos, llamadas, 0.95),
+                'p99_ms': self._percentil(cubos, llamadas, 0.99),
+                'histograma_ms': {clave: cuenta for clave, cuenta in zip(etiquetas_cubos, cubos) if cuenta},
+            }
+        return resultado
+
+    def volcar(self, ruta=None):
+        """Escribe el resumen en JSON (reemplazo atómico); devuelve la ruta"""
+        ruta = ruta or self.destino
+        os.makedirs(os.path.dirname(os.path.abspath(ruta)), exist_ok=True)
+        datos = {
+            'pid': os.getpid(),
+            'desde': self.inicio,
+            'hasta': time.time(),
+            'operaciones': self.resumen(),
+        }
+        temporal = f'{ruta}.tmp'
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump(datos, f, ensure_ascii=False, indent=2)
+        os.replace(temporal, ruta)
+        return ruta
+
+    def reiniciar(self):
+        with self._cerrojo:
+            self._operaciones.clear()
+        self.inicio = time.time()
+
+
+# Colector del proceso; activo solo si NEMO_ETIQUETAS_METRICAS está definida
+metricas = Metricas(_destino_metricas())
+
+
+def _volcar_al_salir():
+    try:
+        metricas.volcar()
+    except OSError as e:
+        logging.getLogger(RAIZ).error("Error volcando métricas: %s", e)
+
+
+if metricas.activas:
+    atexit.register(_volcar_al_salir)
+
+
+def _filas_por_defecto(resultado):
+    """Filas tocadas: el tamaño del resultado si es una colección"""
+    if isinstance(resultado, (list, tuple, set, frozenset, dict)):
+        return len(resultado)
+    return None
+
+
+def instrumentado(nombre=None, filas=_filas_por_defecto):
+    """Decorador que mide cada llamada si las métricas están activas.
+
+    `filas` calcula las filas tocadas a partir del valor devuelto (None si
+    no tiene sentido contarlas). Se decide al decorar: con las métricas
+    apagadas se devuelve la función original.
+    """
+    def decorar(funcion):
+        if not metricas.activas:
+            return funcion
+        operacion = nombre or funcion.__qualname__
+
+        @functools.wraps(funcion)
+        def envoltorio(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                resultado = funcion(*args, **kwargs)
+            except BaseException:
+                metricas.registrar(operacion, (time.perf_counter() - inicio) * 1000, error=True)
+                raise
+            try:
+                tocadas = filas(resultado) if filas else None
+            except (TypeError, KeyError):
+                tocadas = None
+            metricas.registrar(operacion, (time.perf_counter() - inicio) * 1000, tocadas)
+            return resultado
+        return envoltorio
+    return decorar
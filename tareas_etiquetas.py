@@ -0,0 +1,33 @@
+from gi.repository import GLib
+from concurrent.futures import ThreadPoolExecutor
+
+from registro_etiquetas import obtener_registro
+
+log = obtener_registro('tareas')
+
+# Un único hilo de trabajo: las operaciones se serializan (un guardado siempre
+# termina antes de la siguiente lectura) y el gestor reutiliza una sola conexión
+_EJECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='etiquetas')
+
+
+def ejecutar_en_segundo_plano(trabajo, al_terminar=None, al_fallar=None):
+    """Ejecuta trabajo() fuera del hilo de GTK y entrega el resultado con GLib.idle_add"""
+    def entregar(callback, valor):
+        callback(valor)
+        return False  # No repetir el idle
+    
+    def ejecutar():
+        try:
+            resultado = trabajo()
+        except Exception as e:
+            if al_fallar is None:
+                log.exception("Error en un trabajo de fondo: %s", e)
+                return
+            # al_fallar informa del error; la traza queda para el nivel DEBUG
+            log.debug("Error en un trabajo de fondo: %s", e, exc_info=True)
+            GLib.idle_add(entregar, al_fallar, e)
+            return
+        if al_terminar is not None:
+            GLib.idle_add(entregar, al_terminar, resultado)
+    
+    _EJECUTOR.submit(ejecutar)